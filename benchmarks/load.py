@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# coding: utf-8
+# photofs
+# Copyright (C) 2012-2016 Moses Palmér
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see <http://www.gnu.org/licenses/>.
+"""Measures the time taken to load a Shotwell library.
+
+The tag lists of the database are first parsed repeatedly to measure the
+throughput of the parser in IDs per second, and the library is then loaded a
+number of times, reporting the time spent in every phase::
+
+    python benchmarks/load.py --database photo.db
+"""
+
+import argparse
+import os
+import sqlite3
+import sys
+import time
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lib'))
+
+from photofs.sources.shotwell import ShotwellSource
+
+
+def parse(database, repeat):
+    """Parses all tag lists of a database.
+
+    :param str database: The database file.
+
+    :param int repeat: The number of times to parse the lists.
+
+    :return: the tuple ``(ids, duration, distinct)``, where ``ids`` is the
+        number of IDs parsed per pass, ``duration`` the number of seconds
+        taken by the fastest pass and ``distinct`` the number of distinct lists
+    """
+    db = sqlite3.connect(database)
+    try:
+        lists = [
+            value
+            for value, in db.execute('SELECT photo_id_list FROM tagtable')
+            if value]
+    finally:
+        db.close()
+
+    ids = 0
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        parsed = {}
+        ids = 0
+        for value in lists:
+            result = parsed.get(value)
+            if result is None:
+                result = parsed[value] = ShotwellSource.parse_photo_id_list(
+                    value)
+            ids += sum(len(table_ids) for _, table_ids in result)
+        duration = time.time() - start
+        best = duration if best is None else min(best, duration)
+
+    return (ids, best, len(set(lists)))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.split('\n\n')[0])
+    parser.add_argument(
+        '--database',
+        help='The Shotwell database.',
+        required=True)
+    parser.add_argument(
+        '--repeat',
+        help='The number of times to parse and load.',
+        type=int,
+        default=3)
+    args = parser.parse_args()
+
+    ids, duration, distinct = parse(args.database, args.repeat)
+    sys.stdout.write(
+        'parse    %8d ids  %5d distinct lists  %10.0f ids/s\n' % (
+            ids, distinct, ids / duration if duration else 0.0))
+
+    for i in range(args.repeat):
+        source = ShotwellSource(database=args.database, snapshot='transaction')
+        source.reload()
+        stats = source.stats
+        sys.stdout.write(
+            'load     %8.3f s  %s\n' % (
+                stats['last_duration'],
+                '  '.join(
+                    '%s %.3f s' % item
+                    for item in sorted(stats['phases'].items()))))
+
+
+if __name__ == '__main__':
+    main()
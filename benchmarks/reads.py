@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+# coding: utf-8
+# photofs
+# Copyright (C) 2012-2016 Moses Palmér
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see <http://www.gnu.org/licenses/>.
+"""Compares the FUSE backends for many concurrent small reads.
+
+Every backend is mounted in turn on a temporary directory, and a number of
+threads then read small blocks at random offsets of random files for a fixed
+duration. Any additional arguments are passed to photofs, for example::
+
+    python benchmarks/reads.py --threads 32 -- --database photo.db
+"""
+
+import argparse
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+
+def files(mountpoint):
+    """Lists all files beneath a mount point.
+
+    :param str mountpoint: The mount point.
+
+    :return: a list of paths
+    """
+    result = []
+    for root, dirs, names in os.walk(mountpoint):
+        dirs[:] = [d for d in dirs if not d.startswith('.')]
+        result.extend(os.path.join(root, name) for name in names)
+    return result
+
+
+def mount(backend, mountpoint, args):
+    """Mounts photofs and waits for the mount to appear.
+
+    :param str backend: The backend to use.
+
+    :param str mountpoint: The mount point.
+
+    :param [str] args: Additional arguments.
+
+    :return: the daemon process
+    """
+    process = subprocess.Popen([
+        sys.executable, '-m', 'photofs',
+        '--foreground',
+        '--backend', backend] + args + [mountpoint])
+    for i in range(100):
+        if os.path.ismount(mountpoint):
+            return process
+        elif process.poll() is not None:
+            raise RuntimeError('Failed to mount using %s' % backend)
+        time.sleep(0.1)
+    process.terminate()
+    raise RuntimeError('Timed out mounting using %s' % backend)
+
+
+def unmount(mountpoint, process):
+    """Unmounts photofs.
+
+    :param str mountpoint: The mount point.
+
+    :param process: The daemon process.
+    """
+    for command in ('fusermount3', 'fusermount'):
+        try:
+            subprocess.check_call([command, '-u', mountpoint])
+            break
+        except (OSError, subprocess.CalledProcessError):
+            pass
+    process.wait()
+
+
+def run(paths, threads, duration, size):
+    """Reads small blocks concurrently.
+
+    :param [str] paths: The files to read.
+
+    :param int threads: The number of reading threads.
+
+    :param float duration: The number of seconds to read.
+
+    :param int size: The number of bytes per read.
+
+    :return: a sorted list of latencies in seconds
+    """
+    latencies = []
+    lock = threading.Lock()
+    end = time.time() + duration
+
+    def reader(seed):
+        generator = random.Random(seed)
+        local = []
+        while time.time() < end:
+            path = generator.choice(paths)
+            start = time.time()
+            fd = os.open(path, os.O_RDONLY)
+            try:
+                length = os.fstat(fd).st_size
+                os.pread(
+                    fd, size, generator.randrange(max(1, length - size)))
+            finally:
+                os.close(fd)
+            local.append(time.time() - start)
+        with lock:
+            latencies.extend(local)
+
+    workers = [
+        threading.Thread(target=reader, args=(i,))
+        for i in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    return sorted(latencies)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.split('\n\n')[0])
+    parser.add_argument(
+        '--backends',
+        help='The backends to compare.',
+        nargs='+',
+        default=['fusepy', 'pyfuse3'])
+    parser.add_argument(
+        '--threads',
+        help='The number of concurrent readers.',
+        type=int,
+        default=16)
+    parser.add_argument(
+        '--duration',
+        help='The number of seconds to read for every backend.',
+        type=float,
+        default=10.0)
+    parser.add_argument(
+        '--size',
+        help='The number of bytes per read.',
+        type=int,
+        default=4096)
+    parser.add_argument(
+        'photofs_args',
+        help='Arguments passed to photofs.',
+        nargs='*')
+    args = parser.parse_args()
+
+    for backend in args.backends:
+        mountpoint = tempfile.mkdtemp(prefix='photofs-')
+        try:
+            process = mount(backend, mountpoint, args.photofs_args)
+            try:
+                paths = files(mountpoint)
+                if not paths:
+                    raise RuntimeError('No files to read')
+                latencies = run(
+                    paths, args.threads, args.duration, args.size)
+            finally:
+                unmount(mountpoint, process)
+        finally:
+            os.rmdir(mountpoint)
+
+        count = len(latencies)
+        sys.stdout.write(
+            '%-8s %8.0f reads/s  p50 %6.2f ms  p99 %6.2f ms\n' % (
+                backend,
+                count / args.duration,
+                1000 * latencies[count // 2] if count else 0.0,
+                1000 * latencies[int(count * 0.99)] if count else 0.0))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,300 @@
+#!/usr/bin/env python
+# coding: utf-8
+# photofs
+# Copyright (C) 2012-2016 Moses Palmér
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see <http://www.gnu.org/licenses/>.
+"""Stresses a file system from many threads while the library is reloaded.
+
+A file system is created in-process, without mounting it, and a number of
+threads then call ``getattr``, ``readdir``, ``open``, ``read`` and ``release``
+on random paths, while a background thread forces reloads of the image source.
+For every number of threads, the throughput, the latency percentiles and the
+number of correctness violations are reported::
+
+    python benchmarks/stress.py --database photo.db --threads 1 4 16 64
+
+Every result is compared with the state of the file system before the run, so
+any difference is reported as a violation: a path that disappeared, a listing
+that changed, data that differs from the original file or an unexpected
+exception.
+"""
+
+import argparse
+import collections
+import errno
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lib'))
+
+from photofs import PhotoFS
+from photofs._filter import is_photo, is_video
+
+
+#: The number of bytes per read, matching the reads of the kernel
+READ_SIZE = 128 * 1024
+
+
+def snapshot(photo_fs):
+    """Records the expected state of a file system.
+
+    :param PhotoFS photo_fs: The file system.
+
+    :return: the tuple ``(directories, files)``, where ``directories`` is a
+        mapping from path to the set of names listed and ``files`` a mapping
+        from path to the tuple ``(size, location)``
+    """
+    directories = {}
+    files = {}
+    pending = [os.path.sep]
+    while pending:
+        path = pending.pop()
+        names = set(photo_fs.readdir(path, 0))
+        directories[path] = names
+        for name in names:
+            if name.startswith('.'):
+                continue
+            child = os.path.join(path, name)
+            st = photo_fs.getattr(child)
+            if st['st_mode'] & 0o170000 == 0o040000:
+                pending.append(child)
+            else:
+                item = photo_fs.locate(child)[1]
+                files[child] = (st['st_size'], getattr(item, 'location', None))
+
+    # Hidden directories are generated, and may differ between listings
+    for names in directories.values():
+        names.difference_update([
+            name for name in names if name.startswith('.')])
+    return (directories, files)
+
+
+class Worker(threading.Thread):
+    """A thread performing random operations until stopped.
+    """
+    def __init__(self, photo_fs, directories, files, seed, stopped):
+        super(Worker, self).__init__()
+        self.daemon = True
+        self._photo_fs = photo_fs
+        self._directories = directories
+        self._directory_paths = sorted(directories)
+        self._files = files
+        self._file_paths = sorted(files)
+        self._random = random.Random(seed)
+        self._stopped = stopped
+        self.latencies = []
+        self.violations = collections.Counter()
+
+    def _getattr(self):
+        path = self._random.choice(self._file_paths)
+        if self._photo_fs.getattr(path)['st_size'] != self._files[path][0]:
+            self.violations['size'] += 1
+
+    def _readdir(self):
+        path = self._random.choice(self._directory_paths)
+        names = set(
+            name
+            for name in self._photo_fs.readdir(path, 0)
+            if not name.startswith('.'))
+        if names != self._directories[path]:
+            self.violations['listing'] += 1
+
+    def _read(self):
+        path = self._random.choice(self._file_paths)
+        size, location = self._files[path]
+        offset = self._random.randrange(0, max(size, 1), READ_SIZE)
+        fh = self._photo_fs.open(path, os.O_RDONLY)
+        try:
+            data = bytes(self._photo_fs.read(path, READ_SIZE, offset, fh))
+        finally:
+            self._photo_fs.release(path, fh)
+
+        if location is not None:
+            with open(location, 'rb') as f:
+                f.seek(offset)
+                if f.read(READ_SIZE) != data:
+                    self.violations['data'] += 1
+
+    def run(self):
+        operations = (self._getattr, self._readdir, self._read, self._read)
+        while not self._stopped.is_set():
+            operation = self._random.choice(operations)
+            start = time.time()
+            try:
+                operation()
+            except OSError as e:
+                self.violations[
+                    'missing' if e.errno == errno.ENOENT
+                    else errno.errorcode.get(e.errno, 'oserror')] += 1
+            except Exception as e:
+                self.violations[type(e).__name__] += 1
+            self.latencies.append(time.time() - start)
+
+
+def reloader(photo_fs, interval, stopped, counter):
+    """Forces reloads of the image source until stopped.
+
+    :param PhotoFS photo_fs: The file system.
+
+    :param float interval: The number of seconds between reloads.
+
+    :param threading.Event stopped: The event signalling that the run is
+        complete.
+
+    :param list counter: A list whose first element is incremented for every
+        reload.
+    """
+    while not stopped.wait(interval):
+        photo_fs.image_source.reload()
+        counter[0] += 1
+
+
+def run(photo_fs, directories, files, threads, duration, interval):
+    """Stresses a file system.
+
+    :param PhotoFS photo_fs: The file system.
+
+    :param dict directories: The expected directory listings.
+
+    :param dict files: The expected file sizes and locations.
+
+    :param int threads: The number of threads.
+
+    :param float duration: The number of seconds to run.
+
+    :param float interval: The number of seconds between reloads.
+
+    :return: the tuple ``(latencies, violations, reloads)``
+    """
+    stopped = threading.Event()
+    reloads = [0]
+    workers = [
+        Worker(photo_fs, directories, files, i, stopped)
+        for i in range(threads)]
+    background = threading.Thread(
+        target=reloader, args=(photo_fs, interval, stopped, reloads))
+    background.daemon = True
+
+    background.start()
+    for worker in workers:
+        worker.start()
+    time.sleep(duration)
+    stopped.set()
+    for worker in workers:
+        worker.join()
+    background.join()
+
+    latencies = sorted(
+        latency
+        for worker in workers
+        for latency in worker.latencies)
+    violations = collections.Counter()
+    for worker in workers:
+        violations.update(worker.violations)
+    return (latencies, violations, reloads[0])
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.split('\n\n')[0])
+    parser.add_argument(
+        '--source',
+        help='The image source.',
+        default='shotwell')
+    parser.add_argument(
+        '--database',
+        help='The database, or root directory, of the image source.')
+    parser.add_argument(
+        '--load-in-worker',
+        help='Load images and tags in a worker process.',
+        action='store_true')
+    parser.add_argument(
+        '--read-workers',
+        help='The number of threads used to read files.',
+        type=int)
+    parser.add_argument(
+        '--mmap-size',
+        help='The maximum size, in MiB, of memory mappings of small files.',
+        type=lambda value: int(value) * 1024 * 1024)
+    parser.add_argument(
+        '--threads',
+        help='The numbers of concurrent threads to test.',
+        type=int,
+        nargs='+',
+        default=[1, 2, 4, 8, 16, 32, 64])
+    parser.add_argument(
+        '--duration',
+        help='The number of seconds to run for every number of threads.',
+        type=float,
+        default=10.0)
+    parser.add_argument(
+        '--reload-interval',
+        help='The number of seconds between forced reloads.',
+        type=float,
+        default=1.0)
+    args = parser.parse_args()
+
+    mountpoint = tempfile.mkdtemp(prefix='photofs-')
+    try:
+        photo_fs = PhotoFS(
+            mountpoint,
+            source=args.source,
+            filters={'Photos': is_photo, 'Videos': is_video},
+            read_workers=args.read_workers,
+            mmap_size=args.mmap_size,
+            database=args.database,
+            load_in_worker=args.load_in_worker)
+        directories, files = snapshot(photo_fs)
+        if not files:
+            raise RuntimeError('No files to read')
+
+        for threads in args.threads:
+            latencies, violations, reloads = run(
+                photo_fs, directories, files, threads, args.duration,
+                args.reload_interval)
+            count = len(latencies)
+
+            def percentile(p):
+                return 1000 * latencies[min(int(count * p), count - 1)] \
+                    if count else 0.0
+
+            sys.stdout.write(
+                '%3d threads %9.0f ops/s  p50 %7.2f ms  p99 %7.2f ms  '
+                'p99.9 %7.2f ms  %3d reloads  %d violations%s\n' % (
+                    threads,
+                    count / args.duration,
+                    percentile(0.5),
+                    percentile(0.99),
+                    percentile(0.999),
+                    reloads,
+                    sum(violations.values()),
+                    ' (%s)' % ', '.join(
+                        '%s %d' % item
+                        for item in sorted(violations.items()))
+                    if violations else ''))
+            sys.stdout.flush()
+
+    finally:
+        shutil.rmtree(mountpoint, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -16,6 +16,9 @@
 # You should have received a copy of the GNU General Public License along with
 # this program. If not, see <http://www.gnu.org/licenses/>.
 
+import collections
+import io
+import json
 import os
 import stat
 import threading
@@ -23,18 +26,108 @@ import time
 
 # For FUSE
 import errno
-import fuse
+try:
+    import fuse
+    _LoggingMixIn, _Operations = fuse.LoggingMixIn, fuse.Operations
+    FuseOSError = fuse.FuseOSError
+except (ImportError, EnvironmentError):
+    # FUSE is not required to export the file system, or when using another
+    # backend
+    fuse = None
 
+    class _LoggingMixIn(object):
+        pass
+
+    class _Operations(object):
+        pass
+
+    class FuseOSError(OSError):
+        def __init__(self, errno):
+            super(FuseOSError, self).__init__(errno, os.strerror(errno))
+
+from xdg.BaseDirectory import save_cache_path
+
+from ._blockcache import BlockCache, CachedFile
+from ._control import (
+    CONTROL_DIRECTORY, CommandHandle, ControlFile, VirtualFile)
+from ._http import Server
 from ._image import Image, FileBasedImage
-from ._source import ImageSource
+from ._mmap import MappedFile, MappingCache
+from ._profile import Profiler
+from ._resize import RenderCache, ResizedImage
+from ._scheduler import ReadScheduler
+from ._search import SEARCH_DIRECTORY, SearchIndex
+from ._source import ImageSource, CompositeImageSource
 from ._tag import Tag
+from ._util import NegativeCache, hash_inode
 
 
 # Import the actual image sources
 from .sources import *
 
 
-class PhotoFS(fuse.LoggingMixIn, fuse.Operations):
+def create_image_source(
+        source='shotwell', sources=None, merge_sources=False, **kwargs):
+    """Creates an image source.
+
+    :param str source: The name of the image source to create if ``sources``
+        is not specified.
+
+    :param sources: A list of image sources to present. Every item is the tuple
+        ``(name, source, database)``, where ``name`` is the name of the top
+        level directory for the source, ``source`` is the name of the image
+        source and ``database`` is an override for its database file. If more
+        than one source is specified, a composite image source is created.
+    :type sources: [(str, str, str or None)] or None
+
+    :param bool merge_sources: Whether to merge the tags of all ``sources``
+        instead of presenting them as separate directories.
+
+    :param kwargs: Arguments passed to the image sources. If several sources
+        are specified, every source is passed only the arguments it declares
+        in :meth:`ImageSource.add_arguments`.
+
+    :return: an image source
+    :rtype: ImageSource
+
+    :raises ValueError: if the names in ``sources`` are not unique
+    """
+    if sources and len(sources) > 1:
+        if len(set(name for name, _, _ in sources)) != len(sources):
+            raise ValueError('Image source names must be unique')
+
+        # Every source is passed only the arguments it declares; arguments
+        # declared by no source are passed to all, so that they are reported
+        classes = {
+            name: ImageSource.get(source)
+            for name, source, _ in sources}
+        declared = set.union(*(
+            cls.argument_names() for cls in classes.values()))
+
+        def arguments(cls, database):
+            names = cls.argument_names()
+            result = {
+                key: value
+                for key, value in kwargs.items()
+                if key in names or key not in declared}
+            if database:
+                result['database'] = database
+            return result
+
+        return CompositeImageSource(
+            {
+                name: classes[name](**arguments(classes[name], database))
+                for name, _, database in sources},
+            merge=merge_sources)
+    else:
+        if sources:
+            _, source, database = sources[0]
+            if database:
+                kwargs['database'] = database
+        return ImageSource.get(source)(**kwargs)
+
+
+class PhotoFS(_LoggingMixIn, _Operations):
     """An implementation of a *FUSE* file system.
 
     It presents the tagged image libraries from image sources as a tag tree in
@@ -42,6 +135,20 @@ class PhotoFS(fuse.LoggingMixIn, fuse.Operations):
 
     :param ImageSource source: The image source.
 
+    :param sources: A list of image sources to present. Every item is the tuple
+        ``(name, source, database)``, where ``name`` is the name of the top
+        level directory for the source, ``source`` is the name of the image
+        source and ``database`` is an override for its database file. If more
+        than one source is specified, ``source`` and ``database`` are ignored.
+    :type sources: [(str, str, str or None)] or None
+
+    :param bool merge_sources: Whether to merge the tags of all ``sources``
+        instead of presenting them as separate directories.
+
+    :param ImageSource image_source: An image source to present. If this is
+        specified, ``source``, ``sources`` and ``database`` are ignored, and
+        the image source may be shared with other file systems.
+
     :param database: An override for the default database file for the
         selected image source.
     :type database: str or None
@@ -52,10 +159,54 @@ class PhotoFS(fuse.LoggingMixIn, fuse.Operations):
         function. If this is falsy, no filters are used, and root tags are used
         to populate the root directory.
 
+    :param bool root_tags: Whether to present the root tags of the image source
+        in the root directory also when filters are used. The filtered
+        directories take precedence over root tags with the same name.
+
     :param str video_path: The directory in the mounted root to contain videos.
 
     :param str date_format: The date format string used to construct file names
-        from time stamps.
+        from time stamps. This is not used if ``image_source`` is specified.
+
+    :param [int] resize: Sizes for which to present downscaled views of the
+        filtered directories. A directory ``'<name>@<size>'`` is added for
+        every filter and size. This requires filters.
+
+    :param str render_cache: The directory in which to store downscaled images.
+        If this is not specified, a directory in the *XDG* cache directory is
+        used.
+
+    :param int render_cache_size: The maximum total size, in bytes, of the
+        downscaled images stored in ``render_cache``.
+
+    :param int render_workers: The number of processes used to render
+        downscaled images. If this is not specified, the number of CPUs is
+        used.
+
+    :param int block_cache_size: The maximum total size, in bytes, of the
+        local cache of file based images. If this is not specified, files are
+        always read from their original location.
+
+    :param str block_cache: The directory in which to store the local cache of
+        file based images. If this is not specified, a directory in the *XDG*
+        cache directory is used.
+
+    :param int mmap_size: The maximum total size, in bytes, of memory mappings
+        of small files kept when not in use. If this is specified, file based
+        images no larger than ``mmap_threshold`` are memory mapped when opened,
+        and reads return views of the mappings. This is not used for files
+        read through the block cache.
+
+    :param int mmap_threshold: The maximum size, in bytes, of files to map.
+
+    :param tuple http: The address on which to serve the file system over
+        *HTTP*, as the tuple ``(host, port)``. The server is started by
+        :meth:`init`.
+
+    :param int read_workers: The number of threads used to read files. If this
+        is specified, reads are queued and scheduled so that small and header
+        reads are not delayed by streaming of large files; otherwise reads are
+        performed directly in the *FUSE* thread.
 
     :raises RuntimeError: if an error occurs
     """
@@ -63,26 +214,88 @@ class PhotoFS(fuse.LoggingMixIn, fuse.Operations):
     def __init__(
             self,
             mountpoint,
-            source=list(ImageSource.SOURCES.keys())[0],
+            source='shotwell',
+            sources=None,
+            merge_sources=False,
+            image_source=None,
             use_links=False,
             filters={},
+            root_tags=False,
             date_format='%Y-%m-%d, %H.%M',
+            resize=(),
+            render_cache=None,
+            render_cache_size=1024 * 1024 * 1024,
+            render_workers=None,
+            read_workers=None,
+            block_cache=None,
+            block_cache_size=None,
+            mmap_size=None,
+            mmap_threshold=16 * 1024 * 1024,
+            http=None,
             **kwargs):
         super(PhotoFS, self).__init__()
 
         self.source = source
         self.use_links = use_links
-        self.filters = filters
-        Image.DATE_FORMAT = date_format
+        self.filters = filters or {}
+        self.root_tags = root_tags
+        if image_source is None:
+            # The date format is global, so a shared image source keeps the
+            # format of its owner
+            Image.DATE_FORMAT = date_format
+
+        self.resize = set(resize)
+        if self.resize and not self.filters:
+            raise RuntimeError('Resized views require filters')
+        self.render_cache = RenderCache(
+            render_cache or os.path.join(
+                save_cache_path('photofs'), 'render'),
+            render_cache_size,
+            render_workers) if self.resize else None
+        self.scheduler = ReadScheduler(read_workers) if read_workers else None
+        self.block_cache = BlockCache(
+            block_cache or os.path.join(
+                save_cache_path('photofs'), 'blocks'),
+            block_cache_size) if block_cache_size else None
+        self.mappings = MappingCache(
+            mmap_size, mmap_threshold) if mmap_size else None
 
         self.creation = None
         self.dirstat = None
         self.image_source = None
+        self.control = None
+        self.searches = None
 
         self.handles = {}
+        self.negative = NegativeCache()
+        self.profiler = Profiler()
+        self.http = http
+        self.server = None
+
+        self._manifest = None
+        self._manifest_lock = threading.Lock()
+        self._links = None
+        self._links_lock = threading.Lock()
+        self._membership = None
+        self._membership_lock = threading.Lock()
+        self._search_index = SearchIndex()
+        self._search_generation = None
+        self._search_results = collections.OrderedDict()
+        self._search_lock = threading.Lock()
+
+        # Every filter is assigned a bit in the membership masks
+        self._filter_bits = {
+            include: 1 << i
+            for i, include in enumerate((filters or {}).values())}
 
         # Create the image source
-        self.image_source = ImageSource.get(self.source)(**kwargs)
+        if image_source is not None:
+            self.image_source = image_source
+        else:
+            if sources and len(sources) == 1:
+                self.source = sources[0][1]
+            self.image_source = create_image_source(
+                self.source, sources, merge_sources, **kwargs)
 
         try:
             # Store the current time as timestamp for directories
@@ -91,6 +304,19 @@ class PhotoFS(fuse.LoggingMixIn, fuse.Operations):
             # Use the lstat result of the mount point for all directories
             self.dirstat = os.lstat(mountpoint)
 
+            # Create the directory of control files
+            self.control = Tag(CONTROL_DIRECTORY)
+            self.control['manifest.jsonl'] = VirtualFile(
+                'manifest.jsonl', self.dirstat, self.manifest)
+            self.control['stats.json'] = VirtualFile(
+                'stats.json', self.dirstat, self.stats)
+            self.control['profile'] = ControlFile(
+                'profile', self.dirstat, self.profile, self.profile_command)
+
+            # Create the directory of search results; this is always empty
+            # when listed
+            self.searches = Tag(SEARCH_DIRECTORY)
+
         except Exception as e:
             try:
                 raise RuntimeError(
@@ -101,23 +327,51 @@ class PhotoFS(fuse.LoggingMixIn, fuse.Operations):
                     'Failed to initialise file system: %s',
                     str(e))
 
+    def init(self, path):
+        """Starts the background services of the file system.
+
+        This is called by *FUSE* once the file system has been mounted and the
+        process has been daemonised, and must be called explicitly when the
+        file system is not mounted.
+
+        :param str path: The root path.
+        """
+        if self.http and self.server is None:
+            self.server = Server(self, self.http)
+            self.server.start()
+
     def destroy(self, path):
-        pass
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
 
     def recursive_filter(self, item, include):
         """The recursive filter used to actually filter the image source.
 
-        This function will simply call include_filter in the outer scope if
-        item is an instance of :class:`Image`, otherwise it will recursively
-        call itself on all items in the tag, and return whether the filtered
-        tag contains any subitems.
+        If ``include`` is one of the registered filters, the precomputed
+        membership returned by :meth:`membership` is used. Otherwise this
+        function will simply call ``include`` if item is an instance of
+        :class:`Image`, or recursively call itself on all items in the tag, and
+        return whether the filtered tag contains any subitems.
 
         :param item: The item to filter.
         :type item: Image or Tag
 
+        :param include: The filter function, or ``None`` to keep all items.
+
         :return: ``True`` if the item should be kept and ``False``
             otherwise
         """
+        if include is None:
+            return True
+
+        bit = self._filter_bits.get(include)
+        if bit is not None:
+            mask = self.membership().get(id(item))
+            if mask is not None:
+                return bool(mask & bit)
+
         if isinstance(item, Image):
             return include(item)
         elif isinstance(item, Tag):
@@ -127,6 +381,58 @@ class PhotoFS(fuse.LoggingMixIn, fuse.Operations):
         else:
             return False
 
+    def membership(self):
+        """Returns the filter membership of all images and tags.
+
+        The membership is calculated once when the image source has been
+        reloaded, so that filtering a directory listing costs no more than
+        listing it.
+
+        :return: a mapping from ``id(item)`` to a bit mask of the filters that
+            include the item, or any item beneath it
+        :rtype: dict
+        """
+        with self._membership_lock:
+            generation = self.image_source.generation
+            if self._membership is None or self._membership[0] != generation:
+                self._membership = (generation, self._calculate_membership())
+            return self._membership[1]
+
+    def _calculate_membership(self):
+        """Calculates the filter membership of all images and tags.
+
+        See :meth:`membership` for a description of the format.
+
+        :return: the membership
+        :rtype: dict
+        """
+        masks = {}
+        stack = [(self.image_source, None)]
+        while stack:
+            tag, items = stack.pop()
+            if items is not None:
+                # All items beneath the tag have been visited
+                mask = 0
+                for item in items:
+                    mask |= masks.get(id(item), 0)
+                masks[id(tag)] = mask
+                continue
+
+            items = list(tag.values())
+            stack.append((tag, items))
+            for item in items:
+                if id(item) in masks:
+                    continue
+                elif isinstance(item, Image):
+                    masks[id(item)] = sum(
+                        bit
+                        for include, bit in self._filter_bits.items()
+                        if include(item))
+                else:
+                    stack.append((item, None))
+
+        return masks
+
     def locate(self, path):
         """Locates a filter function and an image or tag resource.
 
@@ -145,22 +451,327 @@ class PhotoFS(fuse.LoggingMixIn, fuse.Operations):
         if path == os.path.sep:
             return (None, self.filters or self.image_source)
 
+        # The control directory is not affected by filters
+        root, rest = self.split_path(path)
+        if root == CONTROL_DIRECTORY:
+            return (None, self.control[rest] if rest else self.control)
+
+        # Neither are search results
+        if root == SEARCH_DIRECTORY:
+            if not rest:
+                return (None, self.searches)
+            term, _, name = rest.partition(os.path.sep)
+            results = self.search(term)
+            return (None, results[name] if name else results)
+
+        # Neither are the views of the image source, which take precedence
+        # over filters and root tags with the same name
+        views = self.image_source.views
+        if root in views:
+            item = views[root]
+            for segment in rest.split(os.path.sep) if rest else []:
+                item = item[segment]
+            return (None, item)
+
         # If any filters are registered, the first part of the path is the
-        # filter name; the filter must allow the item
-        if self.filters:
-            root, rest = self.split_path(path)
-            include = self.filters[root]
+        # filter name, optionally with a size for resized views; the filter
+        # must allow the item
+        name, size = self.split_view(root) if self.filters else (None, None)
+        if name in self.filters:
+            include = self.filters[name]
             if rest:
                 item = self.image_source.locate(os.path.sep + rest)
                 if not self.recursive_filter(item, include):
                     raise KeyError(path)
             path = os.path.sep + rest
+        elif self.filters and not self.root_tags:
+            raise KeyError(path)
         else:
             include = None
 
-        return (
-            include,
-            self.image_source.locate(path) if path else self.image_source)
+        item = self.image_source.locate(path) if path else self.image_source
+        if size and isinstance(item, Image) and not item.is_video:
+            item = ResizedImage(item, size, self.render_cache)
+
+        return (include, item)
+
+    #: The number of search results kept in memory
+    SEARCH_RESULTS = 64
+
+    def search(self, term):
+        """Finds all images whose title or file name contains a string.
+
+        The search index is updated incrementally when the image source has
+        been reloaded.
+
+        :param str term: The string to find. The search is case insensitive.
+
+        :return: a tag containing all matching images
+        :rtype: Tag
+        """
+        self.image_source.refresh()
+        with self._search_lock:
+            generation = self.image_source.generation
+            if self._search_generation != generation:
+                self._search_index.update(
+                    (os.path.basename(path), image)
+                    for path, image in self.image_source.images())
+                self._search_generation = generation
+                self._search_results.clear()
+
+            try:
+                results = self._search_results.pop(term)
+            except KeyError:
+                results = Tag(term)
+                for image in sorted(
+                        self._search_index.search(term),
+                        key=lambda image: image.timestamp):
+                    results.add(image)
+            self._search_results[term] = results
+            while len(self._search_results) > self.SEARCH_RESULTS:
+                self._search_results.popitem(last=False)
+
+            return results
+
+    def walk(self):
+        """Iterates over all images presented in the filtered directories,
+        or in the root directory if no filters are used or root tags are
+        presented next to them.
+
+        The image source is traversed once. Resized views are not included.
+
+        :return: an iterator of ``(view, path, image)``, where ``view`` is the
+            name of the filter, or ``None`` for images in root tags, and
+            ``path`` is the absolute path of the image in the image source
+        """
+        shadowed = set(self.views()) if self.filters else set()
+        for path, image in self.image_source.images():
+            for name, include in self.filters.items():
+                if self.recursive_filter(image, include):
+                    yield (name, path, image)
+            if not self.filters or (
+                    self.root_tags
+                    and self.split_path(path)[0] not in shadowed):
+                yield (None, path, image)
+
+    def files(self):
+        """Iterates over all files presented in the filtered directories and
+        their resized views, or in the root directory if no filters are used.
+
+        Control files and search results are not included.
+
+        :return: an iterator of ``(path, image)``, where ``path`` is the
+            absolute path of the image in this file system
+        """
+        self.image_source.refresh()
+        for view, path, image in self.walk():
+            if view is None:
+                yield (path, image)
+                continue
+
+            yield (os.path.sep + view + path, image)
+            for size in sorted(self.resize):
+                yield (
+                    os.path.sep + '%s@%d' % (view, size) + path,
+                    image if image.is_video
+                    else ResizedImage(image, size, self.render_cache))
+
+    def manifest(self):
+        """Returns the manifest of all presented images.
+
+        The manifest contains one *JSON* object per line for every image path,
+        with the keys ``path``, ``size``, ``mtime``, ``timestamp``,
+        ``video``, ``location`` and ``tags``, where ``tags`` lists all tags of
+        the image. It is regenerated only when the image source has been
+        reloaded.
+
+        :return: the manifest
+        :rtype: bytes
+        """
+        self.image_source.refresh()
+        with self._manifest_lock:
+            generation = self.image_source.generation
+            if self._manifest is None or self._manifest[0] != generation:
+                self._manifest = (generation, self._generate_manifest())
+            return self._manifest[1]
+
+    def _generate_manifest(self):
+        """Generates the manifest of all presented images.
+
+        See :meth:`manifest` for a description of the format.
+
+        :return: the manifest
+        :rtype: bytes
+        """
+        entries = []
+        tags = {}
+        stats = {}
+        for view, path, image in self.walk():
+            entries.append((view, path, image))
+            key = id(image)
+            tags.setdefault(key, set()).add(
+                os.path.dirname(path)[len(os.path.sep):])
+            if key not in stats:
+                try:
+                    stats[key] = image.stat
+                except OSError:
+                    stats[key] = None
+
+        lines = []
+        for view, path, image in entries:
+            st = stats[id(image)]
+            lines.append(json.dumps(
+                {
+                    'path': os.path.sep + view + path if view else path,
+                    'size': st.st_size if st else None,
+                    'mtime': st.st_mtime if st else None,
+                    'timestamp': image.timestamp.isoformat(),
+                    'video': bool(image.is_video),
+                    'location': getattr(image, 'location', None),
+                    'tags': sorted(tags[id(image)])},
+                sort_keys=True))
+
+        return ''.join(line + '\n' for line in lines).encode('utf-8')
+
+    def stats(self):
+        """Returns statistics about the file system.
+
+        The statistics are a *JSON* object with the reload statistics of the
+        image ``source``, the queueing statistics of the ``reads`` if a read
+        scheduler is used, the statistics of the ``blocks`` cache if used, and
+        the statistics of the cache of ``negative`` lookups and of the memory
+        ``mappings`` if used.
+
+        :return: the statistics
+        :rtype: bytes
+        """
+        return (json.dumps(
+            {
+                'source': getattr(self.image_source, 'stats', None),
+                'reads': self.scheduler.stats if self.scheduler else None,
+                'blocks':
+                self.block_cache.stats if self.block_cache else None,
+                'negative': self.negative.stats,
+                'mappings':
+                self.mappings.stats if self.mappings else None},
+            indent=4,
+            sort_keys=True) + '\n').encode('utf-8')
+
+    def profile(self):
+        """Returns the report of the sampling profiler.
+
+        The report contains the collapsed stacks sampled since the profiler
+        was last started, preceded by comment lines with the time spent in the
+        phases of the last reload of every image source.
+
+        :return: the report
+        :rtype: bytes
+        """
+        source_stats = getattr(self.image_source, 'stats', None) or {}
+        if 'phases' in source_stats:
+            phases = {'load_tags': source_stats['phases']}
+        else:
+            # A composite image source reports statistics per source
+            phases = {
+                'load_tags[%s]' % name: stats['phases']
+                for name, stats in source_stats.items()
+                if isinstance(stats, dict) and 'phases' in stats}
+
+        return self.profiler.report(phases).encode('utf-8')
+
+    def profile_command(self, command):
+        """Starts or stops the sampling profiler.
+
+        :param str command: The command; either ``'start'`` or ``'stop'``.
+
+        :raises ValueError: if the command is unknown
+        """
+        if command == 'start':
+            self.profiler.start()
+        elif command == 'stop':
+            self.profiler.stop()
+        else:
+            raise ValueError(
+                'Unknown profiler command: %s',
+                command)
+
+    def links(self, image):
+        """Returns the number of paths under which an image is presented.
+
+        Only the filtered directories, or the root directory if no filters are
+        used, are considered; the number is the same for resized views. The
+        counts for all images are calculated when the image source has been
+        reloaded.
+
+        :param Image image: The image.
+
+        :return: the number of links
+        :rtype: int
+        """
+        if isinstance(image, ResizedImage):
+            image = image.image
+
+        with self._links_lock:
+            generation = self.image_source.generation
+            if self._links is None or self._links[0] != generation:
+                links = {}
+                for view, path, item in self.walk():
+                    links[id(item)] = links.get(id(item), 0) + 1
+                self._links = (generation, links)
+
+            return self._links[1].get(id(image), 1)
+
+    def inode(self, path, item):
+        """Returns the inode number of an item.
+
+        Images with a stable inode number retain it wherever they are
+        presented; for other items, the inode number is derived from the path.
+
+        :param str path: The absolute path of the item.
+
+        :param item: The item.
+
+        :return: an inode number
+        :rtype: int
+        """
+        inode = getattr(item, 'inode', None)
+        if inode is not None:
+            return inode
+        elif path == os.path.sep:
+            return 1
+        else:
+            return hash_inode(path)
+
+    def split_view(self, root):
+        """Returns the tuple ``(name, size)`` for a top level directory name,
+        where ``name`` is the name of the filter and ``size`` is the size of
+        the resized view, or ``None`` if ``root`` is not a resized view.
+
+        :param str root: The name of the top level directory.
+
+        :return: a tuple containing the filter name and view size
+
+        :raises KeyError: if ``root`` specifies an unknown size
+        """
+        name, sep, size = root.rpartition('@')
+        if not sep or name not in self.filters or not size.isdigit():
+            return (root, None)
+        elif int(size) not in self.resize:
+            raise KeyError(root)
+        else:
+            return (name, int(size))
+
+    def views(self):
+        """Lists the names of all top level directories when filters are
+        used.
+
+        :return: the filter names, followed by the names of all resized views
+        :rtype: [str]
+        """
+        return list(self.filters) + [
+            '%s@%d' % (name, size)
+            for name in self.filters
+            for size in sorted(self.resize)]
 
     def split_path(self, path):
         """Returns the tuple ``(root, rest)`` for a path, where ``root`` is the
@@ -186,38 +797,67 @@ class PhotoFS(fuse.LoggingMixIn, fuse.Operations):
             return (path, '')
 
     def getattr(self, path, fh=None):
+        # Paths probed by file managers are looked up repeatedly, so remember
+        # missing paths until the image source has been reloaded; the source
+        # is refreshed first, since only locate would otherwise do so
+        self.image_source.refresh()
+        if self.negative.contains(path, self.image_source.generation):
+            raise FuseOSError(errno.ENOENT)
+
         try:
             include, item = self.locate(path)
 
         except KeyError:
-            raise fuse.FuseOSError(errno.ENOENT)
+            self.negative.add(path, self.image_source.generation)
+            raise FuseOSError(errno.ENOENT)
 
         if self.use_links and isinstance(item, FileBasedImage):
             # This is a link
             st = os.stat_result((item.stat[0] | stat.S_IFLNK,) + item.stat[1:])
+            nlink = self.links(item)
+
+        elif isinstance(item, VirtualFile):
+            # This is a control file; an open file contains the content
+            # generated when it was opened, so its size is read from the handle
+            st = item.stat
+            size = self.handle_size(fh) if fh in self.handles else None
+            if size is not None:
+                st = os.stat_result(st[:6] + (size,) + st[7:])
+            nlink = st.st_nlink
 
         elif isinstance(item, Image):
-            # This is a file
+            # This is a file; the size of an open file is read from the handle,
+            # since resized images have their final size only once rendered
             st = item.stat
+            size = self.handle_size(fh) if fh in self.handles else None
+            if size is not None:
+                st = os.stat_result(st[:6] + (size,) + st[7:])
+            nlink = self.links(item)
 
         elif isinstance(item, dict):
             # This is a directory; this matches both Tag and ImageSource
             st = self.dirstat
+            nlink = st.st_nlink
 
         else:
             raise RuntimeError(
                 'Unknown object: %s',
                 path)
 
+        # Remove write permission bits, except for control files accepting
+        # commands
+        mode = st.st_mode
+        if not isinstance(item, ControlFile):
+            mode &= ~(stat.S_IWGRP | stat.S_IWUSR | stat.S_IWOTH)
+
         return dict(
-            # Remove write permission bits
-            st_mode=st.st_mode & ~(
-                stat.S_IWGRP | stat.S_IWUSR | stat.S_IWOTH),
+            st_mode=mode,
 
             st_gid=st.st_gid,
             st_uid=st.st_uid,
 
-            st_nlink=st.st_nlink,
+            st_ino=self.inode(path, item),
+            st_nlink=nlink,
 
             st_atime=st.st_atime,
             st_ctime=st.st_ctime,
@@ -225,17 +865,45 @@ class PhotoFS(fuse.LoggingMixIn, fuse.Operations):
 
             st_size=st.st_size)
 
+    def handle_size(self, fh):
+        """Returns the size of an open file.
+
+        :param int fh: The file handle.
+
+        :return: the size of the file, or ``None`` if the handle does not
+            reference a file
+        :rtype: int or None
+        """
+        handle, lock = self.handles[fh]
+        if isinstance(handle, MappedFile):
+            return handle.size
+        elif isinstance(handle, io.BytesIO):
+            return len(handle.getbuffer())
+        try:
+            return os.fstat(handle.fileno()).st_size
+        except (AttributeError, OSError, ValueError):
+            return None
+
     def readdir(self, path, offset):
         if path == os.path.sep:
-            return [
-                k
-                for k in (self.filters or self.image_source)]
+            self.image_source.refresh()
+            views = self.image_source.views
+            names = self.views() if self.filters else []
+            if not self.filters or self.root_tags:
+                names += [
+                    name
+                    for name in self.image_source
+                    if name not in names]
+            return [CONTROL_DIRECTORY, SEARCH_DIRECTORY] + sorted(views) + [
+                name
+                for name in names
+                if name not in views]
 
         try:
             include, item = self.locate(path)
 
         except KeyError:
-            raise fuse.FuseOSError(errno.ENOENT)
+            raise FuseOSError(errno.ENOENT)
 
         if isinstance(item, dict):
             # This is a directory; this matches both Tag and
@@ -255,16 +923,70 @@ class PhotoFS(fuse.LoggingMixIn, fuse.Operations):
         try:
             return item.location
         except:
-            raise fuse.FuseOSError(errno.EINVAL)
+            raise FuseOSError(errno.EINVAL)
+
+    #: The extended attribute containing the rating of an image
+    RATING_ATTRIBUTE = 'user.photofs.rating'
+
+    def attributes(self, path):
+        """Returns the extended attributes of an item.
+
+        Images have the attributes provided by the image source, such as
+        stored content hashes, and :attr:`RATING_ATTRIBUTE` if the image source
+        supports ratings. Scaled down images and directories have no
+        attributes.
+
+        :param str path: The absolute path of the item.
+
+        :return: a mapping from attribute name to value
+        :rtype: dict
+
+        :raises fuse.FuseOSError: if the item does not exist
+        """
+        try:
+            include, item = self.locate(path)
+        except KeyError:
+            raise FuseOSError(errno.ENOENT)
+
+        if not isinstance(item, Image):
+            return {}
+
+        result = dict(item.attributes)
+        if item.rating is not None:
+            result[self.RATING_ATTRIBUTE] = str(item.rating)
+        return result
+
+    def getxattr(self, path, name, position=0):
+        try:
+            return self.attributes(path)[name].encode('utf-8')
+        except KeyError:
+            raise FuseOSError(errno.ENODATA)
+
+    def listxattr(self, path):
+        return sorted(self.attributes(path))
 
     def open(self, path, flags):
         include, item = self.locate(path)
-        if isinstance(item, Image):
+        if flags & (os.O_WRONLY | os.O_RDWR) \
+                and not isinstance(item, ControlFile):
+            raise FuseOSError(errno.EACCES)
+        elif self.block_cache and isinstance(item, FileBasedImage):
+            handle = CachedFile(
+                self.block_cache, item.location, os.stat(item.location))
+            self.handles[id(handle)] = (handle, threading.Lock())
+            return id(handle)
+        elif self.mappings and isinstance(item, FileBasedImage) \
+                and self.mappings.accepts(os.stat(item.location)):
+            handle = MappedFile(
+                self.mappings, item.location, os.stat(item.location))
+            self.handles[id(handle)] = (handle, threading.Lock())
+            return id(handle)
+        elif isinstance(item, Image):
             handle = item.open(flags)
             self.handles[id(handle)] = (handle, threading.Lock())
             return id(handle)
         else:
-            raise fuse.FuseOSError(errno.EINVAL)
+            raise FuseOSError(errno.EINVAL)
 
     def release(self, path, fh):
         try:
@@ -272,11 +994,98 @@ class PhotoFS(fuse.LoggingMixIn, fuse.Operations):
             with lock:
                 handle.close()
             del self.handles[fh]
+            if self.scheduler:
+                self.scheduler.forget(fh)
         except:
-            raise fuse.FuseOSError(errno.EINVAL)
+            raise FuseOSError(errno.EINVAL)
+
+    def truncate(self, path, length, fh=None):
+        # Control files are truncated when commands are written by a shell
+        try:
+            include, item = self.locate(path)
+        except KeyError:
+            raise FuseOSError(errno.ENOENT)
+        if not isinstance(item, ControlFile):
+            raise FuseOSError(errno.EACCES)
+
+    def write(self, path, data, offset, fh):
+        try:
+            handle, lock = self.handles[fh]
+        except KeyError:
+            raise FuseOSError(errno.EBADF)
+        if not isinstance(handle, CommandHandle):
+            raise FuseOSError(errno.EBADF)
+
+        try:
+            with lock:
+                handle.execute(data)
+        except ValueError:
+            raise FuseOSError(errno.EINVAL)
+        return len(data)
 
     def read(self, path, size, offset, fh):
         handle, lock = self.handles[fh]
+        if isinstance(handle, MappedFile):
+            # fusepy copies the data read with ctypes.memmove, which does not
+            # accept memoryview instances
+            return handle.read_buffer(size, offset)
+        else:
+            return self.read_buffer(path, size, offset, fh)
+
+    def read_buffer(self, path, size, offset, fh):
+        """Reads from an open file, without copying the data if possible.
+
+        Reads from memory mapped files return views of the mapping; they do
+        not perform any I/O until the data is accessed, so they are not
+        scheduled.
+
+        :param str path: The path of the file. This is not used.
+
+        :param int size: The number of bytes to read.
+
+        :param int offset: The offset of the first byte to read.
+
+        :param int fh: The file handle.
+
+        :return: the data read
+        :rtype: bytes or memoryview
+        """
+        handle, lock = self.handles[fh]
+        if isinstance(handle, MappedFile):
+            return handle.pread(size, offset)
+        elif self.scheduler:
+            return self.scheduler.read(
+                fh, offset, size, lambda: self._read(size, offset, fh))
+        else:
+            return self._read(size, offset, fh)
+
+    def _read(self, size, offset, fh):
+        """Reads from an open file.
+
+        Files in the file system and files read through the block cache are
+        read with ``pread``, which does not require locking the handle; other
+        files are read after seeking.
+
+        :param int size: The number of bytes to read.
+
+        :param int offset: The offset of the first byte to read.
+
+        :param int fh: The file handle.
+
+        :return: the data read
+        :rtype: bytes
+        """
+        handle, lock = self.handles[fh]
+        if isinstance(handle, CachedFile):
+            return handle.pread(size, offset)
+
+        try:
+            fileno = handle.fileno() if hasattr(os, 'pread') else None
+        except (AttributeError, ValueError, OSError):
+            fileno = None
+        if fileno is not None:
+            return os.pread(fileno, size, offset)
+
         with lock:
             if handle.tell() != offset:
                 handle.seek(offset)
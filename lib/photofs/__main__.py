@@ -1,22 +1,272 @@
+import os
 import sys
 
 from photofs import *
+from photofs._daemon import Daemon, default_socket, request
+from photofs._export import METHODS, Exporter
+from photofs._filter import FIELDS, compile_filter, is_photo, is_video
+from photofs._http import Server, parse_address
 
 
-def main():
+def daemon():
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        prog='photofs daemon',
+        add_help=True,
+        conflict_handler='resolve',
+        description='Load tagged images from Shotwell once and serve them on '
+        'several mount points. Use "photofs control" to add and remove mount '
+        'points.')
+
+    parser.add_argument(
+        '--socket',
+        help='The location of the control socket.',
+        default=default_socket())
+
+    parser.add_argument(
+        '--source',
+        help='An image source to present, on the form '
+        '[NAME=]SOURCE[:DATABASE]. See "photofs --help".',
+        dest='sources',
+        metavar='SOURCE',
+        action='append',
+        type=source_type)
+
+    parser.add_argument(
+        '--merge-sources',
+        help='Merge the tags of all image sources instead of presenting them '
+        'as separate directories.',
+        action='store_true')
+
+    parser.add_argument(
+        '--date-format',
+        help='The format to use for timestamps.')
+
+    for source in ImageSource.SOURCES.values():
+        source.add_arguments(parser)
+
+    args = {
+        name: value
+        for name, value in vars(parser.parse_args(sys.argv[2:])).items()
+        if value is not None}
+
+    try:
+        path = args.pop('socket')
+        if 'date_format' in args:
+            Image.DATE_FORMAT = args.pop('date_format')
+        Daemon(create_image_source(**args), path).serve_forever()
+    except Exception as e:
+        try:
+            sys.stderr.write('%s\n' % e.args[0] % e.args[1:])
+        except:
+            sys.stderr.write('%s\n' % str(e))
+        sys.exit(1)
+
+
+def control():
     import argparse
 
     parser = argparse.ArgumentParser(
-        prog='photofs',
+        prog='photofs control',
         add_help=True,
-        description='Explore tagged images from Shotwell in the file system.',
-        epilog='In addition to the command line options specified above, this '
-        'program accepts all standard FUSE command line options.')
+        description='Add and remove mount points of a running photofs '
+        'daemon.')
 
     parser.add_argument(
+        '--socket',
+        help='The location of the control socket.',
+        default=default_socket())
+
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    mount = commands.add_parser(
+        'mount',
+        help='Add a mount point.')
+    mount.add_argument(
+        'mountpoint',
+        help='The file system mount point.')
+    mount.add_argument(
+        '--use-links', '-l',
+        help='Report images as links.',
+        action='store_true')
+    mount.add_argument(
+        '--photo-path',
+        help='The name of the top level directory that contains photos.',
+        default='Photos')
+    mount.add_argument(
+        '--video-path',
+        help='The name of the top level directory that contains videos.',
+        default='Videos')
+    mount.add_argument(
+        '--flat-presentation',
+        help='Do not separate photos and videos.',
+        action='store_true')
+    mount.add_argument(
+        '--view',
+        help='Add a top level directory NAME presenting the images for which '
+        'EXPRESSION is true. See "photofs --help".',
+        dest='views',
+        metavar='NAME=EXPRESSION',
+        action='append',
+        default=[],
+        type=view_expression_type)
+    mount.add_argument(
+        '-o',
+        help='Any FUSE options.',
+        dest='options',
+        action='append',
+        default=[])
+
+    unmount = commands.add_parser(
+        'unmount',
+        help='Remove a mount point.')
+    unmount.add_argument(
         'mountpoint',
         help='The file system mount point.')
 
+    commands.add_parser(
+        'list',
+        help='List all mount points.')
+
+    commands.add_parser(
+        'stop',
+        help='Unmount all mount points and stop the daemon.')
+
+    args = vars(parser.parse_args(sys.argv[2:]))
+    path = args.pop('socket')
+    command = args.pop('command')
+    if command == 'mount':
+        args['mountpoint'] = os.path.abspath(args['mountpoint'])
+        args['views'] = dict(args['views'])
+        args['options'] = dict(
+            option.split('=', 1) if '=' in option else (option, True)
+            for option in args['options'])
+
+    try:
+        response = request(path, command, **args)
+        for mountpoint in response.get('mounts', []):
+            sys.stdout.write('%s\n' % mountpoint)
+    except Exception as e:
+        try:
+            sys.stderr.write('%s\n' % e.args[0] % e.args[1:])
+        except:
+            sys.stderr.write('%s\n' % str(e))
+        sys.exit(1)
+
+
+def view_type(value):
+    import argparse
+
+    name, sep, expression = value.partition('=')
+    if not sep or not name:
+        raise argparse.ArgumentTypeError(
+            'views must be specified as NAME=EXPRESSION')
+    try:
+        return (name, compile_filter(expression))
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(e.args[0] % e.args[1:])
+
+
+def view_expression_type(value):
+    name, include = view_type(value)
+    return (name, value.split('=', 1)[1])
+
+
+def source_type(value):
+    if '=' in value.split(':', 1)[0]:
+        name, value = value.split('=', 1)
+    else:
+        name = None
+    source, _, database = value.partition(':')
+    ImageSource.get(source)
+    return (name or source, source, database or None)
+
+
+def main():
+    import argparse
+
+    # The daemon and control commands serve several mount points from one
+    # process
+    if sys.argv[1:2] == ['daemon']:
+        return daemon()
+    elif sys.argv[1:2] == ['control']:
+        return control()
+
+    # The export command writes the file system to a directory instead of
+    # mounting it
+    export = sys.argv[1:2] == ['export']
+
+    if export:
+        parser = argparse.ArgumentParser(
+            prog='photofs export',
+            add_help=True,
+            conflict_handler='resolve',
+            description='Export tagged images from Shotwell to a directory.')
+
+        parser.add_argument(
+            'target',
+            help='The directory to which to export. When exporting to the '
+            'same directory again, only changed files are updated.')
+
+        parser.add_argument(
+            '--method',
+            help='How to export images. auto tries hardlink, reflink and '
+            'symlink in turn. Scaled down photos are always copied.',
+            choices=METHODS,
+            default='auto')
+
+        parser.add_argument(
+            '--export-workers',
+            help='The number of files to export concurrently.',
+            type=int,
+            default=8)
+
+    else:
+        parser = argparse.ArgumentParser(
+            prog='photofs',
+            add_help=True,
+            conflict_handler='resolve',
+            description='Explore tagged images from Shotwell in the file '
+            'system.',
+            epilog='In addition to the command line options specified above, '
+            'this program accepts all standard FUSE command line options. Run '
+            '"photofs export --help" to see how to export the images to a '
+            'directory instead, and "photofs daemon --help" to see how to '
+            'serve several mount points from one process.')
+
+        parser.add_argument(
+            'mountpoint',
+            help='The file system mount point.',
+            nargs='?')
+
+        parser.add_argument(
+            '--http',
+            help='Serve the file system over HTTP on [HOST:]PORT as well.',
+            metavar='[HOST:]PORT',
+            type=parse_address)
+
+        parser.add_argument(
+            '--no-mount',
+            help='Do not mount the file system; this requires --http.',
+            action='store_true')
+
+        parser.add_argument(
+            '--negative-timeout',
+            help='The number of seconds the kernel may remember that a name '
+            'does not exist. Missing names are always remembered by photofs '
+            'until the images are reloaded.',
+            type=float)
+
+        parser.add_argument(
+            '--backend',
+            help='The FUSE library to use. pyfuse3 serves requests '
+            'asynchronously, but requires pyfuse3 and trio, and does not run '
+            'the daemon in the background.',
+            choices=('fusepy', 'pyfuse3'),
+            default='fusepy')
+
     parser.add_argument(
         '--debug', '-d',
         help='Enable debug logging.',
@@ -47,23 +297,13 @@ def main():
         '--photo-path',
         help='The name of the top level directory that contains photos.',
         default='Photos',
-        type=filter_type(
-            '--photo-path',
-            lambda i:
-            not i.is_video
-            if isinstance(i, Image)
-            else not i.has_video))
+        type=filter_type('--photo-path', is_photo))
 
     parser.add_argument(
         '--video-path',
         help='The name of the top level directory that contains videos.',
         default='Videos',
-        type=filter_type(
-            '--video-path',
-            lambda i:
-            i.is_video
-            if isinstance(i, Image)
-            else i.has_video))
+        type=filter_type('--video-path', is_video))
 
     class FlatPresentationAction(argparse.Action):
         def __call__(self, parser, namespace, values, option_string):
@@ -75,6 +315,86 @@ def main():
         help='Do not separate photos and videos.',
         action=FlatPresentationAction)
 
+    parser.add_argument(
+        '--view',
+        help='Add a top level directory NAME presenting the images for which '
+        'EXPRESSION is true. The expression may use comparisons, and, or, '
+        'not, the function date(year, month, day) and the fields %s. This may '
+        'be specified more than once.' % ', '.join(sorted(FIELDS)),
+        dest='views',
+        metavar='NAME=EXPRESSION',
+        action='append',
+        type=view_type)
+
+    parser.add_argument(
+        '--source',
+        help='An image source to present, on the form '
+        '[NAME=]SOURCE[:DATABASE]. If specified more than once, every source '
+        'is presented as a top level directory NAME. Valid sources are %s.' % (
+            ', '.join(sorted(ImageSource.SOURCES))),
+        dest='sources',
+        metavar='SOURCE',
+        action='append',
+        type=source_type)
+
+    parser.add_argument(
+        '--merge-sources',
+        help='Merge the tags of all image sources instead of presenting them '
+        'as separate directories.',
+        action='store_true')
+
+    parser.add_argument(
+        '--resize',
+        help='Add top level directories NAME@SIZE presenting photos scaled '
+        'down to fit SIZE x SIZE pixels for every top level directory NAME. '
+        'This may be specified more than once. This requires Pillow.',
+        action='append',
+        type=int)
+
+    parser.add_argument(
+        '--render-cache',
+        help='The directory in which to store scaled down photos.')
+
+    parser.add_argument(
+        '--render-cache-size',
+        help='The maximum size, in MiB, of the scaled down photos to store.',
+        type=lambda value: int(value) * 1024 * 1024)
+
+    parser.add_argument(
+        '--render-workers',
+        help='The number of processes used to scale down photos.',
+        type=int)
+
+    parser.add_argument(
+        '--block-cache',
+        help='The directory in which to cache parts of original files.')
+
+    parser.add_argument(
+        '--block-cache-size',
+        help='The maximum size, in MiB, of the cached parts of original '
+        'files. If specified, files are cached locally when read, which is '
+        'useful when the originals are on network or removable storage.',
+        type=lambda value: int(value) * 1024 * 1024)
+
+    parser.add_argument(
+        '--mmap-size',
+        help='The maximum size, in MiB, of memory mappings of small files '
+        'kept when not in use. If specified, small files are memory mapped '
+        'when opened, and the mappings are shared by all readers. Do not use '
+        'this if the originals are modified in place while mounted.',
+        type=lambda value: int(value) * 1024 * 1024)
+
+    parser.add_argument(
+        '--mmap-threshold',
+        help='The maximum size, in MiB, of files to memory map.',
+        type=lambda value: int(value) * 1024 * 1024)
+
+    parser.add_argument(
+        '--read-workers',
+        help='The number of threads used to read files. If specified, small '
+        'reads are prioritised over streaming of large files.',
+        type=int)
+
     parser.add_argument(
         '--date-format',
         help='The format to use for timestamps.')
@@ -94,14 +414,17 @@ def main():
         nargs=1,
         action=OAction)
 
-    # Add image source specific command line arguments
+    # Add image source specific command line arguments; arguments shared by
+    # several sources are added more than once, which the conflict handler of
+    # the parser resolves
     for source in ImageSource.SOURCES.values():
         source.add_arguments(parser)
 
     # First, let args be the argument dict, but remove undefined values
     args = {
         name: value
-        for name, value in vars(parser.parse_args()).items()
+        for name, value in vars(parser.parse_args(
+            sys.argv[2:] if export else sys.argv[1:])).items()
         if value is not None}
 
     # Then pop these known items and pass them on to the FUSE constructor
@@ -109,12 +432,59 @@ def main():
         name: args.pop(name)
         for name in (
             'foreground',
-            'debug')
+            'debug',
+            'negative_timeout')
         if name in args})
 
+    # Add the user defined views to the filters; with flat presentation, these
+    # are presented next to the root tags
+    filters = dict(filter_type.filters or {})
+    filters.update(args.pop('views', []))
+    args['root_tags'] = filter_type.filters is None
+
     try:
-        photo_fs = PhotoFS(filters=filter_type.filters, **args)
-        fuse.FUSE(photo_fs, args['mountpoint'], fsname='photofs', **fuse_args)
+        if export:
+            target = args.pop('target')
+            exporter_args = (args.pop('method'), args.pop('export_workers'))
+            if not os.path.isdir(target):
+                os.makedirs(target)
+            photo_fs = PhotoFS(target, filters=filters, **args)
+            sys.stdout.write(
+                'Exported %(exported)d files; %(unchanged)d unchanged, '
+                '%(removed)d removed and %(failed)d failed\n' % Exporter(
+                    photo_fs, target, *exporter_args).export())
+            return
+
+        backend = args.pop('backend')
+        if args.pop('no_mount'):
+            # Serve the file system in the foreground; the mount point, if
+            # specified, is only used for the directory attributes
+            address = args.pop('http', None)
+            if not address:
+                parser.error('--no-mount requires --http')
+            photo_fs = PhotoFS(
+                args.pop('mountpoint', os.curdir), filters=filters, **args)
+            Server(photo_fs, address).serve_forever()
+            return
+        elif not args.get('mountpoint'):
+            parser.error('the mount point is required')
+
+        if backend == 'pyfuse3':
+            from photofs._pyfuse3 import mount
+            photo_fs = PhotoFS(filters=filters, **args)
+            fuse_args.pop('foreground', None)
+            mount(photo_fs, args['mountpoint'], fuse_args)
+            return
+
+        if fuse is None:
+            raise RuntimeError('FUSE is not available')
+        photo_fs = PhotoFS(filters=filters, **args)
+        fuse.FUSE(
+            photo_fs,
+            args['mountpoint'],
+            fsname='photofs',
+            use_ino=True,
+            **fuse_args)
     except Exception as e:
         import traceback
         traceback.print_exc()
@@ -124,4 +494,5 @@ def main():
             sys.stderr.write('%s\n' % str(e))
 
 
-main()
+if __name__ == '__main__':
+    main()
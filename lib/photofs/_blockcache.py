@@ -0,0 +1,325 @@
+# coding: utf-8
+# photofs
+# Copyright (C) 2012-2016 Moses Palmér
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see <http://www.gnu.org/licenses/>.
+
+import hashlib
+import logging
+import os
+import threading
+
+from multiprocessing.pool import ThreadPool
+
+from ._util import FileLRU
+
+
+log = logging.getLogger(__name__)
+
+
+class BlockCache(object):
+    """A local read-through cache of fixed size chunks of files.
+
+    Every cached chunk is stored as a file in the cache directory. When a read
+    requests a chunk that is not cached, the entire chunk is read from the
+    original file, and written to the cache asynchronously. Concurrent reads of
+    the same chunk wait for the first read instead of reading it again. The
+    least recently used chunks are removed when the total size exceeds the
+    maximum size.
+    """
+    def __init__(
+            self, directory, max_size, chunk_size=1024 * 1024, workers=2):
+        """Creates a block cache.
+
+        :param str directory: The directory in which to store chunks. This is
+            created if it does not exist.
+
+        :param int max_size: The maximum total size, in bytes, of all cached
+            chunks.
+
+        :param int chunk_size: The size of a chunk.
+
+        :param int workers: The number of threads copying chunks to the cache.
+        """
+        self._directory = directory
+        self._chunk_size = chunk_size
+        self._workers = workers
+
+        self._lock = threading.Lock()
+        self._pool = None
+        self._pid = None
+
+        #: A mapping from chunk name to the list ``[event, data]`` for chunks
+        #: being read or written; ``event`` is set when ``data`` has been read
+        self._pending = {}
+        self._stats = {
+            'hits': 0,
+            'misses': 0,
+            'bytes_saved': 0,
+            'populated': 0,
+            'evicted': 0}
+
+        #: The cached chunks
+        self._entries = FileLRU(directory, max_size)
+
+    @property
+    def stats(self):
+        """Statistics about this cache.
+
+        This is a ``dict`` with the number of chunk ``hits`` and ``misses``,
+        the ``hit_ratio``, the number of ``bytes_saved`` by reading from the
+        cache, the number of chunks ``populated`` and ``evicted``, and the
+        current ``size`` of the cache.
+        """
+        with self._lock:
+            requests = self._stats['hits'] + self._stats['misses']
+            return dict(
+                self._stats,
+                hit_ratio=float(self._stats['hits']) / requests
+                if requests else 0.0,
+                size=self._entries.size)
+
+    @property
+    def pool(self):
+        """The thread pool used to populate the cache.
+
+        A new pool is created in forked processes.
+        """
+        if self._pid != os.getpid():
+            self._pool = ThreadPool(self._workers)
+            self._pid = os.getpid()
+        return self._pool
+
+    @staticmethod
+    def key(location, st):
+        """Generates the cache key for a file.
+
+        :param str location: The location of the file.
+
+        :param os.stat_result st: The ``stat`` value of the file.
+
+        :return: a cache key
+        :rtype: str
+        """
+        return hashlib.sha1((
+            u'%s\0%d\0%r' % (
+                location,
+                st.st_size,
+                st.st_mtime)).encode('utf-8')).hexdigest()
+
+    def _populate(self, name, location, offset, data):
+        """Writes a chunk of a file to the cache.
+
+        This method is run by the thread pool.
+
+        :param str name: The name of the chunk file.
+
+        :param str location: The location of the file.
+
+        :param int offset: The offset of the chunk.
+
+        :param bytes data: The data of the chunk.
+        """
+        path = os.path.join(self._directory, name)
+        try:
+            with open(path + '.tmp', 'wb') as f:
+                f.write(data)
+            os.rename(path + '.tmp', path)
+
+            with self._lock:
+                self._entries.add(name, len(data))
+                self._stats['populated'] += 1
+                self._stats['evicted'] += self._entries.evict()
+
+        except (IOError, OSError) as e:
+            log.debug('Failed to cache %s at %d: %s', location, offset, e)
+
+        finally:
+            with self._lock:
+                self._pending.pop(name, None)
+
+    def _read_chunk(self, name, offset, size):
+        """Reads from a cached chunk.
+
+        :param str name: The name of the chunk file.
+
+        :param int offset: The offset within the chunk.
+
+        :param int size: The number of bytes to read.
+
+        :return: the data read, or ``None`` if the chunk is not cached
+        :rtype: bytes or None
+        """
+        with self._lock:
+            if not self._entries.touch(name):
+                return None
+
+        try:
+            fd = os.open(os.path.join(self._directory, name), os.O_RDONLY)
+        except OSError:
+            # The chunk was evicted after the check
+            return None
+        try:
+            return os.pread(fd, size, offset)
+        finally:
+            os.close(fd)
+
+    def _fill(self, name, location, fd, offset, start, size):
+        """Reads a chunk that is not cached from the original file, writes it
+        to the cache asynchronously and reads from it.
+
+        If the chunk is already being read or written by another thread, its
+        data is shared instead of read again.
+
+        :param str name: The name of the chunk file.
+
+        :param str location: The location of the file.
+
+        :param int fd: An open file descriptor for the file.
+
+        :param int offset: The offset of the chunk.
+
+        :param int start: The offset within the chunk.
+
+        :param int size: The number of bytes to read.
+
+        :return: the data read
+        :rtype: bytes
+        """
+        with self._lock:
+            entry = self._pending.get(name)
+            owner = entry is None
+            if owner:
+                entry = self._pending[name] = [threading.Event(), None]
+                self._stats['misses'] += 1
+
+        if not owner:
+            entry[0].wait()
+            if entry[1] is None:
+                # The other thread failed to read the chunk
+                return os.pread(fd, size, offset + start)
+            data = entry[1][start:start + size]
+            with self._lock:
+                self._stats['hits'] += 1
+                self._stats['bytes_saved'] += len(data)
+            return data
+
+        try:
+            entry[1] = os.pread(fd, self._chunk_size, offset)
+        except:
+            with self._lock:
+                self._pending.pop(name, None)
+            raise
+        finally:
+            entry[0].set()
+
+        self.pool.apply_async(
+            self._populate, (name, location, offset, entry[1]))
+        return entry[1][start:start + size]
+
+    def read(self, key, location, fd, size, offset):
+        """Reads from a file through the cache.
+
+        Chunks not in the cache are read in their entirety from ``fd``, and
+        written to the cache asynchronously.
+
+        :param str key: The cache key of the file, as returned by :meth:`key`.
+
+        :param str location: The location of the file.
+
+        :param int fd: An open file descriptor for the file.
+
+        :param int size: The number of bytes to read.
+
+        :param int offset: The offset of the first byte to read.
+
+        :return: the data read
+        :rtype: bytes
+        """
+        result = []
+        end = offset + size
+        while offset < end:
+            index = offset // self._chunk_size
+            start = offset - index * self._chunk_size
+            length = min(end - offset, self._chunk_size - start)
+            name = '%s-%d' % (key, index)
+
+            data = self._read_chunk(name, start, length)
+            if data is not None:
+                with self._lock:
+                    self._stats['hits'] += 1
+                    self._stats['bytes_saved'] += len(data)
+            else:
+                data = self._fill(
+                    name, location, fd, index * self._chunk_size, start,
+                    length)
+            result.append(data)
+            offset += len(data)
+
+            # Stop at the end of the file
+            if len(data) < length:
+                break
+
+        return b''.join(result)
+
+
+class CachedFile(object):
+    """A file read through a block cache.
+    """
+    def __init__(self, cache, location, st):
+        """Opens a file.
+
+        :param BlockCache cache: The cache to use.
+
+        :param str location: The location of the file.
+
+        :param os.stat_result st: The ``stat`` value of the file.
+        """
+        self._cache = cache
+        self._location = location
+        self._key = cache.key(location, st)
+        self._fd = os.open(location, os.O_RDONLY)
+        self._offset = 0
+
+    def pread(self, size, offset):
+        """Reads from a specific offset.
+
+        :param int size: The number of bytes to read.
+
+        :param int offset: The offset of the first byte to read.
+
+        :return: the data read
+        :rtype: bytes
+        """
+        return self._cache.read(
+            self._key, self._location, self._fd, size, offset)
+
+    def fileno(self):
+        return self._fd
+
+    def tell(self):
+        return self._offset
+
+    def seek(self, offset):
+        self._offset = offset
+
+    def read(self, size):
+        data = self.pread(size, self._offset)
+        self._offset += len(data)
+        return data
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
@@ -0,0 +1,124 @@
+# coding: utf-8
+# photofs
+# Copyright (C) 2012-2016 Moses Palmér
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see <http://www.gnu.org/licenses/>.
+
+import io
+import os
+import stat
+
+from ._image import Image
+
+
+#: The name of the top level directory containing control files
+CONTROL_DIRECTORY = '.photofs'
+
+
+class VirtualFile(Image):
+    """A read-only file whose content is generated in memory.
+    """
+    def __init__(self, name, st, generate):
+        """Creates a virtual file.
+
+        :param str name: The file name.
+
+        :param os.stat_result st: The ``stat`` value from which to copy
+            ownership and timestamps.
+
+        :param generate: A function returning the current content of the file
+            as ``bytes``. This is called every time the content is needed.
+        """
+        title, extension = os.path.splitext(name)
+        super(VirtualFile, self).__init__(
+            title,
+            extension[1:],
+            st.st_mtime,
+            st,
+            False)
+        self._generate = generate
+
+    @property
+    def data(self):
+        """The current content of this file."""
+        return self._generate()
+
+    @property
+    def stat(self):
+        st = self._stat
+        return os.stat_result(
+            (stat.S_IFREG | 0o444,) + st[1:3] + (1,) + st[4:6] +
+            (len(self.data),) + st[7:])
+
+    def open(self, flags):
+        return io.BytesIO(self.data)
+
+
+class CommandHandle(io.BytesIO):
+    """An open control file accepting commands.
+
+    Reading returns the content of the file when it was opened.
+    """
+    def __init__(self, data, command):
+        """Creates a handle.
+
+        :param bytes data: The content of the file.
+
+        :param command: The function called with every command written.
+        """
+        super(CommandHandle, self).__init__(data)
+        self._command = command
+
+    def execute(self, data):
+        """Executes the commands written to the file.
+
+        Every non-empty line is a command.
+
+        :param bytes data: The data written.
+
+        :raises ValueError: if a command is invalid
+        """
+        for line in data.decode('utf-8').splitlines():
+            if line.strip():
+                self._command(line.strip())
+
+
+class ControlFile(VirtualFile):
+    """A virtual file to which commands may be written by its owner.
+    """
+    def __init__(self, name, st, generate, command):
+        """Creates a control file.
+
+        :param str name: The file name.
+
+        :param os.stat_result st: The ``stat`` value from which to copy
+            ownership and timestamps.
+
+        :param generate: A function returning the current content of the file
+            as ``bytes``.
+
+        :param command: A function called with every command, a ``str``,
+            written to the file. It should raise :class:`ValueError` for
+            invalid commands.
+        """
+        super(ControlFile, self).__init__(name, st, generate)
+        self._command = command
+
+    @property
+    def stat(self):
+        st = super(ControlFile, self).stat
+        return os.stat_result((st.st_mode | stat.S_IWUSR,) + st[1:])
+
+    def open(self, flags):
+        return CommandHandle(self.data, self._command)
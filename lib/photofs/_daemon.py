@@ -0,0 +1,318 @@
+# coding: utf-8
+# photofs
+# Copyright (C) 2012-2016 Moses Palmér
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import logging
+import os
+import socket
+import subprocess
+import threading
+
+try:
+    from socketserver import StreamRequestHandler, ThreadingUnixStreamServer
+except ImportError:
+    from SocketServer import StreamRequestHandler, ThreadingUnixStreamServer
+
+from xdg.BaseDirectory import get_runtime_dir
+
+from . import PhotoFS, fuse
+from ._filter import compile_filter, is_photo, is_video
+
+
+log = logging.getLogger(__name__)
+
+
+def default_socket():
+    """Returns the default location of the control socket.
+
+    :return: a path in the *XDG* runtime directory
+    :rtype: str
+    """
+    return os.path.join(get_runtime_dir(strict=False), 'photofs.sock')
+
+
+def request(path, command, **arguments):
+    """Sends a command to a daemon.
+
+    :param str path: The location of the control socket.
+
+    :param str command: The command.
+
+    :param arguments: The arguments of the command.
+
+    :return: the response of the daemon
+
+    :raises RuntimeError: if the daemon reports an error
+    """
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        connection.connect(path)
+        connection.sendall(json.dumps(
+            dict(arguments, command=command)).encode('utf-8') + b'\n')
+        response = json.loads(
+            connection.makefile('rb').readline().decode('utf-8'))
+    finally:
+        connection.close()
+
+    if not response.get('ok'):
+        raise RuntimeError(
+            'The daemon failed to %s: %s',
+            command, response.get('error'))
+    return response
+
+
+class _Handler(StreamRequestHandler):
+    """Handles commands sent to the control socket.
+
+    Every line received is a *JSON* object with the key ``command`` and the
+    arguments of the command, and is answered with a *JSON* object on one
+    line with the key ``ok``, and ``error`` if the command failed.
+    """
+    def handle(self):
+        for line in self.rfile:
+            try:
+                message = json.loads(line.decode('utf-8'))
+                response = self.server.daemon.handle(
+                    message.pop('command'), **message)
+                response['ok'] = True
+            except Exception as e:
+                log.exception('Failed to handle %s', line)
+                try:
+                    error = e.args[0] % e.args[1:]
+                except Exception:
+                    error = str(e)
+                response = {'ok': False, 'error': error}
+            self.wfile.write(json.dumps(response).encode('utf-8') + b'\n')
+
+
+class Daemon(object):
+    """Serves several mount points from one image source.
+
+    The image source is loaded and reloaded once, regardless of the number of
+    mount points. Every mount point has its own filters and presentation
+    settings, and is served by *FUSE* in a thread of its own. Mount points are
+    added and removed through a control socket.
+    """
+    def __init__(self, image_source, path):
+        """Creates a daemon.
+
+        :param ImageSource image_source: The image source to present.
+
+        :param str path: The location of the control socket.
+
+        :raises RuntimeError: if *FUSE* is not available
+        """
+        if fuse is None:
+            raise RuntimeError('FUSE is not available')
+        self._image_source = image_source
+        self._path = path
+        self._lock = threading.Lock()
+        self._server = None
+
+        #: A mapping from mount point to the tuple ``(photo_fs, thread)``
+        self._mounts = {}
+
+    def filters(
+            self, flat_presentation=False, photo_path='Photos',
+            video_path='Videos', views={}):
+        """Creates the filters for a mount point.
+
+        :param bool flat_presentation: Whether to not separate photos and
+            videos.
+
+        :param str photo_path: The name of the top level directory containing
+            photos.
+
+        :param str video_path: The name of the top level directory containing
+            videos.
+
+        :param dict views: A mapping from top level directory to filter
+            expression.
+
+        :return: the filters
+
+        :raises ValueError: if a filter expression is invalid
+        """
+        filters = {} if flat_presentation else {
+            photo_path: is_photo,
+            video_path: is_video}
+        filters.update(
+            (name, compile_filter(expression))
+            for name, expression in views.items())
+        return filters
+
+    def mount(
+            self, mountpoint, use_links=False, options={}, **kwargs):
+        """Mounts the image source.
+
+        :param str mountpoint: The mount point.
+
+        :param bool use_links: Whether to report file based images as links.
+
+        :param dict options: Additional *FUSE* options.
+
+        :param kwargs: Arguments passed to :meth:`filters`.
+
+        :raises ValueError: if the mount point is already used
+        """
+        mountpoint = os.path.abspath(mountpoint)
+        photo_fs = PhotoFS(
+            mountpoint,
+            image_source=self._image_source,
+            use_links=use_links,
+            filters=self.filters(**kwargs),
+            root_tags=kwargs.get('flat_presentation', False))
+
+        with self._lock:
+            if mountpoint in self._mounts:
+                raise ValueError(
+                    '%s is already mounted',
+                    mountpoint)
+            thread = threading.Thread(
+                target=self._run,
+                args=(photo_fs, mountpoint, options),
+                name='photofs-%s' % mountpoint)
+            thread.daemon = True
+            self._mounts[mountpoint] = (photo_fs, thread)
+            thread.start()
+
+    def unmount(self, mountpoint, timeout=10.0):
+        """Unmounts a mount point.
+
+        :param str mountpoint: The mount point.
+
+        :param float timeout: The maximum number of seconds to wait for *FUSE*
+            to return.
+
+        :raises KeyError: if the mount point is not mounted by this daemon
+
+        :raises RuntimeError: if no unmount command succeeds
+        """
+        mountpoint = os.path.abspath(mountpoint)
+        with self._lock:
+            photo_fs, thread = self._mounts[mountpoint]
+
+        # fusermount is called fusermount3 with libfuse 3, and is not required
+        # when running as root
+        commands = [['fusermount3', '-u'], ['fusermount', '-u']]
+        if os.geteuid() == 0:
+            commands.insert(0, ['umount'])
+        errors = []
+        for command in commands:
+            try:
+                subprocess.check_call(command + [mountpoint])
+                break
+            except (OSError, subprocess.CalledProcessError) as e:
+                errors.append('%s: %s' % (command[0], e))
+        else:
+            raise RuntimeError(
+                'Failed to unmount %s: %s',
+                mountpoint, '; '.join(errors))
+        thread.join(timeout)
+
+    def _run(self, photo_fs, mountpoint, options):
+        """Serves a mount point until it is unmounted.
+
+        :param PhotoFS photo_fs: The file system.
+
+        :param str mountpoint: The mount point.
+
+        :param dict options: Additional *FUSE* options.
+        """
+        try:
+            fuse.FUSE(
+                photo_fs,
+                mountpoint,
+                foreground=True,
+                fsname='photofs',
+                use_ino=True,
+                **options)
+        except Exception:
+            log.exception('Failed to serve %s', mountpoint)
+        finally:
+            with self._lock:
+                self._mounts.pop(mountpoint, None)
+
+    def handle(self, command, **arguments):
+        """Handles a command sent to the control socket.
+
+        The commands are ``'mount'`` and ``'unmount'``, taking the arguments
+        of :meth:`mount` and :meth:`unmount`, ``'list'``, returning the
+        mount points as ``mounts``, and ``'stop'``, which unmounts all mount
+        points and stops the daemon.
+
+        :param str command: The command.
+
+        :param arguments: The arguments of the command.
+
+        :return: the response
+        :rtype: dict
+
+        :raises ValueError: if the command is unknown
+        """
+        if command == 'mount':
+            self.mount(**arguments)
+            return {}
+        elif command == 'unmount':
+            self.unmount(**arguments)
+            return {}
+        elif command == 'list':
+            with self._lock:
+                return {'mounts': sorted(self._mounts)}
+        elif command == 'stop':
+            threading.Thread(target=self.stop).start()
+            return {}
+        else:
+            raise ValueError(
+                'Unknown command: %s',
+                command)
+
+    def serve_forever(self):
+        """Listens on the control socket until the daemon is stopped.
+        """
+        if os.path.exists(self._path):
+            # Remove the socket of a daemon that is no longer running
+            try:
+                request(self._path, 'list')
+            except (socket.error, OSError):
+                os.unlink(self._path)
+            else:
+                raise RuntimeError(
+                    'A daemon is already listening on %s',
+                    self._path)
+
+        self._server = ThreadingUnixStreamServer(self._path, _Handler)
+        self._server.daemon_threads = True
+        self._server.daemon = self
+        try:
+            self._server.serve_forever()
+        finally:
+            self._server.server_close()
+            os.unlink(self._path)
+
+    def stop(self):
+        """Unmounts all mount points and stops the daemon.
+        """
+        with self._lock:
+            mountpoints = list(self._mounts)
+        for mountpoint in mountpoints:
+            try:
+                self.unmount(mountpoint)
+            except Exception:
+                log.exception('Failed to unmount %s', mountpoint)
+        if self._server is not None:
+            self._server.shutdown()
@@ -0,0 +1,298 @@
+# coding: utf-8
+# photofs
+# Copyright (C) 2012-2016 Moses Palmér
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see <http://www.gnu.org/licenses/>.
+
+import errno
+import json
+import logging
+import os
+import shutil
+
+from multiprocessing.pool import ThreadPool
+
+from ._image import FileBasedImage
+from ._resize import ResizedImage
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+log = logging.getLogger(__name__)
+
+
+#: The name of the file in the export directory describing the previous export
+MANIFEST = '.photofs-export.json'
+
+#: The version of the manifest format
+MANIFEST_VERSION = 1
+
+#: The methods used to export images
+METHODS = ('auto', 'hardlink', 'reflink', 'symlink', 'copy')
+
+#: The methods tried, in order, when the method is ``'auto'``
+AUTO_METHODS = ('hardlink', 'reflink', 'symlink')
+
+#: The ioctl request cloning a file on Linux
+FICLONE = 0x40049409
+
+
+def _hardlink(location, path):
+    os.link(location, path)
+
+
+def _reflink(location, path):
+    if fcntl is None:
+        raise OSError(errno.EOPNOTSUPP, 'Reflinks are not supported')
+    with open(location, 'rb') as source:
+        with open(path, 'wb') as target:
+            try:
+                fcntl.ioctl(target.fileno(), FICLONE, source.fileno())
+            except (IOError, OSError):
+                target.close()
+                os.unlink(path)
+                raise
+
+
+def _symlink(location, path):
+    os.symlink(location, path)
+
+
+def _copy(location, path):
+    shutil.copyfile(location, path)
+
+
+#: The functions creating a file from the location of an image
+LINKERS = {
+    'hardlink': _hardlink,
+    'reflink': _reflink,
+    'symlink': _symlink,
+    'copy': _copy}
+
+
+def identity(item):
+    """Returns a value identifying the content of an image.
+
+    If the identity of an image is unchanged since the previous export, the
+    exported file is not recreated.
+
+    :param Image item: The image.
+
+    :return: a list that can be stored as *JSON*
+    """
+    original = item.image if isinstance(item, ResizedImage) else item
+    st = original.stat
+    return [
+        getattr(original, 'location', None),
+        item.size if isinstance(item, ResizedImage) else None,
+        st.st_size,
+        st.st_mtime]
+
+
+class Exporter(object):
+    """Writes the files presented by a file system to a real directory.
+
+    The images in the file system are linked or copied to the directory in
+    parallel. A manifest of the exported files is stored in the directory, and
+    when exporting again, only files whose image has changed are recreated, and
+    files no longer presented are removed.
+    """
+    def __init__(self, photo_fs, target, method='auto', workers=8):
+        """Creates an exporter.
+
+        :param PhotoFS photo_fs: The file system to export.
+
+        :param str target: The directory to which to export. This is created if
+            it does not exist.
+
+        :param str method: The method used to export images whose files are
+            in the file system; one of :attr:`METHODS`. With ``'auto'``, the
+            methods in :attr:`AUTO_METHODS` are tried in order. Other images,
+            such as downscaled photos, are always copied.
+
+        :param int workers: The number of files to export concurrently.
+
+        :raises ValueError: if ``method`` is unknown
+        """
+        if method not in METHODS:
+            raise ValueError(
+                'Unknown export method: %s',
+                method)
+        self._photo_fs = photo_fs
+        self._target = os.path.abspath(target)
+        self._method = method
+        self._workers = workers
+
+    def _load_manifest(self):
+        """Loads the manifest of the previous export.
+
+        :return: a mapping from relative path to the tuple
+            ``(method, identity)``
+        :rtype: dict
+        """
+        try:
+            with open(os.path.join(self._target, MANIFEST)) as f:
+                manifest = json.load(f)
+            if manifest.get('version') != MANIFEST_VERSION:
+                return {}
+            return {
+                path: (method, identity)
+                for path, (method, identity) in manifest['files'].items()}
+        except (OSError, IOError, ValueError, KeyError, TypeError):
+            return {}
+
+    def _save_manifest(self, files):
+        """Atomically stores the manifest of this export.
+
+        :param dict files: A mapping from relative path to the tuple
+            ``(method, identity)``.
+        """
+        path = os.path.join(self._target, MANIFEST)
+        temporary = path + '.tmp'
+        with open(temporary, 'w') as f:
+            json.dump(
+                {
+                    'version': MANIFEST_VERSION,
+                    'files': {
+                        name: list(value)
+                        for name, value in files.items()}},
+                f)
+        os.rename(temporary, path)
+
+    def _export(self, entry):
+        """Exports a single image.
+
+        The file is created under a temporary name and then renamed, so an
+        existing file is replaced atomically.
+
+        :param entry: The tuple ``(path, item)``, where ``path`` is the
+            relative path of the file to create.
+
+        :return: the tuple ``(path, method)``, where ``method`` is ``None`` if
+            the export failed
+        """
+        path, item = entry
+        destination = os.path.join(self._target, path)
+        temporary = os.path.join(
+            os.path.dirname(destination),
+            '.%s.photofs-tmp' % os.path.basename(destination))
+
+        if isinstance(item, FileBasedImage):
+            methods = AUTO_METHODS if self._method == 'auto' \
+                else (self._method,)
+        else:
+            methods = ('copy',)
+
+        for method in methods:
+            try:
+                if os.path.lexists(temporary):
+                    os.unlink(temporary)
+                if isinstance(item, FileBasedImage):
+                    LINKERS[method](item.location, temporary)
+                else:
+                    source = item.open(os.O_RDONLY)
+                    try:
+                        with open(temporary, 'wb') as f:
+                            shutil.copyfileobj(source, f)
+                    finally:
+                        source.close()
+                os.rename(temporary, destination)
+                return (path, method)
+            except (OSError, IOError) as e:
+                log.debug('Failed to %s %s: %s', method, path, e)
+
+        log.error('Failed to export %s', path)
+        return (path, None)
+
+    def _remove(self, path):
+        """Removes an exported file and any directories left empty.
+
+        :param str path: The relative path of the file.
+        """
+        try:
+            os.unlink(os.path.join(self._target, path))
+        except OSError:
+            pass
+
+        directory = os.path.dirname(path)
+        while directory:
+            try:
+                os.rmdir(os.path.join(self._target, directory))
+            except OSError:
+                break
+            directory = os.path.dirname(directory)
+
+    def export(self):
+        """Exports the file system.
+
+        :return: a ``dict`` with the number of files ``exported``,
+            ``unchanged``, ``removed`` and ``failed``
+        """
+        previous = self._load_manifest()
+        current = {}
+        pending = []
+        unchanged = 0
+
+        for path, item in self._photo_fs.files():
+            path = path[len(os.path.sep):]
+            try:
+                value = identity(item)
+            except OSError:
+                continue
+            old = previous.get(path)
+            if old is not None and old[1] == value and os.path.lexists(
+                    os.path.join(self._target, path)):
+                current[path] = old
+                unchanged += 1
+            else:
+                current[path] = (None, value)
+                pending.append((path, item))
+
+        # Remove files no longer presented before creating new ones, since a
+        # directory may have been replaced by a file
+        removed = [path for path in previous if path not in current]
+        for path in removed:
+            self._remove(path)
+
+        for directory in sorted(set(
+                os.path.dirname(path) for path, item in pending)):
+            try:
+                os.makedirs(os.path.join(self._target, directory))
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+        failed = 0
+        pool = ThreadPool(self._workers)
+        try:
+            for path, method in pool.imap_unordered(self._export, pending):
+                if method is None:
+                    del current[path]
+                    failed += 1
+                else:
+                    current[path] = (method, current[path][1])
+        finally:
+            pool.close()
+            pool.join()
+
+        self._save_manifest(current)
+
+        return dict(
+            exported=len(pending) - failed,
+            unchanged=unchanged,
+            removed=len(removed),
+            failed=failed)
@@ -0,0 +1,143 @@
+# coding: utf-8
+# photofs
+# Copyright (C) 2012-2016 Moses Palmér
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see <http://www.gnu.org/licenses/>.
+
+import ast
+import datetime
+
+from ._image import Image
+
+
+def is_photo(item):
+    """The filter function of the default directory of photos.
+
+    :param item: An image or a tag.
+    :type item: Image or Tag
+
+    :return: whether the item is, or contains, a photo
+    """
+    return not item.is_video if isinstance(item, Image) else not item.has_video
+
+
+def is_video(item):
+    """The filter function of the default directory of videos.
+
+    :param item: An image or a tag.
+    :type item: Image or Tag
+
+    :return: whether the item is, or contains, a video
+    """
+    return item.is_video if isinstance(item, Image) else item.has_video
+
+
+#: The image fields available to filter expressions, mapped to functions
+#: extracting them from an image
+FIELDS = {
+    'extension': lambda image: image.extension,
+    'title': lambda image: image.title,
+    'timestamp': lambda image: image.timestamp,
+    'year': lambda image: image.timestamp.year,
+    'month': lambda image: image.timestamp.month,
+    'day': lambda image: image.timestamp.day,
+    'size': lambda image: image.stat.st_size,
+    'rating': lambda image: image.rating or 0,
+    'video': lambda image: bool(image.is_video),
+    'photo': lambda image: not image.is_video}
+
+
+#: The functions available to filter expressions
+FUNCTIONS = {
+    'date': datetime.datetime}
+
+
+#: The syntax nodes allowed in filter expressions
+NODES = tuple(
+    getattr(ast, name)
+    for name in (
+        'Expression', 'Load',
+        'BoolOp', 'And', 'Or',
+        'UnaryOp', 'Not', 'USub',
+        'BinOp', 'Add', 'Sub', 'Mult',
+        'Compare', 'Eq', 'NotEq', 'Lt', 'LtE', 'Gt', 'GtE', 'In', 'NotIn',
+        'Name', 'Call', 'Constant', 'Num', 'Str', 'NameConstant',
+        'Tuple', 'List')
+    if hasattr(ast, name))
+
+
+def compile_filter(expression):
+    """Compiles a filter expression into a filter function.
+
+    A filter expression is a *Python* expression using comparisons, boolean
+    operators, constants and the names in :attr:`FIELDS`, which are bound to
+    the values for the image being tested, and the functions in
+    :attr:`FUNCTIONS`. For example, ``'photo and rating >= 4'`` or
+    ``'extension in ("jpg", "png") and timestamp >= date(2015, 6, 1)'``.
+
+    Only the fields referenced by the expression are read from images. An
+    image for which the expression cannot be evaluated, for example because the
+    file has been removed, is not included.
+
+    :param str expression: The filter expression.
+
+    :return: a function taking an image and returning whether to include it
+
+    :raises ValueError: if the expression is invalid
+    """
+    try:
+        tree = ast.parse(expression.strip(), mode='eval')
+    except SyntaxError as e:
+        raise ValueError(
+            'Invalid filter expression %s: %s',
+            expression, e.msg)
+
+    names = set()
+    for node in ast.walk(tree):
+        if not isinstance(node, NODES):
+            raise ValueError(
+                'Unsupported construct in filter expression %s: %s',
+                expression, type(node).__name__)
+        elif isinstance(node, ast.Call):
+            if not isinstance(node.func, ast.Name) \
+                    or node.func.id not in FUNCTIONS:
+                raise ValueError(
+                    'Unknown function in filter expression %s',
+                    expression)
+        elif isinstance(node, ast.Name) and node.id not in FUNCTIONS:
+            if node.id not in FIELDS:
+                raise ValueError(
+                    'Unknown field in filter expression %s: %s; valid fields '
+                    'are %s',
+                    expression, node.id, ', '.join(sorted(FIELDS)))
+            names.add(node.id)
+
+    # Compile the expression into a function taking the referenced fields as
+    # arguments, so that it is evaluated without any dictionary lookups
+    names = sorted(names)
+    function = eval(
+        compile(
+            'lambda %s: (%s)' % (', '.join(names), expression.strip()),
+            '<filter>',
+            'eval'),
+        dict(FUNCTIONS, __builtins__={}))
+    fields = tuple(FIELDS[name] for name in names)
+
+    def include(image):
+        try:
+            return bool(function(*[field(image) for field in fields]))
+        except (OSError, TypeError, ValueError):
+            return False
+
+    return include
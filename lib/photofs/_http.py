@@ -0,0 +1,296 @@
+# coding: utf-8
+# photofs
+# Copyright (C) 2012-2016 Moses Palmér
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import logging
+import mimetypes
+import os
+import re
+import socket
+import stat
+import threading
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import unquote, urlsplit
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urllib import unquote
+    from urlparse import urlsplit
+
+from ._image import FileBasedImage
+
+
+log = logging.getLogger(__name__)
+
+
+#: The regular expression matching a single byte range
+RANGE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+#: The number of bytes copied at a time when not using ``sendfile``
+CHUNK_SIZE = 64 * 1024
+
+
+def parse_address(value):
+    """Parses an address on the form ``[HOST:]PORT``.
+
+    :param str value: The address.
+
+    :return: the tuple ``(host, port)``; ``host`` is ``''`` if not specified
+
+    :raises ValueError: if the address is invalid
+    """
+    host, _, port = value.rpartition(':')
+    return (host.strip('[]'), int(port))
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    """Serves the files and directories of a file system.
+
+    Directories are listed as *JSON* arrays of objects with the keys ``name``,
+    ``type``, ``size`` and ``mtime``.
+    """
+    protocol_version = 'HTTP/1.1'
+    server_version = 'photofs'
+
+    def log_message(self, format, *args):
+        log.debug('%s: %s', self.address_string(), format % args)
+
+    def do_HEAD(self):
+        self.serve(False)
+
+    def do_GET(self):
+        self.serve(True)
+
+    def serve(self, body):
+        """Serves a request.
+
+        :param bool body: Whether to send the body.
+        """
+        photo_fs = self.server.photo_fs
+        path = unquote(urlsplit(self.path).path)
+        if len(path) > 1:
+            path = path.rstrip('/')
+
+        try:
+            include, item = photo_fs.locate(path)
+            st = photo_fs.getattr(path)
+        except (KeyError, ValueError, OSError):
+            return self.send_error(404)
+
+        if stat.S_ISDIR(st['st_mode']):
+            self.serve_directory(path, body)
+        else:
+            self.serve_file(path, item, body)
+
+    def serve_directory(self, path, body):
+        """Serves a directory listing.
+
+        :param str path: The absolute path of the directory.
+
+        :param bool body: Whether to send the body.
+        """
+        photo_fs = self.server.photo_fs
+        entries = []
+        for name in photo_fs.readdir(path, 0):
+            try:
+                st = photo_fs.getattr(os.path.join(path, name))
+            except (KeyError, OSError):
+                continue
+            is_directory = stat.S_ISDIR(st['st_mode'])
+            entries.append({
+                'name': name,
+                'type': 'directory' if is_directory else 'file',
+                'size': None if is_directory else st['st_size'],
+                'mtime': st['st_mtime']})
+        data = json.dumps(entries).encode('utf-8')
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        if body:
+            self.wfile.write(data)
+
+    def serve_file(self, path, item, body):
+        """Serves a file, or a range of it.
+
+        The file is opened before any headers are sent, and its attributes are
+        read from the open file, since resized images are rendered when opened.
+
+        :param str path: The absolute path of the file.
+
+        :param Image item: The image.
+
+        :param bool body: Whether to send the body.
+        """
+        photo_fs = self.server.photo_fs
+        try:
+            fh = photo_fs.open(path, os.O_RDONLY)
+        except (KeyError, OSError):
+            return self.send_error(404)
+        try:
+            self.serve_handle(path, item, fh, body)
+        finally:
+            photo_fs.release(path, fh)
+
+    def serve_handle(self, path, item, fh, body):
+        """Serves an open file, or a range of it.
+
+        :param str path: The absolute path of the file.
+
+        :param Image item: The image.
+
+        :param int fh: The file handle.
+
+        :param bool body: Whether to send the body.
+        """
+        st = self.server.photo_fs.getattr(path, fh)
+        size = st['st_size']
+        etag = '"%x-%x-%x"' % (
+            st['st_ino'], size, int(st['st_mtime'] * 1000000))
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+
+        # Only single ranges are supported; other requests receive the entire
+        # file
+        start, end = 0, size
+        status = 200
+        match = RANGE.match(self.headers.get('Range', ''))
+        if match and self.headers.get('If-Range', etag) == etag:
+            first, last = match.groups()
+            if first:
+                start = int(first)
+                end = min(int(last) + 1, size) if last else size
+            elif last:
+                start = max(size - int(last), 0)
+            if start >= end:
+                self.send_response(416)
+                self.send_header('Content-Range', 'bytes */%d' % size)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            status = 206
+
+        self.send_response(status)
+        self.send_header(
+            'Content-Type',
+            mimetypes.guess_type(path)[0] or 'application/octet-stream')
+        self.send_header('Content-Length', str(end - start))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('ETag', etag)
+        self.send_header('Last-Modified', self.date_time_string(
+            st['st_mtime']))
+        if status == 206:
+            self.send_header(
+                'Content-Range', 'bytes %d-%d/%d' % (start, end - 1, size))
+        self.end_headers()
+        if not body or start == end:
+            return
+
+        try:
+            if isinstance(item, FileBasedImage) \
+                    and hasattr(os, 'sendfile') \
+                    and not self.server.photo_fs.block_cache:
+                self.send_location(item.location, start, end)
+            else:
+                self.send_path(path, fh, start, end)
+        except (IOError, OSError, socket.error) as e:
+            # The client may close the connection at any time
+            log.debug('Failed to send %s: %s', path, e)
+            self.close_connection = True
+
+    def send_location(self, location, start, end):
+        """Sends part of a file using ``sendfile``.
+
+        :param str location: The location of the file.
+
+        :param int start: The offset of the first byte to send.
+
+        :param int end: The offset after the last byte to send.
+        """
+        self.wfile.flush()
+        fd = os.open(location, os.O_RDONLY)
+        try:
+            while start < end:
+                sent = os.sendfile(
+                    self.connection.fileno(), fd, start, end - start)
+                if sent == 0:
+                    raise IOError('%s was truncated' % location)
+                start += sent
+        finally:
+            os.close(fd)
+
+    def send_path(self, path, fh, start, end):
+        """Sends part of a file read through the file system.
+
+        This uses any block cache and read scheduler of the file system.
+
+        :param str path: The absolute path of the file.
+
+        :param int fh: The file handle.
+
+        :param int start: The offset of the first byte to send.
+
+        :param int end: The offset after the last byte to send.
+        """
+        photo_fs = self.server.photo_fs
+        while start < end:
+            data = photo_fs.read_buffer(
+                path, min(CHUNK_SIZE, end - start), start, fh)
+            if not data:
+                raise IOError('%s was truncated' % path)
+            self.wfile.write(data)
+            start += len(data)
+
+
+class Server(ThreadingMixIn, HTTPServer):
+    """An *HTTP* server presenting a file system.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, photo_fs, address):
+        """Creates a server.
+
+        :param PhotoFS photo_fs: The file system to serve.
+
+        :param tuple address: The address on which to listen, as the tuple
+            ``(host, port)``.
+        """
+        if ':' in address[0]:
+            self.address_family = socket.AF_INET6
+        HTTPServer.__init__(self, address, RequestHandler)
+        self.photo_fs = photo_fs
+
+    def start(self):
+        """Serves requests in a background thread.
+
+        :return: the thread
+        """
+        thread = threading.Thread(
+            target=self.serve_forever,
+            name='photofs-http')
+        thread.daemon = True
+        thread.start()
+        return thread
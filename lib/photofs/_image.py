@@ -29,7 +29,9 @@ class Image(object):
     #: The date format used to construct the title when none is set
     DATE_FORMAT = '%Y-%m-%d, %H.%M'
 
-    def __init__(self, title, extension, timestamp, st, is_video=None):
+    def __init__(
+            self, title, extension, timestamp, st, is_video=None, inode=None,
+            rating=None, attributes=None):
         """Initialises an image.
 
         :param str title: The title of the image. This should be used to
@@ -47,6 +49,16 @@ class Image(object):
         :param bool is_video: Whether this image is a video. This must be
             either ``True`` or ``False``, or ``None``. If it is ``None``, the
             type is inferred from the file *MIME type*.
+
+        :param int inode: A number uniquely identifying this image within its
+            image source, which remains the same when the source is reloaded.
+
+        :param int rating: The rating of the image, if supported by the image
+            source.
+
+        :param dict attributes: Additional attributes provided by the image
+            source, as a mapping from name to ``str``. These are presented as
+            extended attributes.
         """
         super(Image, self).__init__()
         self._title = title
@@ -60,6 +72,9 @@ class Image(object):
             is_video = mime and mime.startswith('video/')
         self._stat = st
         self._is_video = is_video
+        self._inode = inode
+        self._rating = rating
+        self._attributes = attributes if attributes is not None else {}
 
     @property
     def timestamp(self):
@@ -89,6 +104,22 @@ class Image(object):
         """The ``stat`` result for this image."""
         return self._stat
 
+    @property
+    def inode(self):
+        """The stable inode number of this image, or ``None``."""
+        return self._inode
+
+    @property
+    def rating(self):
+        """The rating of this image, or ``None``."""
+        return self._rating
+
+    @property
+    def attributes(self):
+        """Additional attributes provided by the image source, as a mapping
+        from name to ``str``."""
+        return self._attributes
+
     def open(self, flags):
         """Opens a readable stream to the file.
 
@@ -103,7 +134,9 @@ class Image(object):
 class FileBasedImage(Image):
     """An image or video.
     """
-    def __init__(self, title, location, timestamp, is_video=None):
+    def __init__(
+            self, title, location, timestamp, is_video=None, st=None,
+            inode=None, rating=None, attributes=None):
         """Initialises a file based image.
 
         :param str title: The title of the image. This should be used to
@@ -119,13 +152,29 @@ class FileBasedImage(Image):
         :param bool is_video: Whether this image is a video. This must be
             either ``True`` or ``False``, or ``None``. If it is ``None``, the
             type is inferred from the file *MIME type*.
+
+        :param os.stat_result st: The ``lstat`` value for ``location``, if
+            already known. If this is not specified, it is read from the file
+            system.
+
+        :param int inode: A number uniquely identifying this image within its
+            image source, which remains the same when the source is reloaded.
+
+        :param int rating: The rating of the image, if supported by the image
+            source.
+
+        :param dict attributes: Additional attributes provided by the image
+            source, as a mapping from name to ``str``.
         """
         super(FileBasedImage, self).__init__(
             title,
             location.rsplit('.', 1)[-1].lower(),
             timestamp,
-            os.lstat(location),
-            is_video)
+            st or os.lstat(location),
+            is_video,
+            inode,
+            rating,
+            attributes)
         self._location = location
 
     @property
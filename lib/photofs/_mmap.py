@@ -0,0 +1,311 @@
+#!/usr/bin/env python
+# coding: utf-8
+# photofs
+# Copyright (C) 2012-2016 Moses Palmér
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see <http://www.gnu.org/licenses/>.
+import collections
+import ctypes
+import mmap
+import os
+import threading
+
+
+class MappingCache(object):
+    """A cache of memory mappings of small files.
+
+    Files are mapped when first opened, and the mapping is shared by all
+    handles to the same file. The least recently used mappings not in use are
+    unmapped when the total size exceeds the address space budget.
+
+    Files are mapped copy-on-write, since *ctypes* can only reference the
+    memory of writable buffers; nothing is ever written, so no pages are
+    copied.
+    """
+    def __init__(self, max_size, threshold=16 * 1024 * 1024):
+        """Creates a mapping cache.
+
+        :param int max_size: The maximum total size, in bytes, of all mappings
+            not in use.
+
+        :param int threshold: The maximum size of files to map.
+        """
+        self._max_size = max_size
+        self._threshold = threshold
+        self._lock = threading.Lock()
+        self._size = 0
+        self._stats = {
+            'hits': 0,
+            'misses': 0,
+            'evicted': 0}
+
+        #: A mapping from key to the list ``[mapping, users]``, in order of
+        #: last use
+        self._entries = collections.OrderedDict()
+
+    @property
+    def stats(self):
+        """Statistics about this cache.
+
+        This is a ``dict`` with the number of ``hits`` and ``misses`` when
+        opening files, the number of mappings ``evicted``, and the current
+        number of ``mappings`` and their total ``size``.
+        """
+        with self._lock:
+            return dict(
+                self._stats,
+                mappings=len(self._entries),
+                size=self._size)
+
+    def accepts(self, st):
+        """Returns whether a file is mapped when opened.
+
+        :param os.stat_result st: The ``stat`` value of the file.
+
+        :rtype: bool
+        """
+        return 0 < st.st_size <= min(self._threshold, self._max_size)
+
+    @staticmethod
+    def key(location, st):
+        """Generates the cache key for a file.
+
+        :param str location: The location of the file.
+
+        :param os.stat_result st: The ``stat`` value of the file.
+
+        :return: a cache key
+        """
+        return (location, st.st_ino, st.st_size, st.st_mtime)
+
+    def _evict(self):
+        """Unmaps the least recently used mappings not in use until the total
+        size is within the maximum size.
+
+        This method must be called with the lock held.
+        """
+        for key in list(self._entries):
+            if self._size <= self._max_size:
+                break
+            mapping, users = self._entries[key]
+            if users:
+                continue
+            del self._entries[key]
+            self._size -= len(mapping)
+            self._stats['evicted'] += 1
+            try:
+                mapping.close()
+            except BufferError:
+                # Data returned by a read is still referenced; the mapping is
+                # closed when it is garbage collected
+                pass
+
+    def acquire(self, location, st):
+        """Returns the mapping of a file, mapping it if necessary.
+
+        Every call must be matched by a call to :meth:`release`.
+
+        :param str location: The location of the file.
+
+        :param os.stat_result st: The ``stat`` value of the file.
+
+        :return: the tuple ``(key, mapping)``
+
+        :raises OSError: if the file cannot be mapped
+        """
+        key = self.key(location, st)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                entry[1] += 1
+                self._entries[key] = self._entries.pop(key)
+                self._stats['hits'] += 1
+                return (key, entry[0])
+
+        # Map the file without holding the lock
+        fd = os.open(location, os.O_RDONLY)
+        try:
+            mapping = mmap.mmap(fd, st.st_size, access=mmap.ACCESS_COPY)
+        finally:
+            os.close(fd)
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                # Another thread mapped the file concurrently
+                mapping.close()
+                entry[1] += 1
+                self._entries[key] = self._entries.pop(key)
+                self._stats['hits'] += 1
+                return (key, entry[0])
+
+            self._entries[key] = [mapping, 1]
+            self._size += len(mapping)
+            self._stats['misses'] += 1
+            self._evict()
+            return (key, mapping)
+
+    def release(self, key, stale=False):
+        """Releases a mapping acquired with :meth:`acquire`.
+
+        :param key: The key returned by :meth:`acquire`.
+
+        :param bool stale: Whether the file has been modified since it was
+            mapped. Stale mappings are removed as soon as they are not in use.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                entry[1] -= 1
+                if stale and not entry[1]:
+                    del self._entries[key]
+                    self._size -= len(entry[0])
+                    self._stats['evicted'] += 1
+                    try:
+                        entry[0].close()
+                    except BufferError:
+                        pass
+                self._evict()
+
+
+class MappedFile(object):
+    """A file read through a shared memory mapping.
+
+    Reads return views of the mapping instead of copies of the data.
+
+    Touching the pages of a mapping of a file that has since been truncated
+    raises ``SIGBUS``. As a best effort, the file is checked before every read
+    through a file descriptor kept open, and if its size or modification time
+    has changed, the mapping is released and the file is read with ``pread``
+    instead. This does not prevent the crash: the data returned is copied
+    only after the check, by the caller or by *fusepy*, so a file truncated
+    in between still crashes the process. Mappings should therefore only be
+    used for files that are not modified in place. Files replaced by renaming
+    keep their mapping, since the descriptor references the original file.
+    """
+    def __init__(self, cache, location, st):
+        """Opens a file.
+
+        :param MappingCache cache: The cache to use.
+
+        :param str location: The location of the file.
+
+        :param os.stat_result st: The ``stat`` value of the file.
+
+        :raises OSError: if the file cannot be mapped
+        """
+        self._cache = cache
+        self._key, self._mapping = cache.acquire(location, st)
+        try:
+            self._fd = os.open(location, os.O_RDONLY)
+        except OSError:
+            cache.release(self._key)
+            raise
+        self._offset = 0
+
+    @property
+    def size(self):
+        """The size of the mapped file."""
+        if self._check():
+            return len(self._mapping)
+        else:
+            return os.fstat(self._fd).st_size
+
+    def _check(self):
+        """Releases the mapping if the file has been modified since it was
+        mapped.
+
+        This is only a best effort; see :class:`MappedFile`.
+
+        :return: whether the mapping can be read
+        :rtype: bool
+        """
+        if self._mapping is not None and self._cache.key(
+                self._key[0], os.fstat(self._fd)) != self._key:
+            self._cache.release(self._key, True)
+            self._mapping = None
+        return self._mapping is not None
+
+    def _range(self, size, offset):
+        """Clamps a range to the size of the file.
+
+        :param int size: The number of bytes to read.
+
+        :param int offset: The offset of the first byte to read.
+
+        :return: the tuple ``(start, end)``
+        """
+        length = len(self._mapping)
+        start = min(max(offset, 0), length)
+        return (start, min(start + size, length))
+
+    def pread(self, size, offset):
+        """Reads from a specific offset.
+
+        :param int size: The number of bytes to read.
+
+        :param int offset: The offset of the first byte to read.
+
+        :return: a view of the data read, or the data read if the file has
+            been modified
+        :rtype: memoryview or bytes
+        """
+        if not self._check():
+            return os.pread(self._fd, size, max(offset, 0))
+        start, end = self._range(size, offset)
+        return memoryview(self._mapping)[start:end]
+
+    def read_buffer(self, size, offset):
+        """Reads from a specific offset into a *ctypes* array.
+
+        The array references the mapping, so no data is copied. This is used
+        with *fusepy*, which copies the data read using ``ctypes.memmove``,
+        which does not accept ``memoryview`` instances. The copy is made after
+        this method has returned, so the mapping may be touched after the file
+        has been truncated; see :class:`MappedFile`.
+
+        :param int size: The number of bytes to read.
+
+        :param int offset: The offset of the first byte to read.
+
+        :return: an array of the data read, or the data read if the file has
+            been modified
+        :rtype: ctypes.Array or bytes
+        """
+        if not self._check():
+            return os.pread(self._fd, size, max(offset, 0))
+        start, end = self._range(size, offset)
+        if start == end:
+            return b''
+        return (ctypes.c_char * (end - start)).from_buffer(
+            self._mapping, start)
+
+    def tell(self):
+        return self._offset
+
+    def seek(self, offset):
+        self._offset = offset
+
+    def read(self, size):
+        data = self.pread(size, self._offset)
+        self._offset += len(data)
+        return data
+
+    def close(self):
+        if self._mapping is not None:
+            self._cache.release(self._key)
+            self._mapping = None
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
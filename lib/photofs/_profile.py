@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+# coding: utf-8
+# photofs
+# Copyright (C) 2012-2016 Moses Palmér
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see <http://www.gnu.org/licenses/>.
+import collections
+import contextlib
+import os
+import sys
+import threading
+import time
+
+
+class PhaseTimer(object):
+    """Accumulates the time spent in the phases of an operation.
+    """
+    def __init__(self):
+        self._phases = collections.OrderedDict()
+
+    @property
+    def phases(self):
+        """A mapping from phase name to the number of seconds spent in it."""
+        return dict(self._phases)
+
+    def add(self, name, duration):
+        """Adds time to a phase.
+
+        :param str name: The name of the phase.
+
+        :param float duration: The number of seconds to add.
+        """
+        self._phases[name] = self._phases.get(name, 0.0) + duration
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """A context manager adding the time spent in its body to a phase.
+
+        :param str name: The name of the phase.
+        """
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add(name, time.time() - start)
+
+
+class Profiler(object):
+    """A sampling profiler for all threads of the process.
+
+    When running, a background thread periodically records the stack of every
+    other thread. The samples are reported as collapsed stacks, one line per
+    distinct stack on the form ``frame;frame;frame count`` with the outermost
+    frame first, which is the input format of most flame graph tools.
+    """
+    def __init__(self, interval=0.005):
+        """Creates a profiler.
+
+        :param float interval: The number of seconds between samples.
+        """
+        self._interval = interval
+        self._lock = threading.Lock()
+        self._samples = collections.Counter()
+        self._thread = None
+        self._stopped = None
+        self._started = None
+        self._duration = 0.0
+
+    @property
+    def running(self):
+        """Whether the profiler is currently sampling."""
+        return self._thread is not None
+
+    def start(self):
+        """Starts sampling.
+
+        Samples from previous runs are discarded. If the profiler is already
+        running, this method does nothing.
+        """
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._samples.clear()
+            self._duration = 0.0
+            self._started = time.time()
+            self._stopped = threading.Event()
+            self._thread = threading.Thread(
+                target=self._run,
+                args=(self._stopped,),
+                name='photofs-profiler')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self):
+        """Stops sampling.
+
+        The samples are kept until the profiler is started again. If the
+        profiler is not running, this method does nothing.
+        """
+        with self._lock:
+            if self._thread is None:
+                return
+            thread, self._thread = self._thread, None
+            self._stopped.set()
+            self._duration = time.time() - self._started
+        thread.join()
+
+    def _run(self, stopped):
+        """The sampling loop.
+
+        :param threading.Event stopped: The event signalling that sampling
+            should stop.
+        """
+        own = threading.current_thread().ident
+        while not stopped.wait(self._interval):
+            stacks = []
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append('%s (%s:%d)' % (
+                        code.co_name,
+                        os.path.basename(code.co_filename),
+                        code.co_firstlineno))
+                    frame = frame.f_back
+                stacks.append(';'.join(reversed(stack)))
+            with self._lock:
+                self._samples.update(stacks)
+
+    def report(self, phases={}):
+        """Generates a report of the samples collected.
+
+        The report starts with comment lines, prefixed with ``'#'``, describing
+        the run and the phase timings passed, followed by the collapsed stacks
+        sorted by decreasing sample count.
+
+        :param dict phases: A mapping from a description to a mapping from
+            phase name to duration in seconds, to include in the report.
+
+        :return: the report
+        :rtype: str
+        """
+        with self._lock:
+            samples = self._samples.most_common()
+            if self._thread is not None:
+                duration = time.time() - self._started
+            else:
+                duration = self._duration
+
+        lines = [
+            '# %s, %d samples over %.3f s at %.0f Hz' % (
+                'running' if self.running else 'stopped',
+                sum(count for stack, count in samples),
+                duration,
+                1.0 / self._interval)]
+        for description, timings in sorted(phases.items()):
+            for name, seconds in sorted(timings.items()):
+                lines.append('# %s %s %.6f s' % (description, name, seconds))
+        lines.extend('%s %d' % (stack, count) for stack, count in samples)
+        return '\n'.join(lines) + '\n'
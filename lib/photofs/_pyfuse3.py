@@ -0,0 +1,313 @@
+# coding: utf-8
+# photofs
+# Copyright (C) 2012-2016 Moses Palmér
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see <http://www.gnu.org/licenses/>.
+
+import errno
+import itertools
+import os
+import threading
+
+from ._control import VirtualFile
+
+# Try to import pyfuse3
+try:
+    import pyfuse3
+    import trio
+    _Operations = pyfuse3.Operations
+except ImportError:
+    pyfuse3 = None
+    trio = None
+    _Operations = object
+
+
+class Operations(_Operations):
+    """An implementation of the low level *pyfuse3* operations using a
+    :class:`photofs.PhotoFS` instance.
+
+    *pyfuse3* addresses items by inode number, so the path of every inode
+    reported to the kernel is remembered until the kernel forgets it. The
+    methods of the file system, which may block, are run in worker threads so
+    that requests are served concurrently by a single event loop.
+    """
+
+    #: The number of seconds the kernel may cache attributes and entries
+    TIMEOUT = 1.0
+
+    def __init__(self, photo_fs, negative_timeout=None):
+        """Creates the operations for a file system.
+
+        :param PhotoFS photo_fs: The file system to present.
+
+        :param float negative_timeout: The number of seconds the kernel may
+            cache that a name does not exist. If this is not specified, missing
+            names are not cached by the kernel.
+
+        :raises RuntimeError: if *pyfuse3* is not installed
+        """
+        if pyfuse3 is None:
+            raise RuntimeError('The pyfuse3 backend requires pyfuse3 and trio')
+        super(Operations, self).__init__()
+        self._photo_fs = photo_fs
+        self._negative_timeout = negative_timeout
+        self._lock = threading.Lock()
+
+        #: A mapping from inode number to the tuple ``(path, lookups)``
+        self._inodes = {pyfuse3.ROOT_INODE: (os.path.sep, 1)}
+
+        #: A mapping from directory handle to the list of ``(name, attrs)``
+        self._directories = {}
+        self._handles = itertools.count(1)
+
+    async def _call(self, function, *args):
+        """Calls a method of the file system in a worker thread.
+
+        :param function: The function to call.
+
+        :param args: The arguments to pass.
+
+        :return: the return value of ``function``
+
+        :raises pyfuse3.FUSEError: if ``function`` fails
+        """
+        try:
+            return await trio.to_thread.run_sync(function, *args)
+        except pyfuse3.FUSEError:
+            raise
+        except KeyError:
+            raise pyfuse3.FUSEError(errno.ENOENT)
+        except OSError as e:
+            raise pyfuse3.FUSEError(e.errno or errno.EIO)
+
+    def _path(self, inode):
+        """Returns the path of an inode.
+
+        :param int inode: The inode number.
+
+        :return: the absolute path
+
+        :raises pyfuse3.FUSEError: if the inode is unknown
+        """
+        try:
+            return self._inodes[inode][0]
+        except KeyError:
+            raise pyfuse3.FUSEError(errno.ENOENT)
+
+    def _remember(self, attrs, path):
+        """Remembers the path of an inode reported to the kernel.
+
+        :param pyfuse3.EntryAttributes attrs: The attributes reported.
+
+        :param str path: The absolute path of the item.
+        """
+        with self._lock:
+            _, lookups = self._inodes.get(attrs.st_ino, (None, 0))
+            self._inodes[attrs.st_ino] = (path, lookups + 1)
+
+    def _attributes(self, path):
+        """Returns the attributes of an item.
+
+        This method is run in a worker thread.
+
+        :param str path: The absolute path of the item.
+
+        :return: the attributes
+        :rtype: pyfuse3.EntryAttributes
+        """
+        st = self._photo_fs.getattr(path)
+        attrs = pyfuse3.EntryAttributes()
+        attrs.st_ino = st['st_ino']
+        attrs.st_mode = st['st_mode']
+        attrs.st_nlink = st['st_nlink']
+        attrs.st_uid = st['st_uid']
+        attrs.st_gid = st['st_gid']
+        attrs.st_size = st['st_size']
+        attrs.st_atime_ns = int(st['st_atime'] * 1e9)
+        attrs.st_ctime_ns = int(st['st_ctime'] * 1e9)
+        attrs.st_mtime_ns = int(st['st_mtime'] * 1e9)
+        attrs.st_blksize = 4096
+        attrs.st_blocks = (st['st_size'] + 511) // 512
+        attrs.attr_timeout = self.TIMEOUT
+        attrs.entry_timeout = self.TIMEOUT
+        return attrs
+
+    def _list(self, path):
+        """Lists a directory with the attributes of all items.
+
+        This method is run in a worker thread.
+
+        :param str path: The absolute path of the directory.
+
+        :return: a list of ``(name, attrs)``
+        """
+        result = []
+        for name in self._photo_fs.readdir(path, 0):
+            try:
+                result.append((
+                    name,
+                    self._attributes(os.path.join(path, name))))
+            except (KeyError, OSError):
+                # The item was removed while listing
+                pass
+        return result
+
+    def init(self):
+        self._photo_fs.init(os.path.sep)
+
+    async def lookup(self, parent_inode, name, ctx=None):
+        path = os.path.join(self._path(parent_inode), os.fsdecode(name))
+        try:
+            attrs = await self._call(self._attributes, path)
+        except pyfuse3.FUSEError as e:
+            if e.errno != errno.ENOENT or not self._negative_timeout:
+                raise
+
+            # An entry with inode number 0 lets the kernel cache the miss
+            attrs = pyfuse3.EntryAttributes()
+            attrs.st_ino = 0
+            attrs.entry_timeout = self._negative_timeout
+            return attrs
+
+        self._remember(attrs, path)
+        return attrs
+
+    async def forget(self, inode_list):
+        with self._lock:
+            for inode, nlookup in inode_list:
+                if inode == pyfuse3.ROOT_INODE or inode not in self._inodes:
+                    continue
+                path, lookups = self._inodes[inode]
+                if lookups > nlookup:
+                    self._inodes[inode] = (path, lookups - nlookup)
+                else:
+                    del self._inodes[inode]
+
+    async def getattr(self, inode, ctx=None):
+        return await self._call(self._attributes, self._path(inode))
+
+    async def readlink(self, inode, ctx):
+        return os.fsencode(
+            await self._call(self._photo_fs.readlink, self._path(inode)))
+
+    async def getxattr(self, inode, name, ctx):
+        return await self._call(
+            self._photo_fs.getxattr, self._path(inode), os.fsdecode(name))
+
+    async def listxattr(self, inode, ctx):
+        return [
+            os.fsencode(name)
+            for name in await self._call(
+                self._photo_fs.listxattr, self._path(inode))]
+
+    async def opendir(self, inode, ctx):
+        # The listing is read once, so that the offsets passed to readdir
+        # remain valid
+        path = self._path(inode)
+        entries = await self._call(self._list, path)
+        fh = next(self._handles)
+        self._directories[fh] = (path, entries)
+        return fh
+
+    async def readdir(self, fh, start_id, token):
+        path, entries = self._directories[fh]
+        for i in range(start_id, len(entries)):
+            name, attrs = entries[i]
+            if not pyfuse3.readdir_reply(
+                    token, os.fsencode(name), attrs, i + 1):
+                break
+            self._remember(attrs, os.path.join(path, name))
+
+    async def releasedir(self, fh):
+        self._directories.pop(fh, None)
+
+    async def setattr(self, inode, attr, fields, fh, ctx):
+        # Only truncating control files is supported
+        path = self._path(inode)
+        if fields.update_size:
+            await self._call(self._photo_fs.truncate, path, attr.st_size, fh)
+        return await self._call(self._attributes, path)
+
+    def _open(self, path, flags):
+        """Opens a file.
+
+        This method is run in a worker thread.
+
+        :param str path: The absolute path of the file.
+
+        :param int flags: The flags passed to ``open``.
+
+        :return: the file information
+        :rtype: pyfuse3.FileInfo
+        """
+        # The content of virtual files is generated when they are opened, so
+        # it must neither be cached nor limited to the size reported before
+        include, item = self._photo_fs.locate(path)
+        generated = isinstance(item, VirtualFile)
+        fh = self._photo_fs.open(path, flags)
+        return pyfuse3.FileInfo(
+            fh=fh,
+            keep_cache=not generated,
+            direct_io=generated)
+
+    async def open(self, inode, flags, ctx):
+        return await self._call(self._open, self._path(inode), flags)
+
+    async def read(self, fh, off, size):
+        return await self._call(
+            self._photo_fs.read_buffer, None, size, off, fh)
+
+    async def write(self, fh, off, buf):
+        return await self._call(self._photo_fs.write, None, buf, off, fh)
+
+    async def release(self, fh):
+        await self._call(self._photo_fs.release, None, fh)
+
+
+def mount(photo_fs, mountpoint, options={}):
+    """Mounts a file system using *pyfuse3* and serves requests until it is
+    unmounted.
+
+    The process is not daemonised.
+
+    :param PhotoFS photo_fs: The file system to mount.
+
+    :param str mountpoint: The mount point.
+
+    :param dict options: *FUSE* options. A value of ``True`` denotes a flag.
+        The option ``negative_timeout`` is handled by the file system.
+
+    :raises RuntimeError: if *pyfuse3* is not installed
+    """
+    options = dict(options)
+    negative_timeout = options.pop('negative_timeout', None)
+    operations = Operations(
+        photo_fs,
+        float(negative_timeout) if negative_timeout else None)
+
+    fuse_options = set(pyfuse3.default_options)
+    fuse_options.add('fsname=photofs')
+    for name, value in options.items():
+        if value is True:
+            fuse_options.add(name)
+        elif value:
+            fuse_options.add('%s=%s' % (name, value))
+
+    pyfuse3.init(operations, mountpoint, fuse_options)
+    try:
+        trio.run(pyfuse3.main)
+    except:
+        pyfuse3.close(unmount=True)
+        raise
+    pyfuse3.close()
@@ -0,0 +1,275 @@
+# coding: utf-8
+# photofs
+# Copyright (C) 2012-2016 Moses Palmér
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see <http://www.gnu.org/licenses/>.
+
+import hashlib
+import io
+import os
+import threading
+
+from . import _worker
+from ._image import Image
+from ._util import FileLRU, hash_inode
+
+
+# Try to import Pillow
+try:
+    import PIL.Image
+    import PIL.ImageOps
+except ImportError:
+    PIL = None
+
+
+#: A mapping from image formats that can be resized to the format in which to
+#: store the resized image
+FORMATS = {
+    'JPEG': 'JPEG',
+    'MPO': 'JPEG',
+    'PNG': 'PNG',
+    'TIFF': 'TIFF',
+    'WEBP': 'WEBP'}
+
+
+def _render(source, target, size, quality):
+    """Renders a downscaled copy of an image.
+
+    This function is run by the render worker processes.
+
+    :param source: The location of the original image, or its data.
+    :type source: str or bytes
+
+    :param str target: The location of the downscaled copy.
+
+    :param int size: The maximum width and height of the copy.
+
+    :param int quality: The quality to use for lossy formats.
+
+    :return: whether a copy was rendered; if the image format is not supported,
+        or the image is not larger than ``size``, no copy is rendered
+    :rtype: bool
+    """
+    try:
+        image = PIL.Image.open(
+            source if not isinstance(source, bytes) else io.BytesIO(source))
+    except (IOError, OSError):
+        return False
+
+    with image:
+        target_format = FORMATS.get(image.format)
+        if target_format is None or max(image.size) <= size:
+            return False
+
+        # Let the JPEG decoder scale the image while decoding
+        image.draft('RGB', (size, size))
+
+        image = PIL.ImageOps.exif_transpose(image)
+        image.thumbnail((size, size), PIL.Image.LANCZOS)
+        if target_format == 'JPEG' and image.mode not in ('RGB', 'L'):
+            image = image.convert('RGB')
+
+        temporary = '%s.%d.tmp' % (target, os.getpid())
+        image.save(temporary, target_format, quality=quality)
+        os.rename(temporary, target)
+
+    return True
+
+
+class RenderCache(object):
+    """A size bounded cache of downscaled images on disk.
+
+    Images are rendered on demand by a pool of worker processes, and the least
+    recently used images are removed when the total size exceeds the maximum
+    size.
+    """
+    def __init__(self, directory, max_size, workers=None, quality=85):
+        """Creates a render cache.
+
+        :param str directory: The directory in which to store downscaled
+            images. This is created if it does not exist.
+
+        :param int max_size: The maximum total size, in bytes, of all cached
+            images.
+
+        :param int workers: The number of render processes. If this is not
+            specified, the number of CPUs is used.
+
+        :param int quality: The quality to use for lossy formats.
+
+        :raises RuntimeError: if *Pillow* is not installed
+        """
+        if PIL is None:
+            raise RuntimeError('Resized views require Pillow')
+        self._directory = directory
+        self._workers = workers
+        self._quality = quality
+
+        self._lock = threading.Lock()
+        self._pool = None
+        self._pending = {}
+        self._originals = set()
+
+        #: The rendered images; the image most recently rendered is kept even
+        #: if it exceeds the maximum size
+        self._entries = FileLRU(directory, max_size, 1)
+
+    @staticmethod
+    def key(image, size):
+        """Generates the cache key for a downscaled image.
+
+        The key is derived from the location, or the title and timestamp if
+        the image is not file based, and the size and modification time of the
+        original image.
+
+        :param Image image: The original image.
+
+        :param int size: The maximum width and height of the downscaled image.
+
+        :return: a cache key
+        :rtype: str
+        """
+        st = image.stat
+        return hashlib.sha1((
+            u'%s\0%d\0%r\0%d' % (
+                getattr(image, 'location', None) or u'%s\0%s' % (
+                    image.title, image.timestamp.isoformat()),
+                st.st_size,
+                st.st_mtime,
+                size)).encode('utf-8')).hexdigest()
+
+    def size(self, key):
+        """Returns the size of a cached image.
+
+        :param str key: The cache key.
+
+        :return: the size of the cached image, or ``None`` if it has not been
+            rendered
+        :rtype: int or None
+        """
+        with self._lock:
+            return self._entries.get(key)
+
+    def render(self, image, size):
+        """Returns the location of a downscaled image, rendering it if
+        required.
+
+        :param Image image: The original image.
+
+        :param int size: The maximum width and height of the downscaled image.
+
+        :return: the location of the downscaled image, or ``None`` if the
+            original image should be used
+        :rtype: str or None
+        """
+        key = self.key(image, size)
+        path = os.path.join(self._directory, key)
+
+        with self._lock:
+            if self._entries.touch(key):
+                try:
+                    os.utime(path, None)
+                except OSError:
+                    pass
+                return path
+            elif key in self._originals:
+                return None
+            result = self._pending.get(key)
+
+        if result is None:
+            # Pass the data of images that are not file based to the worker
+            try:
+                source = image.location
+            except AttributeError:
+                with image.open(os.O_RDONLY) as f:
+                    source = f.read()
+
+            with self._lock:
+                result = self._pending.get(key)
+                if result is None:
+                    if self._pool is None:
+                        self._pool = _worker.pool_context().Pool(self._workers)
+                    result = self._pending[key] = self._pool.apply_async(
+                        _render,
+                        (source, path, size, self._quality))
+
+        try:
+            rendered = result.get()
+        except Exception:
+            rendered = False
+
+        with self._lock:
+            self._pending.pop(key, None)
+            if not rendered:
+                self._originals.add(key)
+                return None
+            elif key not in self._entries:
+                self._entries.add(key, os.stat(path).st_size)
+                self._entries.evict()
+
+        return path
+
+
+class ResizedImage(Image):
+    """A downscaled view of an image.
+
+    Until the image has been rendered, the size of the original image is
+    reported.
+    """
+    def __init__(self, image, size, cache):
+        """Creates a downscaled view of an image.
+
+        :param Image image: The original image.
+
+        :param int size: The maximum width and height.
+
+        :param RenderCache cache: The cache used to render the image.
+        """
+        super(ResizedImage, self).__init__(
+            image.title,
+            image.extension,
+            image.timestamp,
+            None,
+            image.is_video,
+            hash_inode(u'%d@%d' % (image.inode, size))
+            if image.inode is not None else None)
+        self._image = image
+        self._size = size
+        self._cache = cache
+
+    @property
+    def image(self):
+        """The original image."""
+        return self._image
+
+    @property
+    def size(self):
+        """The maximum width and height."""
+        return self._size
+
+    @property
+    def stat(self):
+        st = self._image.stat
+        size = self._cache.size(self._cache.key(self._image, self._size))
+        if size is None:
+            return st
+        else:
+            return os.stat_result(st[:6] + (size,) + st[7:])
+
+    def open(self, flags):
+        location = self._cache.render(self._image, self._size)
+        if location is None:
+            return self._image.open(flags)
+        else:
+            return open(location, 'rb')
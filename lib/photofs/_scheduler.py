@@ -0,0 +1,263 @@
+# coding: utf-8
+# photofs
+# Copyright (C) 2012-2016 Moses Palmér
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see <http://www.gnu.org/licenses/>.
+
+import collections
+import os
+import threading
+import time
+
+
+class _Request(object):
+    """A queued read.
+    """
+    __slots__ = ('function', 'queued', 'event', 'result', 'exception')
+
+    def __init__(self, function):
+        self.function = function
+        self.queued = time.time()
+        self.event = threading.Event()
+        self.result = None
+        self.exception = None
+
+
+class ReadScheduler(object):
+    """Performs reads in a bounded set of worker threads, prioritising
+    interactive reads over bulk reads.
+
+    A read is *interactive* if it reads the header of a file, or if the file
+    has not been read sequentially for long; other reads are *bulk* reads,
+    such as those of a video being streamed. Interactive reads are performed
+    before bulk reads, except that every ``bulk_share``:th read is a bulk read
+    if both kinds are waiting, so that streams never stall.
+
+    Within a class, files are served in turn, so a single file being read
+    quickly cannot starve other files.
+    """
+
+    #: The priority class of interactive reads
+    INTERACTIVE = 'interactive'
+
+    #: The priority class of bulk reads
+    BULK = 'bulk'
+
+    #: The priority classes, in order of priority
+    CLASSES = (INTERACTIVE, BULK)
+
+    def __init__(
+            self, workers=4, header_size=256 * 1024,
+            bulk_threshold=2 * 1024 * 1024, bulk_share=4):
+        """Creates a read scheduler.
+
+        :param int workers: The number of worker threads performing reads.
+
+        :param int header_size: Reads beginning before this offset are always
+            interactive.
+
+        :param int bulk_threshold: The number of bytes a file must have been
+            read sequentially before its reads are bulk reads.
+
+        :param int bulk_share: When both interactive and bulk reads are
+            waiting, one in this many reads is a bulk read.
+        """
+        self._workers = workers
+        self._header_size = header_size
+        self._bulk_threshold = bulk_threshold
+        self._bulk_share = bulk_share
+
+        self._condition = threading.Condition()
+        self._pid = None
+        self._picks = 0
+
+        #: A mapping from class to a mapping from file handle to queued reads;
+        #: the file handles are served in order
+        self._queues = {
+            priority: collections.OrderedDict()
+            for priority in self.CLASSES}
+
+        #: A mapping from file handle to the list ``[end, streak]``, where
+        #: ``end`` is the end offset of the last read and ``streak`` the number
+        #: of bytes read sequentially
+        self._files = {}
+
+        self._stats = {
+            priority: {
+                'reads': 0,
+                'bytes': 0,
+                'total_delay': 0.0,
+                'max_delay': 0.0}
+            for priority in self.CLASSES}
+
+    @property
+    def stats(self):
+        """Statistics about the reads of every priority class.
+
+        This is a mapping from class to a ``dict`` with the number of
+        ``reads``, the number of ``bytes`` requested, the ``mean_delay`` and
+        ``max_delay`` in seconds spent waiting in the queue, and the number of
+        currently ``queued`` reads.
+        """
+        with self._condition:
+            return {
+                priority: dict(
+                    stats,
+                    mean_delay=stats['total_delay'] / stats['reads']
+                    if stats['reads'] else 0.0,
+                    queued=sum(
+                        len(requests)
+                        for requests in self._queues[priority].values()))
+                for priority, stats in self._stats.items()}
+
+    def classify(self, fh, offset, size):
+        """Determines the priority class of a read, and records it as the last
+        read of the file.
+
+        This method must be called with the lock held.
+
+        :param int fh: The file handle.
+
+        :param int offset: The offset of the read.
+
+        :param int size: The number of bytes to read.
+
+        :return: the priority class
+        """
+        state = self._files.setdefault(fh, [0, 0])
+        end, streak = state
+        state[0] = offset + size
+        state[1] = streak + size if offset == end else 0
+
+        if offset < self._header_size or state[1] < self._bulk_threshold:
+            return self.INTERACTIVE
+        else:
+            return self.BULK
+
+    def read(self, fh, offset, size, function):
+        """Performs a read in a worker thread and waits for it to complete.
+
+        :param int fh: The file handle.
+
+        :param int offset: The offset of the read.
+
+        :param int size: The number of bytes to read.
+
+        :param function: The function performing the read. This is called
+            without arguments.
+
+        :return: the value returned by ``function``
+
+        :raises: any exception raised by ``function``
+        """
+        self._start()
+
+        request = _Request(function)
+        with self._condition:
+            priority = self.classify(fh, offset, size)
+            self._queues[priority].setdefault(fh, collections.deque()).append(
+                request)
+            self._stats[priority]['bytes'] += size
+            self._condition.notify()
+
+        request.event.wait()
+        if request.exception is not None:
+            raise request.exception
+        else:
+            return request.result
+
+    def forget(self, fh):
+        """Forgets the read history of a file.
+
+        This should be called when a file is closed.
+
+        :param int fh: The file handle.
+        """
+        with self._condition:
+            self._files.pop(fh, None)
+
+    def _start(self):
+        """Starts the worker threads unless already started in this process.
+
+        The threads are started lazily since *FUSE* may fork after the file
+        system has been created.
+        """
+        if self._pid == os.getpid():
+            return
+
+        with self._condition:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            for i in range(self._workers):
+                thread = threading.Thread(
+                    target=self._run,
+                    name='photofs-read-%d' % i)
+                thread.daemon = True
+                thread.start()
+
+    def _next(self):
+        """Removes the next read from the queues.
+
+        This method must be called with the lock held.
+
+        :return: the tuple ``(priority, request)``, or ``None`` if no reads are
+            queued
+        """
+        interactive = self._queues[self.INTERACTIVE]
+        bulk = self._queues[self.BULK]
+        if interactive and bulk:
+            self._picks += 1
+            priority = self.BULK if self._picks % self._bulk_share == 0 \
+                else self.INTERACTIVE
+        elif interactive:
+            priority = self.INTERACTIVE
+        elif bulk:
+            priority = self.BULK
+        else:
+            return None
+
+        # Serve the file that has waited the longest, and move it last if it
+        # has more reads queued
+        queue = self._queues[priority]
+        fh, requests = queue.popitem(last=False)
+        request = requests.popleft()
+        if requests:
+            queue[fh] = requests
+
+        return (priority, request)
+
+    def _run(self):
+        """The worker thread loop.
+        """
+        while True:
+            with self._condition:
+                item = self._next()
+                while item is None:
+                    self._condition.wait()
+                    item = self._next()
+
+                priority, request = item
+                delay = time.time() - request.queued
+                stats = self._stats[priority]
+                stats['reads'] += 1
+                stats['total_delay'] += delay
+                stats['max_delay'] = max(stats['max_delay'], delay)
+
+            try:
+                request.result = request.function()
+            except Exception as e:
+                request.exception = e
+            finally:
+                request.event.set()
@@ -0,0 +1,162 @@
+# coding: utf-8
+# photofs
+# Copyright (C) 2012-2016 Moses Palmér
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see <http://www.gnu.org/licenses/>.
+
+import threading
+
+
+#: The name of the top level directory containing search results
+SEARCH_DIRECTORY = '.search'
+
+
+class SearchIndex(object):
+    """A trigram index of the titles and file names of images.
+
+    Every image is a document whose text is its title followed by all names
+    under which it is presented. Every trigram of the lower case text maps to
+    the set of documents containing it, so a search only has to verify the
+    documents containing all trigrams of the search term.
+    """
+    def __init__(self):
+        #: A mapping from document key to the tuple ``(text, image)``
+        self._documents = {}
+
+        #: A mapping from trigram to the set of document keys containing it
+        self._postings = {}
+
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._documents)
+
+    @staticmethod
+    def key(image):
+        """Returns the key identifying the document of an image across
+        reloads.
+
+        :param Image image: The image.
+
+        :return: a hashable key
+        """
+        if image.inode is not None:
+            return image.inode
+        else:
+            return getattr(image, 'location', None) or id(image)
+
+    @staticmethod
+    def trigrams(text):
+        """Returns all trigrams of a string.
+
+        :param str text: The string.
+
+        :return: the trigrams
+        :rtype: set
+        """
+        return set(text[i:i + 3] for i in range(len(text) - 2))
+
+    def update(self, images):
+        """Updates this index to contain exactly a set of images.
+
+        Only the postings of added, removed and renamed images are updated.
+
+        :param images: An iterable of ``(name, image)``, where ``name`` is a
+            file name of ``image``. An image may occur more than once.
+
+        :return: the tuple ``(added, removed)`` with the number of documents
+            added and removed; a changed document is counted as both
+        """
+        names = {}
+        for name, image in images:
+            key = self.key(image)
+            try:
+                names[key][1].add(name)
+            except KeyError:
+                names[key] = (image, set((name,)))
+        previous = self._documents
+        documents = {}
+        for key, (image, image_names) in names.items():
+            # Generating titles from timestamps is expensive, so reuse the
+            # title of unchanged images
+            document = previous.get(key)
+            if document is not None and document[1] is image:
+                title = document[0].split(u'\0', 1)[0]
+            else:
+                title = image.title.lower()
+            documents[key] = (
+                u'\0'.join([title] + sorted(image_names)).lower(),
+                image)
+
+        with self._lock:
+            postings = self._postings
+            added = 0
+            removed = 0
+
+            for key, (text, image) in self._documents.items():
+                document = documents.get(key)
+                if document is not None and document[0] == text:
+                    continue
+                removed += 1
+                for trigram in self.trigrams(text):
+                    keys = postings[trigram]
+                    keys.discard(key)
+                    if not keys:
+                        del postings[trigram]
+
+            for key, (text, image) in documents.items():
+                document = self._documents.get(key)
+                if document is not None and document[0] == text:
+                    continue
+                added += 1
+                for trigram in self.trigrams(text):
+                    try:
+                        postings[trigram].add(key)
+                    except KeyError:
+                        postings[trigram] = set((key,))
+
+            self._documents = documents
+
+        return (added, removed)
+
+    def search(self, term):
+        """Finds all images whose title or file names contain a string.
+
+        The search is case insensitive.
+
+        :param str term: The string to find.
+
+        :return: the matching images
+        :rtype: [Image]
+        """
+        term = term.lower()
+        with self._lock:
+            documents = self._documents
+            if len(term) < 3:
+                candidates = documents
+            else:
+                # Intersect the smallest sets first
+                try:
+                    postings = sorted(
+                        (self._postings[trigram]
+                            for trigram in self.trigrams(term)),
+                        key=len)
+                except KeyError:
+                    return []
+                candidates = postings[0].intersection(*postings[1:])
+
+            return [
+                documents[key][1]
+                for key in candidates
+                if term in documents[key][0]]
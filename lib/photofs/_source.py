@@ -16,12 +16,24 @@
 # You should have received a copy of the GNU General Public License along with
 # this program. If not, see <http://www.gnu.org/licenses/>.
 
+import argparse
+import logging
 import os
+import threading
+import time
 
+from multiprocessing.pool import ThreadPool
+
+from . import _worker
+from ._image import Image
+from ._profile import PhaseTimer
 from ._util import make_unique
 from ._tag import Tag
 
 
+log = logging.getLogger(__name__)
+
+
 class ImageSource(dict):
     """A source of images and tags.
 
@@ -30,6 +42,10 @@ class ImageSource(dict):
     #: A mapping of all registered sources by name to implementing classes
     SOURCES = {}
 
+    #: The number of bits of inode numbers available to a single image source;
+    #: the bits above are used for the inode namespace of the source
+    INODE_BITS = 48
+
     @classmethod
     def add_arguments(self, argparser):
         """Adds all command line arguments for this image source to an argument
@@ -40,6 +56,20 @@ class ImageSource(dict):
         """
         pass
 
+    @classmethod
+    def argument_names(self):
+        """Returns the names of the keyword arguments corresponding to the
+        command line arguments added by :meth:`add_arguments`.
+
+        :return: the argument names
+        :rtype: set(str)
+        """
+        argparser = argparse.ArgumentParser(
+            add_help=False,
+            conflict_handler='resolve')
+        self.add_arguments(argparser)
+        return set(vars(argparser.parse_args([])))
+
     @classmethod
     def register(self, name):
         """A decorator that registers an :class:`ImageSource` subclass as an
@@ -123,22 +153,35 @@ class ImageSource(dict):
         segments = self._break_path(path)
 
         # Create all tags
-        current = self
+        root = self._root
+        current = root
         for segment in segments:
             if segment not in current:
-                tag = Tag(segment, current if current != self else None)
-                if current == self:
+                tag = Tag(segment, current if current is not root else None)
+                if current is root:
                     # If the tag does not exist, and this is a root tag
-                    # (current == self => this is the first iteration), add the
-                    # tag to self; the parent parameter to Tag above will
+                    # (current == root => this is the first iteration), add the
+                    # tag to root; the parent parameter to Tag above will
                     # handle other cases
-                    self[segment] = tag
+                    root[segment] = tag
                 current = tag
             else:
                 current = current[segment]
 
         return current
 
+    def _replace(self, tags):
+        """Replaces all root tags.
+
+        The new tags are added before any stale root tags are removed, so a
+        concurrent lookup never sees an empty source.
+
+        :param dict tags: A mapping from name to root tag.
+        """
+        self.update(tags)
+        for name in [name for name in self if name not in tags]:
+            del self[name]
+
     def __init__(self, **kwargs):
         """Creates a new ImageSource.
 
@@ -150,6 +193,79 @@ class ImageSource(dict):
                 'Unsupported command line argument: %s',
                 ', '.join(k for k in kwargs))
         super(ImageSource, self).__init__()
+        self._generation = 0
+        self._inode_namespace = 0
+
+        #: The mapping to which :meth:`_make_tags` adds root tags; this is the
+        #: source itself, except while a new tree is built by :meth:`reload`
+        self._root = self
+
+    @property
+    def generation(self):
+        """A counter incremented every time the images and tags of this source
+        are reloaded."""
+        return self._generation
+
+    @property
+    def views(self):
+        """Additional top level directories presented by this source.
+
+        This is a mapping from name to :class:`Tag`. Views are not affected by
+        filters, and are not part of the tag tree of this source. This
+        implementation returns an empty mapping.
+        """
+        return {}
+
+    @property
+    def inode_namespace(self):
+        """The namespace of the inode numbers generated by :meth:`make_inode`.
+
+        When several image sources are combined, every source is assigned a
+        unique namespace.
+        """
+        return self._inode_namespace
+
+    @inode_namespace.setter
+    def inode_namespace(self, value):
+        self._inode_namespace = value
+
+    def make_inode(self, value):
+        """Generates a stable inode number for an image.
+
+        :param int value: A value uniquely identifying the image within this
+            source, such as a database ID. Only the lowest
+            :attr:`INODE_BITS` bits are used.
+
+        :return: an inode number
+        :rtype: int
+        """
+        return (self._inode_namespace << self.INODE_BITS) | (
+            value & ((1 << self.INODE_BITS) - 1))
+
+    def refresh(self):
+        """Reloads all images and tags if the backend has changed.
+
+        This is called by :meth:`locate`. The default implementation does
+        nothing.
+        """
+        pass
+
+    def images(self):
+        """Iterates over all images in this source.
+
+        An image with several tags is yielded once for every tag.
+
+        :return: an iterator of ``(path, image)``, where ``path`` is the
+            absolute path of the image in this source
+        """
+        stack = [(os.path.sep, self)]
+        while stack:
+            path, tag = stack.pop()
+            for name, item in list(tag.items()):
+                if isinstance(item, Image):
+                    yield (path + name, item)
+                else:
+                    stack.append((path + name + os.path.sep, item))
 
     def locate(self, path):
         """Locates an image or tag.
@@ -165,6 +281,7 @@ class ImageSource(dict):
 
         :raises ValueError: if path does not begin with os.path.sep
         """
+        self.refresh()
         segments = self._break_path(path)
 
         # Locate the last item
@@ -180,6 +297,10 @@ class FileBasedImageSource(ImageSource):
 
     This is an abstract class.
     """
+    #: The names of attributes updated by :meth:`load_tags` that must be
+    #: transferred back when loading in a worker process
+    WORKER_STATE = ()
+
     @classmethod
     def add_arguments(self, argparser):
         """Adds all command line arguments for this image source to an argument
@@ -190,10 +311,18 @@ class FileBasedImageSource(ImageSource):
         """
         argparser.add_argument(
             '--database',
-            help='The database file to use. If not specified, the default one '
-            'is used.')
+            help='The database file, or the root directory for directory '
+            'based sources, to use. If not specified, the default one is '
+            'used.')
+
+        argparser.add_argument(
+            '--load-in-worker',
+            help='Load images and tags in a separate process. This keeps the '
+            'file system responsive while a large library is reloaded.',
+            action='store_true',
+            default=None)
 
-    def __init__(self, database=None, **kwargs):
+    def __init__(self, database=None, load_in_worker=False, **kwargs):
         """Creates a new ImageSource.
 
         :param str database: The path to the backend database or directory for
@@ -201,21 +330,39 @@ class FileBasedImageSource(ImageSource):
             be a valid file name. Its timestamp is used to determine whether to
             actually reload all images and tags. If this is not provided, a
             default location is used.
+
+        :param bool load_in_worker: Whether to call :meth:`load_tags` in a
+            worker process. If this is ``True``, the tag tree is built in a
+            child process and then transferred back, and the current tree is
+            kept until the new one is ready.
         """
         super(FileBasedImageSource, self).__init__(**kwargs)
         self._path = database or self.default_location
         if self._path is None:
             raise ValueError('No database')
         self._timestamp = 0
+        self._load_in_worker = load_in_worker
+        self._stats = {
+            'reloads': 0,
+            'last_reload': None,
+            'last_duration': None,
+            'total_duration': 0.0,
+            'phases': {}}
+
+        #: The timer of the phases of the current or last call to
+        #: :meth:`load_tags`
+        self._timer = PhaseTimer()
 
     def load_tags(self):
         """Loads the tags from the backend resource.
 
         This function is called by refresh if the timestamp of the backend
-        resource has changed.
+        resource has changed. Implementations should record the time spent in
+        their phases using :attr:`_timer`.
 
-        :return: a list of tags with the images attached
-        :rtype: [Tag]
+        :return: ``False`` if the backend resource turned out to be unchanged,
+            in which case the tags added are discarded and the current tags
+            are kept
         """
         raise NotImplementedError()
 
@@ -239,6 +386,18 @@ class FileBasedImageSource(ImageSource):
         """The timestamp when the backend resource was last modified."""
         return self._timestamp
 
+    @property
+    def stats(self):
+        """Statistics about reloads of this source.
+
+        This is a ``dict`` with the number of ``reloads``, the time of the
+        ``last_reload``, the ``last_duration`` of a reload and the
+        ``total_duration`` of all reloads, and the ``phases`` of the last
+        reload, a mapping from phase name to the number of seconds spent in
+        it.
+        """
+        return dict(self._stats)
+
     def refresh(self):
         """Reloads all images and tags from the backend resource if it has
         changed since the last update.
@@ -246,8 +405,8 @@ class FileBasedImageSource(ImageSource):
         If the last modification time of :attr:`path` has changed, the backend
         resource is considered to be changed as well.
 
-        In this case, the internal timestamp is updated and :meth:`load_tags`
-        is called.
+        In this case, the internal timestamp is updated and :meth:`reload` is
+        called.
         """
         # Check the timestamp
         if self.path:
@@ -256,10 +415,178 @@ class FileBasedImageSource(ImageSource):
                 return
             self._timestamp = timestamp
 
-        # Release the old data and reload the tags
-        self.clear()
-        self.load_tags()
+        self.reload()
 
-    def locate(self, path):
-        self.refresh()
-        return super(FileBasedImageSource, self).locate(path)
+    def reload(self):
+        """Unconditionally reloads all images and tags from the backend
+        resource.
+
+        The new tree is built either in a worker process or in a separate
+        mapping, and the root tags are replaced once it is complete, so
+        concurrent lookups keep using the current tree meanwhile.
+        """
+        start = time.time()
+        self._timer = PhaseTimer()
+        if self._load_in_worker:
+            result = _worker.load(self)
+            if result is None:
+                return
+            tags, state = result
+            for name, value in state.items():
+                setattr(self, name, value)
+            self._replace(tags)
+
+        else:
+            self._root = {}
+            try:
+                changed = self.load_tags()
+                tags = self._root
+            finally:
+                self._root = self
+            if changed is False:
+                return
+            self._replace(tags)
+
+        duration = time.time() - start
+        self._generation += 1
+        self._stats['reloads'] += 1
+        self._stats['last_reload'] = start
+        self._stats['last_duration'] = duration
+        self._stats['total_duration'] += duration
+        self._stats['phases'] = self._timer.phases
+        log.info('Reloaded %s in %.3f s', self.path, duration)
+
+
+class CompositeImageSource(ImageSource):
+    """A source of images and tags combining several image sources.
+
+    The sources are presented either as separate top level directories named
+    after the sources, or with their tag trees merged. All sources are
+    refreshed in parallel.
+    """
+    def __init__(self, sources, merge=False, **kwargs):
+        """Creates a new composite image source.
+
+        :param dict sources: A mapping from name to image source.
+
+        :param bool merge: Whether to merge the tags of all sources. If this is
+            ``False``, every source is presented as a directory named after
+            the source.
+        """
+        super(CompositeImageSource, self).__init__(**kwargs)
+        self._sources = sources
+        for index, name in enumerate(sorted(sources)):
+            sources[name].inode_namespace = index + 1
+        self._merge = merge
+        self._generations = {}
+        self._lock = threading.Lock()
+        self._pool = None
+
+    @property
+    def sources(self):
+        """The mapping from name to image source."""
+        return self._sources
+
+    @property
+    def views(self):
+        """The views of all sources, if the tags of the sources are merged.
+
+        Views with the same name in several sources are given unique names. If
+        the sources are presented as separate directories, the views of every
+        source are instead added to the directory of the source.
+        """
+        result = {}
+        if not self._merge:
+            return result
+        for name in sorted(self._sources):
+            for view_name, view in sorted(self._sources[name].views.items()):
+                result[make_unique(
+                    result, view_name, '%s', '%s (%d)')] = view
+        return result
+
+    @property
+    def stats(self):
+        """A mapping from source name to the reload statistics of that
+        source."""
+        return {
+            name: getattr(source, 'stats', {})
+            for name, source in self._sources.items()}
+
+    def _refresh_source(self, name):
+        """Refreshes a single source.
+
+        Failures are logged, and the source keeps its previous tags.
+
+        :param str name: The name of the source.
+        """
+        try:
+            self._sources[name].refresh()
+        except Exception:
+            log.exception('Failed to refresh source %s', name)
+
+    def _merge_tags(self, target, items):
+        """Recursively merges tags and images into a tag.
+
+        Tags with the same name are merged, and images are added with unique
+        names.
+
+        :param Tag target: The tag into which to merge ``items``.
+
+        :param dict items: The tags and images to merge.
+        """
+        for name, item in items.items():
+            if isinstance(item, Tag):
+                existing = target.get(name)
+                if not isinstance(existing, Tag):
+                    existing = Tag(name, target)
+                self._merge_tags(existing, item)
+            else:
+                target.add(item)
+
+    def refresh(self):
+        """Refreshes all sources in parallel, and rebuilds the root tags if
+        any source was reloaded.
+
+        If another thread is already refreshing this source, this method
+        returns immediately, and the current tags are kept.
+        """
+        if not self._lock.acquire(False):
+            return
+
+        try:
+            if self._pool is None:
+                self._pool = ThreadPool(len(self._sources))
+            self._pool.map(self._refresh_source, list(self._sources))
+
+            generations = {
+                name: source.generation
+                for name, source in self._sources.items()}
+            if generations == self._generations:
+                return
+            self._generations = generations
+
+            tags = {}
+            for name, source in sorted(self._sources.items()):
+                if self._merge:
+                    for key, item in source.items():
+                        if isinstance(item, Tag):
+                            tag = tags.get(key)
+                            if not isinstance(tag, Tag):
+                                tag = tags[key] = Tag(key)
+                            self._merge_tags(tag, item)
+                        else:
+                            tags[self._make_unique(
+                                tags, *os.path.splitext(key))] = item
+                else:
+                    tag = Tag(name)
+                    for key, item in source.items():
+                        tag[key] = item
+                    for key, view in sorted(source.views.items()):
+                        tag[make_unique(tag, key, '%s', '%s (%d)')] = view
+                    tags[name] = tag
+
+            self._replace(tags)
+            self._generation += 1
+
+        finally:
+            self._lock.release()
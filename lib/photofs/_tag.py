@@ -75,7 +75,7 @@ class Tag(dict):
         self._has_image = False
 
         # Make sure to add ourselves to the parent tag if specified
-        if parent:
+        if parent is not None:
             parent.add(self)
 
     @property
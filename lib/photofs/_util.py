@@ -16,6 +16,32 @@
 # You should have received a copy of the GNU General Public License along with
 # this program. If not, see <http://www.gnu.org/licenses/>.
 
+import collections
+import hashlib
+import os
+import threading
+
+
+#: The bit set in all inode numbers generated by :func:`hash_inode`; inode
+#: numbers generated by image sources never have this bit set
+HASHED_INODE = 1 << 62
+
+
+def hash_inode(*parts):
+    """Generates an inode number from a hash of strings.
+
+    The inode number has :attr:`HASHED_INODE` set, so it does not collide with
+    inode numbers generated by image sources.
+
+    :param parts: The strings identifying the item, for example its path.
+
+    :return: an inode number
+    :rtype: int
+    """
+    return HASHED_INODE | int(
+        hashlib.sha1(u'\0'.join(parts).encode('utf-8')).hexdigest()[:15],
+        16)
+
 
 def make_unique(mapping, base_name, format_1, format_n, *args):
     """Creates a unique key in a ``dict``.
@@ -44,3 +70,166 @@ def make_unique(mapping, base_name, format_1, format_n, *args):
         key = format_n % ((base_name, i) + args)
 
     return key
+
+
+class NegativeCache(object):
+    """A set of paths known not to exist in one generation of an image source.
+
+    The set is cleared when a path is added for a new generation, or when it
+    grows beyond its maximum size.
+    """
+    def __init__(self, max_size=65536):
+        """Creates a negative cache.
+
+        :param int max_size: The maximum number of paths to remember.
+        """
+        self._max_size = max_size
+        self._generation = None
+        self._paths = set()
+        self._lock = threading.Lock()
+        self._stats = {
+            'hits': 0,
+            'misses': 0}
+
+    @property
+    def stats(self):
+        """Statistics about this cache.
+
+        This is a ``dict`` with the number of ``hits`` and ``misses``, and the
+        number of paths currently remembered as ``size``.
+        """
+        with self._lock:
+            return dict(self._stats, size=len(self._paths))
+
+    def contains(self, path, generation):
+        """Returns whether a path is known not to exist.
+
+        :param str path: The path.
+
+        :param generation: The current generation of the image source.
+
+        :return: whether the path has been added for ``generation``
+        :rtype: bool
+        """
+        with self._lock:
+            if generation == self._generation and path in self._paths:
+                self._stats['hits'] += 1
+                return True
+            else:
+                self._stats['misses'] += 1
+                return False
+
+    def add(self, path, generation):
+        """Remembers that a path does not exist.
+
+        :param str path: The path.
+
+        :param generation: The current generation of the image source.
+        """
+        with self._lock:
+            if generation != self._generation \
+                    or len(self._paths) >= self._max_size:
+                self._paths = set()
+                self._generation = generation
+            self._paths.add(path)
+
+
+class FileLRU(object):
+    """The files of a cache directory, in order of last use.
+
+    The files present when created are loaded in order of modification time,
+    and temporary files, with the extension ``.tmp``, are removed. The least
+    recently used files are removed by :meth:`evict` when their total size
+    exceeds the maximum size.
+
+    This class is not thread safe; the owner must serialise all calls.
+    """
+    def __init__(self, directory, max_size, minimum=0):
+        """Creates the list of files in a cache directory.
+
+        :param str directory: The cache directory. This is created if it does
+            not exist.
+
+        :param int max_size: The maximum total size, in bytes, of all files.
+
+        :param int minimum: The number of most recently used files never
+            removed by :meth:`evict`.
+        """
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        self._directory = directory
+        self._max_size = max_size
+        self._minimum = minimum
+
+        #: A mapping from file name to size, in order of last use
+        self._entries = collections.OrderedDict()
+        entries = []
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            if name.endswith('.tmp'):
+                os.unlink(path)
+                continue
+            st = os.stat(path)
+            entries.append((st.st_mtime, name, st.st_size))
+        for mtime, name, size in sorted(entries):
+            self._entries[name] = size
+        self.size = sum(self._entries.values())
+
+    def __contains__(self, name):
+        return name in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, name):
+        """Returns the size of a file.
+
+        :param str name: The name of the file.
+
+        :return: the size of the file, or ``None`` if it is not present
+        :rtype: int or None
+        """
+        return self._entries.get(name)
+
+    def touch(self, name):
+        """Marks a file as most recently used.
+
+        :param str name: The name of the file.
+
+        :return: whether the file is present
+        :rtype: bool
+        """
+        if name not in self._entries:
+            return False
+        self._entries[name] = self._entries.pop(name)
+        return True
+
+    def add(self, name, size):
+        """Adds or replaces a file as the most recently used one.
+
+        :param str name: The name of the file.
+
+        :param int size: The size of the file.
+        """
+        self.size += size - self._entries.pop(name, 0)
+        self._entries[name] = size
+
+    def evict(self):
+        """Removes the least recently used files until the total size is
+        within the maximum size.
+
+        :return: the number of files removed
+        :rtype: int
+        """
+        count = 0
+        while self.size > self._max_size \
+                and len(self._entries) > self._minimum:
+            name, size = self._entries.popitem(last=False)
+            self.size -= size
+            count += 1
+            try:
+                os.unlink(os.path.join(self._directory, name))
+            except OSError:
+                pass
+        return count
@@ -0,0 +1,267 @@
+# coding: utf-8
+# photofs
+# Copyright (C) 2012-2016 Moses Palmér
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see <http://www.gnu.org/licenses/>.
+
+import gc
+import io
+import multiprocessing
+import pickle
+
+from ._image import Image
+
+
+#: The number of images transferred in every message from a worker process
+CHUNK_SIZE = 1024
+
+#: The number of seconds between checks that a worker process is still alive
+POLL_INTERVAL = 1.0
+
+#: The maximum number of seconds to wait for a message from a worker process
+TIMEOUT = 600.0
+
+
+def context():
+    """Returns the *multiprocessing* context used to start workers.
+
+    Workers are forked, so that they inherit the state of the parent process
+    instead of requiring it to be picklable.
+
+    :return: a multiprocessing context
+    """
+    try:
+        return multiprocessing.get_context('fork')
+    except AttributeError:
+        return multiprocessing
+
+
+def pool_context():
+    """Returns the *multiprocessing* context used to start pools of worker
+    processes.
+
+    Unlike the workers started by :func:`load`, pool processes are not forked
+    from this process, since it runs the threads serving requests; they are
+    started by a fork server where supported, and spawned otherwise. All
+    arguments passed to them must therefore be picklable.
+
+    :return: a multiprocessing context
+    """
+    try:
+        methods = multiprocessing.get_all_start_methods()
+    except AttributeError:
+        return multiprocessing
+    return multiprocessing.get_context(
+        'forkserver' if 'forkserver' in methods else 'spawn')
+
+
+class _Pickler(pickle.Pickler):
+    """A pickler replacing all images with their indices in :attr:`images`.
+    """
+    def __init__(self, f):
+        pickle.Pickler.__init__(self, f, pickle.HIGHEST_PROTOCOL)
+        self.images = []
+        self._indices = {}
+
+    def persistent_id(self, obj):
+        if not isinstance(obj, Image):
+            return None
+        index = self._indices.get(id(obj))
+        if index is None:
+            index = self._indices[id(obj)] = len(self.images)
+            self.images.append(obj)
+        return index
+
+
+class _Unpickler(pickle.Unpickler):
+    """An unpickler resolving the image indices written by :class:`_Pickler`.
+    """
+    def __init__(self, f, images):
+        pickle.Unpickler.__init__(self, f)
+        self._images = images
+
+    def persistent_load(self, pid):
+        return self._images[pid]
+
+
+def _run(source, writer):
+    """The entry point of the worker process.
+
+    This function loads all tags into the copy of ``source`` inherited by the
+    worker process, and writes the root tags, the attributes named by
+    ``source.WORKER_STATE`` and the phase timer of the load to ``writer``.
+
+    The first message is the pickled tuple ``(success, value)``, where
+    ``value`` is the number of image messages that follow if ``success``, or
+    ``None`` if the source is unchanged, and an error message otherwise. The
+    images are sent in lists of at most :attr:`CHUNK_SIZE`, followed by the
+    tree, in which images are replaced by their indices.
+
+    :param ImageSource source: The image source to load.
+
+    :param writer: The writing end of the pipe back to the parent process.
+    """
+    # Only the calling thread exists in this process, so any lock held by
+    # another thread of the parent at the time of the fork remains locked, and
+    # the loader must not wait for such a lock. ShotwellSource holds its own
+    # lock in the calling thread; the file based sources take no lock while
+    # loading, and create new thread pools in this process. Database
+    # connections are reopened after a fork, CPython reinitialises the
+    # interpreter and logging locks, and the process exits through
+    # multiprocessing without running any cleanup of the parent, such as
+    # unmounting. Locks inside libraries, such as the mutexes of SQLite, may
+    # however have been held by other threads when forking, for example while
+    # serving requests or refreshing the other sources of a
+    # CompositeImageSource; load therefore gives up on a worker that stops
+    # responding
+    f = io.BytesIO()
+    try:
+        source.clear()
+        if source.load_tags() is False:
+            header = (True, None)
+        else:
+            pickler = _Pickler(f)
+            pickler.dump((
+                dict(source),
+                {
+                    name: getattr(source, name)
+                    for name in source.WORKER_STATE + ('_timer',)}))
+            chunks = [
+                pickler.images[i:i + CHUNK_SIZE]
+                for i in range(0, len(pickler.images), CHUNK_SIZE)]
+            header = (True, len(chunks))
+    except Exception as e:
+        try:
+            header = (False, e.args[0] % e.args[1:])
+        except:
+            header = (False, str(e))
+
+    writer.send_bytes(pickle.dumps(header, pickle.HIGHEST_PROTOCOL))
+    if header[0] and header[1] is not None:
+        for chunk in chunks:
+            writer.send_bytes(pickle.dumps(chunk, pickle.HIGHEST_PROTOCOL))
+        writer.send_bytes(f.getvalue())
+    writer.close()
+
+
+def _receive(reader, process):
+    """Receives a message from a worker process.
+
+    :param reader: The reading end of the pipe from the worker process.
+
+    :param process: The worker process.
+
+    :return: the message
+    :rtype: bytes
+
+    :raises RuntimeError: if the worker process exits, or does not send a
+        message within :attr:`TIMEOUT` seconds
+    """
+    waited = 0.0
+    while not reader.poll(POLL_INTERVAL):
+        waited += POLL_INTERVAL
+        if not process.is_alive():
+            raise RuntimeError(
+                'The worker process terminated with exit code %s',
+                process.exitcode)
+        elif waited >= TIMEOUT:
+            raise RuntimeError(
+                'The worker process did not respond in %d seconds',
+                TIMEOUT)
+    return reader.recv_bytes()
+
+
+def _loads(data, images=None):
+    """Unpickles a message from a worker process.
+
+    Automatic garbage collection is suspended meanwhile, since every full
+    collection traverses the entire heap, and the many new objects would
+    otherwise trigger it repeatedly.
+
+    :param bytes data: The message.
+
+    :param list images: The images referenced by the message, if it is the
+        tree written by :class:`_Pickler`.
+
+    :return: the unpickled value
+    """
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        if images is None:
+            return pickle.loads(data)
+        else:
+            return _Unpickler(io.BytesIO(data), images).load()
+    finally:
+        if enabled:
+            gc.enable()
+
+
+def load(source):
+    """Loads the tags of an image source in a worker process.
+
+    The tag tree is built by calling ``source.load_tags()`` in a forked child
+    process, and is then transferred back in pickled form. While waiting for
+    the child, the calling thread does not hold the global interpreter lock,
+    so other threads may keep serving requests from the current tree.
+
+    Unpickling holds the global interpreter lock, so the images are received
+    and unpickled in chunks, and the tree referencing them is unpickled last;
+    the interpreter may switch threads between chunks, and whenever an image
+    reference in the tree is resolved. If the worker process exits or stops
+    responding, it is terminated and the current tree is kept.
+
+    :param ImageSource source: The image source to load. This instance is not
+        modified.
+
+    :return: the tuple ``(tags, state)``, where ``tags`` is a mapping from
+        name to root tag and ``state`` is a mapping from the attribute names in
+        ``source.WORKER_STATE``, and ``'_timer'``, to their values in the
+        worker process, or ``None`` if the source is unchanged
+    :rtype: (dict, dict) or None
+
+    :raises RuntimeError: if the worker fails to load the tags, exits or
+        stops responding
+    """
+    reader, writer = context().Pipe(False)
+    process = context().Process(target=_run, args=(source, writer))
+    process.daemon = True
+    process.start()
+    writer.close()
+
+    try:
+        success, value = _loads(_receive(reader, process))
+        if not success:
+            raise RuntimeError(
+                'Failed to load tags in worker process: %s',
+                value)
+        elif value is None:
+            return None
+
+        images = []
+        for _ in range(value):
+            images.extend(_loads(_receive(reader, process)))
+        return _loads(_receive(reader, process), images)
+
+    except EOFError:
+        process.join()
+        raise RuntimeError(
+            'The worker process terminated with exit code %s',
+            process.exitcode)
+
+    finally:
+        reader.close()
+        if process.is_alive():
+            process.terminate()
+        process.join()
@@ -0,0 +1,497 @@
+# coding: utf-8
+# photofs
+# Copyright (C) 2012-2016 Moses Palmér
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see <http://www.gnu.org/licenses/>.
+
+import hashlib
+import mimetypes
+import os
+import pickle
+import re
+import time
+
+from multiprocessing.pool import ThreadPool
+from xml.etree import ElementTree
+
+from xdg.BaseDirectory import save_cache_path
+
+from photofs._image import FileBasedImage
+from photofs._source import ImageSource, FileBasedImageSource
+
+
+#: The XML name of a flat XMP keyword list
+XMP_SUBJECT = '{http://purl.org/dc/elements/1.1/}subject'
+
+#: The XML name of a hierarchial XMP keyword list
+XMP_HIERARCHICAL_SUBJECT = \
+    '{http://ns.adobe.com/lightroom/1.0/}hierarchicalSubject'
+
+#: The XML name of an item in an XMP keyword list
+XMP_ITEM = '{http://www.w3.org/1999/02/22-rdf-syntax-ns#}li'
+
+
+def keyword_path(keyword):
+    """Converts a keyword to the path of a tag.
+
+    Both ``'|'`` and ``'/'`` separate the parts of the path. Empty parts, and
+    the parts ``'.'`` and ``'..'``, are removed.
+
+    :param str keyword: The keyword.
+
+    :return: the path, without a leading separator; this is empty if no valid
+        parts remain
+    :rtype: str
+    """
+    return '/'.join(
+        part
+        for part in (part.strip() for part in re.split(r'[|/]', keyword))
+        if part and part not in (os.path.curdir, os.path.pardir))
+
+
+def xmp_keywords(data):
+    """Extracts the keywords from an XMP packet.
+
+    Hierarchial keywords, on the form ``'Parent|Child'``, are returned as
+    ``'Parent/Child'``. Flat keywords that are the leaf of a hierarchial
+    keyword are not returned. Forward slashes in keywords are treated as
+    hierarchy separators as well.
+
+    :param bytes data: The XMP packet.
+
+    :return: a list of keywords
+    :rtype: [str]
+
+    :raises ValueError: if ``data`` is not a valid XMP packet
+    """
+    try:
+        root = ElementTree.fromstring(data)
+    except ElementTree.ParseError as e:
+        raise ValueError('Invalid XMP data: %s', str(e))
+
+    def items(name):
+        return [
+            keyword
+            for keyword in (
+                keyword_path(item.text or '')
+                for element in root.iter(name)
+                for item in element.iter(XMP_ITEM))
+            if keyword]
+
+    hierarchial = items(XMP_HIERARCHICAL_SUBJECT)
+    leaves = set(keyword.rsplit('/', 1)[-1] for keyword in hierarchial)
+
+    return hierarchial + [
+        keyword
+        for keyword in items(XMP_SUBJECT)
+        if keyword not in leaves]
+
+
+def is_media(name):
+    """Returns whether a file name denotes an image or a video.
+
+    :param str name: The file name.
+
+    :rtype: bool
+    """
+    mime, encoding = mimetypes.guess_type(name)
+    return bool(mime) and (
+        mime.startswith('image/') or
+        mime.startswith('video/'))
+
+
+@ImageSource.register('directory')
+class DirectorySource(FileBasedImageSource):
+    """Loads images and videos from a directory tree.
+
+    Every directory beneath the root directory is presented as a tag containing
+    the images and videos in it. Files directly in the root directory, and
+    hidden files and directories, are not presented.
+
+    The result of every scan is stored in a persistent cache. When rescanning,
+    the files of a directory are only listed again if the modification time of
+    the directory has changed.
+    """
+    WORKER_STATE = ('_cache',)
+
+    #: The version of the cache file format
+    CACHE_VERSION = 1
+
+    @classmethod
+    def add_arguments(self, argparser):
+        super(DirectorySource, self).add_arguments(argparser)
+
+        argparser.add_argument(
+            '--xmp-keywords',
+            help='Read keywords from XMP sidecar files when using a directory '
+            'source, and present them as tags.',
+            action='store_true',
+            default=None)
+
+        argparser.add_argument(
+            '--scan-workers',
+            help='The number of threads used to scan directories.',
+            type=int)
+
+        argparser.add_argument(
+            '--scan-cache',
+            help='The file in which to store the directory scan cache.')
+
+        argparser.add_argument(
+            '--rescan-interval',
+            help='The minimum number of seconds between checks for modified '
+            'directories.',
+            type=float)
+
+    def __init__(
+            self,
+            xmp_keywords=False,
+            scan_workers=8,
+            scan_cache=None,
+            rescan_interval=10.0,
+            **kwargs):
+        """Creates a new directory source.
+
+        :param bool xmp_keywords: Whether to read keywords from XMP sidecar
+            files. Keywords are presented as root tags.
+
+        :param int scan_workers: The number of threads used to scan
+            directories.
+
+        :param str scan_cache: The file in which to store the scan cache. If
+            this is not specified, a file in the *XDG* cache directory is used.
+
+        :param float rescan_interval: The minimum number of seconds between
+            checks for modified directories.
+        """
+        super(DirectorySource, self).__init__(**kwargs)
+        self._path = os.path.abspath(self._path)
+        self._xmp_keywords = xmp_keywords
+        self._scan_workers = scan_workers
+        self._scan_cache = scan_cache or os.path.join(
+            save_cache_path('photofs'),
+            '%s-%s.pickle' % (
+                self.__class__.__name__.lower(),
+                hashlib.sha1(self._path.encode('utf-8')).hexdigest()))
+        self._rescan_interval = rescan_interval
+        self._checked = None
+        self._cache = None
+        self._pool = None
+        self._pool_pid = None
+
+    @property
+    def default_location(self):
+        """The *Pictures* directory of the current user, if it exists.
+
+        :return: the location of the directory, or ``None`` if it does not
+            exist
+        :rtype: str or None
+        """
+        result = os.path.expanduser(os.path.join('~', 'Pictures'))
+        if os.path.isdir(result):
+            return result
+
+    @property
+    def pool(self):
+        """The thread pool used to scan directories.
+
+        A new pool is created in a worker process, since the threads of a pool
+        are not inherited.
+        """
+        if self._pool is None or self._pool_pid != os.getpid():
+            self._pool = ThreadPool(self._scan_workers)
+            self._pool_pid = os.getpid()
+        return self._pool
+
+    def _load_cache(self):
+        """Reads the persistent scan cache.
+
+        :return: a mapping from directory path to cache entry
+        :rtype: dict
+        """
+        try:
+            with open(self._scan_cache, 'rb') as f:
+                version, cache = pickle.load(f)
+            if version == self.CACHE_VERSION:
+                return cache
+        except Exception:
+            pass
+
+        return {}
+
+    def _save_cache(self, cache):
+        """Writes the persistent scan cache.
+
+        The cache is written to a temporary file which then replaces the
+        previous cache file.
+
+        :param dict cache: The scan cache.
+        """
+        temporary = '%s.%d' % (self._scan_cache, os.getpid())
+        try:
+            with open(temporary, 'wb') as f:
+                pickle.dump(
+                    (self.CACHE_VERSION, cache),
+                    f,
+                    pickle.HIGHEST_PROTOCOL)
+            os.rename(temporary, self._scan_cache)
+        except OSError:
+            # The cache is only an optimisation
+            pass
+
+    def _keywords(self, path, name, names):
+        """Reads the keywords for a file from its XMP sidecar file.
+
+        :param str path: The directory containing the file.
+
+        :param str name: The name of the file.
+
+        :param set names: The names of all files in the directory.
+
+        :return: a list of keywords
+        :rtype: [str]
+        """
+        for sidecar in (
+                name + '.xmp',
+                name + '.XMP',
+                os.path.splitext(name)[0] + '.xmp',
+                os.path.splitext(name)[0] + '.XMP'):
+            if sidecar in names:
+                try:
+                    with open(os.path.join(path, sidecar), 'rb') as f:
+                        return xmp_keywords(f.read())
+                except (OSError, ValueError):
+                    return []
+
+        return []
+
+    def _scan_directory(self, path, mtime):
+        """Lists the files and subdirectories of a directory.
+
+        :param str path: The directory to list.
+
+        :param float mtime: The modification time of ``path``.
+
+        :return: the cache entry ``(mtime, files, directories)``, where
+            ``files`` is a list of ``(name, st, keywords)``
+        """
+        files = []
+        directories = []
+        entries = [
+            entry
+            for entry in os.scandir(path)
+            if entry.name[0] != '.']
+        names = set(entry.name for entry in entries)
+
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    directories.append(entry.name)
+                elif entry.is_file() and is_media(entry.name):
+                    files.append((
+                        entry.name,
+                        entry.stat(follow_symlinks=False),
+                        self._keywords(path, entry.name, names)
+                        if self._xmp_keywords else []))
+            except OSError:
+                # Ignore files removed while scanning
+                pass
+
+        return (mtime, files, directories)
+
+    def _unchanged(self, path, mtime, entry):
+        """Returns whether a directory and its files are unchanged since it
+        was listed.
+
+        Files modified in place do not update the modification time of their
+        directory, so the ``lstat`` value of every file is checked as well.
+        Sidecar files are not checked.
+
+        :param str path: The directory to check.
+
+        :param float mtime: The current modification time of ``path``.
+
+        :param entry: The current cache entry for ``path``.
+
+        :rtype: bool
+        """
+        if mtime != entry[0]:
+            return False
+        for name, st, _ in entry[1]:
+            try:
+                current = os.lstat(os.path.join(path, name))
+            except OSError:
+                return False
+            if (current.st_mtime, current.st_size) != (
+                    st.st_mtime, st.st_size):
+                return False
+        return True
+
+    def _scan_entry(self, args):
+        """Returns the cache entry for a directory.
+
+        The directory is only listed if it or any file in it has been modified
+        since its current cache entry was made.
+
+        :param args: The tuple ``(path, entry)``, where ``entry`` is the
+            current cache entry for ``path``, or ``None``.
+
+        :return: the tuple ``(path, entry, scanned)``, where ``entry`` is
+            ``None`` if the directory no longer exists and ``scanned`` is
+            whether the directory was listed
+        """
+        path, entry = args
+        try:
+            mtime = os.stat(path).st_mtime
+            if entry is not None and self._unchanged(path, mtime, entry):
+                return (path, entry, False)
+            else:
+                return (path, self._scan_directory(path, mtime), True)
+        except OSError:
+            return (path, None, True)
+
+    def _scan(self, cache):
+        """Scans the directory tree.
+
+        Directories are scanned in parallel, one level at a time.
+
+        :param dict cache: The current scan cache.
+
+        :return: the tuple ``(cache, changed)``, where ``cache`` is the new
+            scan cache and ``changed`` whether it differs from the old one
+        """
+        result = {}
+        changed = False
+        pending = [self._path]
+        while pending:
+            scanned = self.pool.map(
+                self._scan_entry,
+                [(path, cache.get(path)) for path in pending])
+            pending = []
+            for path, entry, listed in scanned:
+                changed = changed or listed
+                if entry is None:
+                    continue
+                result[path] = entry
+                pending.extend(
+                    os.path.join(path, name)
+                    for name in entry[2])
+
+        return (result, changed or set(result) != set(cache))
+
+    def _modified(self):
+        """Returns whether any known directory, or any file in it, has been
+        modified since the last scan.
+
+        :rtype: bool
+        """
+        def modified(item):
+            path, entry = item
+            try:
+                return not self._unchanged(
+                    path, os.stat(path).st_mtime, entry)
+            except OSError:
+                return True
+
+        return any(self.pool.map(modified, list(self._cache.items())))
+
+    def refresh(self):
+        """Reloads all images and tags if any directory or file has been
+        modified.
+
+        The directories are checked at most once every ``rescan_interval``
+        seconds.
+        """
+        now = time.time()
+        if self._checked is not None \
+                and now - self._checked < self._rescan_interval:
+            return
+        self._checked = now
+
+        if self._cache is None or self._modified():
+            self.reload()
+
+    def _describe(self, files):
+        """Determines the title, timestamp and keywords of files.
+
+        This implementation uses the file name without extension as title, the
+        modification time as timestamp and the keywords found when scanning.
+
+        :param files: A list of ``(location, st, keywords)``, where ``st`` is
+            the ``lstat`` value of ``location`` and ``keywords`` the list of
+            keywords found when scanning.
+
+        :return: a list of ``(title, timestamp, keywords)``, in the same order
+            as ``files``
+        """
+        return [
+            (
+                os.path.splitext(os.path.basename(location))[0],
+                st.st_mtime,
+                keywords)
+            for location, st, keywords in files]
+
+    def load_tags(self):
+        with self._timer.phase('stat'):
+            cache, changed = self._scan(
+                self._load_cache() if self._cache is None else self._cache)
+            if changed:
+                self._save_cache(cache)
+            self._cache = cache
+
+        files = [
+            (
+                os.path.relpath(path, self._path),
+                os.path.join(path, name),
+                st,
+                keywords)
+            for path, (mtime, entries, directories) in sorted(cache.items())
+            for name, st, keywords in entries]
+        with self._timer.phase('naming'):
+            descriptions = self._describe([
+                (location, st, keywords)
+                for relative, location, st, keywords in files])
+
+        with self._timer.phase('tags'):
+            self._build_tags(files, descriptions)
+
+    def _build_tags(self, files, descriptions):
+        """Creates the images and adds them to their tags.
+
+        :param files: A list of ``(relative, location, st, keywords)``.
+
+        :param descriptions: The descriptions of ``files``, as returned by
+            :meth:`_describe`.
+        """
+        tags = {os.path.curdir: None}
+        for (relative, location, st, _), (title, timestamp, keywords) \
+                in zip(files, descriptions):
+            if relative not in tags:
+                tags[relative] = self._make_tags(os.path.sep + relative)
+            tag = tags[relative]
+            if tag is None and not keywords:
+                continue
+
+            image = FileBasedImage(
+                title,
+                location,
+                timestamp,
+                st=st,
+                inode=self.make_inode(st.st_ino))
+            if tag is not None:
+                tag.add(image)
+            for keyword in keywords:
+                keyword_tag = self._make_tags(os.path.sep + keyword)
+                if keyword_tag is not tag:
+                    keyword_tag.add(image)
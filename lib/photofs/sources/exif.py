@@ -0,0 +1,455 @@
+# coding: utf-8
+# photofs
+# Copyright (C) 2012-2016 Moses Palmér
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see <http://www.gnu.org/licenses/>.
+
+import datetime
+import hashlib
+import os
+import struct
+import time
+
+from xdg.BaseDirectory import save_cache_path
+
+from photofs import _worker
+from photofs._source import ImageSource
+from photofs.sources.directory import (
+    DirectorySource, keyword_path, xmp_keywords)
+
+
+# Try to import sqlite
+try:
+    import sqlite3
+except ImportError:
+    sqlite3 = None
+
+
+#: The header of an *Exif* ``APP1`` segment in a *JPEG* file
+JPEG_EXIF = b'Exif\x00\x00'
+
+#: The header of an *XMP* ``APP1`` segment in a *JPEG* file
+JPEG_XMP = b'http://ns.adobe.com/xap/1.0/\x00'
+
+#: The *TIFF* tag of the *Exif* IFD pointer
+TIFF_EXIF_IFD = 0x8769
+
+#: The *TIFF* tag of the modification time
+TIFF_DATE_TIME = 0x0132
+
+#: The *Exif* tag of the capture time
+TIFF_DATE_TIME_ORIGINAL = 0x9003
+
+#: The *Exif* tag of the digitisation time
+TIFF_DATE_TIME_DIGITIZED = 0x9004
+
+#: The *TIFF* tag of an embedded *XMP* packet
+TIFF_XMP = 0x02bc
+
+#: The *TIFF* tag of the *Windows* keyword list
+TIFF_XP_KEYWORDS = 0x9c9e
+
+#: The sizes of *TIFF* field types
+TIFF_TYPE_SIZES = {
+    1: 1, 2: 1, 3: 2, 4: 4, 5: 8, 6: 1, 7: 1, 8: 2, 9: 4, 10: 8, 11: 4,
+    12: 8, 13: 4}
+
+#: The maximum number of entries in a *TIFF* IFD
+TIFF_MAX_ENTRIES = 1024
+
+#: The maximum size of a *TIFF* value that is read
+TIFF_MAX_VALUE_SIZE = 1024 * 1024
+
+#: The number of seconds between the *MP4* epoch, 1904-01-01, and the UNIX
+#: epoch
+MP4_EPOCH = 2082844800
+
+#: File extensions of *JPEG* files
+JPEG_EXTENSIONS = ('jpg', 'jpeg', 'jpe')
+
+#: File extensions of *TIFF* based files
+TIFF_EXTENSIONS = ('tif', 'tiff', 'dng', 'nef', 'cr2', 'arw', 'pef', 'srw')
+
+#: File extensions of *MP4* based files
+MP4_EXTENSIONS = ('mp4', 'm4v', 'mov', '3gp')
+
+
+def _exif_time(value):
+    """Converts an *Exif* timestamp to a UNIX timestamp.
+
+    *Exif* timestamps are in local time.
+
+    :param bytes value: The *Exif* timestamp, on the form
+        ``'YYYY:MM:DD HH:MM:SS'``.
+
+    :return: a UNIX timestamp, or ``None`` if ``value`` is invalid
+    :rtype: float or None
+    """
+    try:
+        return time.mktime(datetime.datetime.strptime(
+            value.rstrip(b'\x00 ').decode('ascii'),
+            '%Y:%m:%d %H:%M:%S').timetuple())
+    except (ValueError, OverflowError, UnicodeDecodeError):
+        return None
+
+
+def tiff_metadata(read):
+    """Extracts the capture time and keywords from a *TIFF* structure.
+
+    :param read: A function taking the arguments ``(offset, size)`` and
+        returning the bytes at that offset relative to the start of the *TIFF*
+        header.
+
+    :return: the tuple ``(timestamp, keywords)``, where ``timestamp`` is
+        ``None`` if no capture time is stored
+
+    :raises ValueError: if the data is not a valid *TIFF* structure
+    """
+    header = read(0, 8)
+    if header[:2] == b'II':
+        order = '<'
+    elif header[:2] == b'MM':
+        order = '>'
+    else:
+        raise ValueError('Invalid TIFF header')
+    magic, offset = struct.unpack(order + 'HI', header[2:8])
+    if magic != 42:
+        raise ValueError('Invalid TIFF header')
+
+    def ifd(offset):
+        count, = struct.unpack(order + 'H', read(offset, 2))
+        if count > TIFF_MAX_ENTRIES:
+            raise ValueError('Invalid TIFF IFD')
+        data = read(offset + 2, count * 12)
+        return {
+            tag: (kind, n, value)
+            for tag, kind, n, value in (
+                struct.unpack(order + 'HHI4s', data[i:i + 12])
+                for i in range(0, len(data) - 11, 12))}
+
+    def value(entry):
+        kind, n, raw = entry
+        size = TIFF_TYPE_SIZES.get(kind, 1) * n
+        if size <= 4:
+            return raw[:size]
+        elif size <= TIFF_MAX_VALUE_SIZE:
+            return read(struct.unpack(order + 'I', raw)[0], size)
+        else:
+            return b''
+
+    ifd0 = ifd(offset)
+    exif = ifd(struct.unpack(order + 'I', ifd0[TIFF_EXIF_IFD][2])[0]) \
+        if TIFF_EXIF_IFD in ifd0 else {}
+
+    timestamp = None
+    for tag, entries in (
+            (TIFF_DATE_TIME_ORIGINAL, exif),
+            (TIFF_DATE_TIME_DIGITIZED, exif),
+            (TIFF_DATE_TIME, ifd0)):
+        if tag in entries:
+            timestamp = _exif_time(value(entries[tag]))
+            if timestamp is not None:
+                break
+
+    keywords = []
+    if TIFF_XMP in ifd0:
+        try:
+            keywords.extend(xmp_keywords(value(ifd0[TIFF_XMP])))
+        except ValueError:
+            pass
+    if TIFF_XP_KEYWORDS in ifd0:
+        keywords.extend(
+            keyword
+            for keyword in (
+                keyword_path(item)
+                for item in value(ifd0[TIFF_XP_KEYWORDS]).decode(
+                    'utf-16-le', 'replace').rstrip('\x00').split(';'))
+            if keyword and keyword not in keywords)
+
+    return (timestamp, keywords)
+
+
+def jpeg_metadata(f):
+    """Extracts the capture time and keywords from a *JPEG* file.
+
+    Only the ``APP1`` segments preceding the image data are read.
+
+    :param f: The file, positioned at its start.
+
+    :return: the tuple ``(timestamp, keywords)``, where ``timestamp`` is
+        ``None`` if no capture time is stored
+
+    :raises ValueError: if the file is not a valid *JPEG* file
+    """
+    if f.read(2) != b'\xff\xd8':
+        raise ValueError('Invalid JPEG header')
+
+    timestamp = None
+    keywords = []
+    while True:
+        marker = f.read(2)
+        if len(marker) < 2 or marker[0:1] != b'\xff':
+            break
+        kind = ord(marker[1:2])
+        if kind in (0xd9, 0xda):
+            # End of image or start of scan; no more metadata follows
+            break
+        elif 0xd0 <= kind <= 0xd7 or kind in (0x01, 0xff):
+            # Markers without a length
+            continue
+
+        length, = struct.unpack('>H', f.read(2))
+        if kind != 0xe1:
+            f.seek(length - 2, os.SEEK_CUR)
+            continue
+
+        data = f.read(length - 2)
+        if data.startswith(JPEG_EXIF):
+            exif_timestamp, exif_keywords = tiff_metadata(
+                lambda offset, size: data[
+                    len(JPEG_EXIF) + offset:len(JPEG_EXIF) + offset + size])
+            timestamp = timestamp or exif_timestamp
+            keywords.extend(
+                keyword
+                for keyword in exif_keywords
+                if keyword not in keywords)
+        elif data.startswith(JPEG_XMP):
+            keywords.extend(
+                keyword
+                for keyword in xmp_keywords(data[len(JPEG_XMP):])
+                if keyword not in keywords)
+
+    return (timestamp, keywords)
+
+
+def mp4_metadata(f):
+    """Extracts the creation time from an *MP4* or *QuickTime* file.
+
+    Only box headers and the ``mvhd`` box are read.
+
+    :param f: The file.
+
+    :return: the tuple ``(timestamp, keywords)``, where ``timestamp`` is
+        ``None`` if no creation time is stored and ``keywords`` is always
+        empty
+    """
+    def boxes(start, end):
+        offset = start
+        while offset + 8 <= end:
+            f.seek(offset)
+            header = f.read(8)
+            if len(header) < 8:
+                return
+            length, kind = struct.unpack('>I4s', header)
+            body = offset + 8
+            if length == 1:
+                length, = struct.unpack('>Q', f.read(8))
+                body += 8
+            elif length == 0:
+                length = end - offset
+            if length < body - offset:
+                return
+            yield kind, body, offset + length
+            offset += length
+
+    for kind, body, end in boxes(0, os.fstat(f.fileno()).st_size):
+        if kind != b'moov':
+            continue
+        for kind, body, _ in boxes(body, end):
+            if kind != b'mvhd':
+                continue
+            f.seek(body)
+            data = f.read(12)
+            if len(data) < 8:
+                raise ValueError('Truncated mvhd box')
+            if ord(data[0:1]) == 1:
+                created, = struct.unpack('>Q', data[4:12])
+            else:
+                created, = struct.unpack('>I', data[4:8])
+            return (created - MP4_EPOCH if created else None, [])
+
+    return (None, [])
+
+
+def metadata(location):
+    """Extracts the capture time and keywords from a file.
+
+    :param str location: The location of the file.
+
+    :return: the tuple ``(timestamp, keywords)``, where ``timestamp`` is
+        ``None`` if no capture time could be read
+    """
+    extension = location.rsplit('.', 1)[-1].lower()
+    try:
+        with open(location, 'rb') as f:
+            if extension in JPEG_EXTENSIONS:
+                return jpeg_metadata(f)
+            elif extension in TIFF_EXTENSIONS:
+                def read(offset, size):
+                    f.seek(offset)
+                    return f.read(size)
+                return tiff_metadata(read)
+            elif extension in MP4_EXTENSIONS:
+                return mp4_metadata(f)
+    except (OSError, ValueError, KeyError, IndexError, struct.error):
+        pass
+
+    return (None, [])
+
+
+def _read_metadata(location):
+    """The function run by the metadata worker processes.
+
+    :param str location: The location of the file.
+
+    :return: the tuple ``(location, timestamp, keywords)``
+    """
+    return (location,) + metadata(location)
+
+
+@ImageSource.register('exif')
+class ExifSource(DirectorySource):
+    """Loads images and videos from a directory tree, using the capture times
+    and keywords stored in the files.
+
+    Capture times and keywords are read from the headers of *JPEG*, *TIFF* and
+    *MP4* files by a pool of worker processes, and are stored in a persistent
+    index. When remounting, only new and modified files are read.
+
+    Since the capture time is used as title, images are named after it.
+    """
+    WORKER_STATE = DirectorySource.WORKER_STATE + ('_index',)
+
+    @classmethod
+    def add_arguments(self, argparser):
+        super(ExifSource, self).add_arguments(argparser)
+
+        argparser.add_argument(
+            '--metadata-index',
+            help='The file in which to store metadata read from image files.')
+
+        argparser.add_argument(
+            '--metadata-workers',
+            help='The number of processes used to read metadata from image '
+            'files.',
+            type=int)
+
+    def __init__(self, metadata_index=None, metadata_workers=None, **kwargs):
+        """Creates a new *Exif* source.
+
+        :param str metadata_index: The file in which to store the metadata
+            index. If this is not specified, a file in the *XDG* cache
+            directory is used.
+
+        :param int metadata_workers: The number of processes used to read
+            metadata. If this is not specified, the number of CPUs is used.
+        """
+        if sqlite3 is None:
+            raise RuntimeError('This program requires sqlite3')
+        super(ExifSource, self).__init__(**kwargs)
+        self._metadata_index = metadata_index or os.path.join(
+            save_cache_path('photofs'),
+            'exif-%s.sqlite' % hashlib.sha1(
+                self._path.encode('utf-8')).hexdigest())
+        self._metadata_workers = metadata_workers
+        self._index = None
+
+    def _read(self, locations):
+        """Reads metadata from files using a pool of worker processes.
+
+        :param [str] locations: The locations of the files to read.
+
+        :return: an iterator of ``(location, timestamp, keywords)``
+        """
+        pool = _worker.pool_context().Pool(self._metadata_workers)
+        try:
+            for result in pool.imap_unordered(
+                    _read_metadata,
+                    locations,
+                    max(1, min(256, len(locations) // 64))):
+                yield result
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def _describe(self, files):
+        db = sqlite3.connect(self._metadata_index)
+        try:
+            db.execute("""
+                CREATE TABLE IF NOT EXISTS metadata (
+                    path TEXT PRIMARY KEY,
+                    size INTEGER,
+                    mtime REAL,
+                    timestamp REAL,
+                    keywords TEXT)""")
+            if self._index is None:
+                self._index = {
+                    r_path: (r_size, r_mtime, r_timestamp, (
+                        r_keywords.split('\n') if r_keywords else []))
+                    for r_path, r_size, r_mtime, r_timestamp, r_keywords
+                    in db.execute("""
+                        SELECT path, size, mtime, timestamp, keywords
+                            FROM metadata""")}
+
+            # Read the metadata of new and modified files
+            stats = {location: st for location, st, _ in files}
+            stale = [
+                location
+                for location, st in stats.items()
+                if self._index.get(location, (None, None))[:2] != (
+                    st.st_size, st.st_mtime)]
+            if stale:
+                rows = []
+                for location, timestamp, keywords in self._read(stale):
+                    st = stats[location]
+                    self._index[location] = (
+                        st.st_size, st.st_mtime, timestamp, keywords)
+                    rows.append((
+                        location, st.st_size, st.st_mtime, timestamp,
+                        '\n'.join(keywords)))
+                db.executemany("""
+                    INSERT OR REPLACE INTO metadata
+                        VALUES (?, ?, ?, ?, ?)""", rows)
+
+            # Forget removed files
+            removed = [
+                location
+                for location in self._index
+                if location not in stats]
+            if removed:
+                for location in removed:
+                    del self._index[location]
+                db.executemany(
+                    """
+                    DELETE FROM metadata
+                        WHERE path = ?""",
+                    ((location,) for location in removed))
+
+            db.commit()
+
+        finally:
+            db.close()
+
+        result = []
+        for location, st, keywords in files:
+            _, _, timestamp, embedded = self._index[location]
+            result.append((
+                None,
+                st.st_mtime if timestamp is None else timestamp,
+                keywords + [
+                    keyword
+                    for keyword in embedded
+                    if keyword not in keywords]))
+
+        return result
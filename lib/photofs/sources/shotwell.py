@@ -15,29 +15,150 @@
 # You should have received a copy of the GNU General Public License along with
 # this program. If not, see <http://www.gnu.org/licenses/>.
 
+import array
+import contextlib
+import hashlib
+import itertools
+import operator
 import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+
+try:
+    from urllib.parse import quote
+except ImportError:
+    from urllib import quote
 
 from xdg.BaseDirectory import xdg_data_dirs
 
 from photofs._image import FileBasedImage
 from photofs._source import ImageSource, FileBasedImageSource
+from photofs._tag import Tag
+from photofs._util import make_unique
 
 
 # Try to import sqlite
 try:
     import sqlite3
 except ImportError:
-    sqlite = None
+    sqlite3 = None
 
 
 @ImageSource.register('shotwell')
 class ShotwellSource(FileBasedImageSource):
     """Loads images and videos from Shotwell.
+
+    The database is kept open in read-only mode. Changes are detected using
+    ``PRAGMA data_version``, and a digest of the content of every table is then
+    computed from the snapshot being loaded to determine which tables have
+    actually changed. Only changed image tables are reloaded, and if no table
+    has changed, the current tags are kept.
+
+    All tables are read from one consistent snapshot of the database, without
+    blocking *Shotwell*. If the database uses write-ahead logging, a single
+    read transaction is used, otherwise, or if the database cannot be locked,
+    the database is copied to a temporary directory, preferably on *tmpfs*, and
+    read from there.
     """
-    def __init__(self, *args, **kwargs):
+    WORKER_STATE = ('_images', '_events', '_events_view', '_probes')
+
+    #: The name of the top level directory containing events
+    EVENTS_VIEW = 'Events'
+
+    #: The format of the names of events without a name
+    EVENT_DATE_FORMAT = '%Y-%m-%d'
+
+    #: The descriptions of the different image tables; the value tuple is the
+    #: header of the ID in the tag table and whether the table contains videos
+    IMAGE_TABLES = {
+        'phototable': ('thumb', False),
+        'videotable': ('video-', True)}
+
+    #: The regular expression matching the IDs in ``photo_id_list``; the
+    #: groups are the header from :attr:`IMAGE_TABLES` and the hexadecimal ID,
+    #: or an empty header and the decimal ID for legacy IDs in the photo table
+    ID_PATTERN = re.compile(
+        r'(?:^|,)(thumb|video-|(?=[0-9]+,))([0-9a-fA-F]+)(?=,)')
+
+    #: The image tables for the headers matched by :attr:`ID_PATTERN`
+    ID_TABLES = {
+        'thumb': 'phototable',
+        'video-': 'videotable',
+        '': 'phototable'}
+
+    #: The content hashes stored in the different image tables, mapped to the
+    #: names of the extended attributes used to present them
+    HASH_COLUMNS = {
+        'phototable': (
+            ('md5', 'user.shotwell.md5'),
+            ('thumbnail_md5', 'user.shotwell.thumbnail_md5')),
+        'videotable': (
+            ('md5', 'user.shotwell.md5'),)}
+
+    #: The extended attribute containing the *Shotwell* source ID
+    ID_ATTRIBUTE = 'user.shotwell.id'
+
+    #: The extended attribute containing the full names of all tags applied,
+    #: separated by newlines
+    TAGS_ATTRIBUTE = 'user.shotwell.tags'
+
+    #: The columns used to probe tables for changes; a digest of the content
+    #: of these columns in all rows is compared with the previous load
+    PROBES = {
+        'phototable': (
+            'id', 'filename', 'exposure_time', 'title', 'rating', 'event_id',
+            'md5', 'thumbnail_md5'),
+        'videotable': (
+            'id', 'filename', 'exposure_time', 'title', 'rating', 'event_id',
+            'md5'),
+        'tagtable': ('id', 'name', 'photo_id_list'),
+        'eventtable': ('id', 'name')}
+
+    #: The snapshot strategies
+    SNAPSHOT_STRATEGIES = ('auto', 'transaction', 'copy')
+
+    #: The number of times to try copying the database before giving up
+    COPY_ATTEMPTS = 5
+
+    #: The directory in which to store copies of the database; tmpfs is
+    #: preferred
+    COPY_DIRECTORY = '/dev/shm' if os.path.isdir('/dev/shm') else None
+
+    @classmethod
+    def add_arguments(self, argparser):
+        super(ShotwellSource, self).add_arguments(argparser)
+
+        argparser.add_argument(
+            '--snapshot',
+            help='How to read a consistent snapshot of the Shotwell database. '
+            'transaction uses a single read transaction, and copy reads from '
+            'a temporary copy of the database. auto, the default, uses a '
+            'transaction if the database uses write-ahead logging.',
+            choices=self.SNAPSHOT_STRATEGIES)
+
+    def __init__(self, snapshot='auto', *args, **kwargs):
+        """Creates a new *Shotwell* source.
+
+        :param str snapshot: The strategy used to read a consistent snapshot of
+            the database; one of :attr:`SNAPSHOT_STRATEGIES`.
+        """
         if sqlite3 is None:
             raise RuntimeError('This program requires sqlite3')
+        if snapshot not in self.SNAPSHOT_STRATEGIES:
+            raise ValueError('Invalid snapshot strategy: %s', snapshot)
         super(ShotwellSource, self).__init__(*args, **kwargs)
+        self._snapshot_strategy = snapshot
+        self._lock = threading.Lock()
+        self._db = None
+        self._db_pid = None
+        self._data_version = None
+        self._images = {}
+        self._events = {}
+        self._events_view = None
+        self._probes = {}
 
     @property
     def default_location(self):
@@ -52,84 +173,414 @@ class ShotwellSource(FileBasedImageSource):
             if os.access(result, os.R_OK):
                 return result
 
-    def load_tags(self):
-        db = sqlite3.connect(self._path)
+    @property
+    def views(self):
+        """The events of the library, if any, as the view :attr:`EVENTS_VIEW`.
+        """
+        if self._events_view:
+            return {self.EVENTS_VIEW: self._events_view}
+        else:
+            return {}
+
+    @property
+    def db(self):
+        """The read-only connection to the database.
+
+        The connection is opened on first access, and reopened in a worker
+        process, since connections must not be used across ``fork``.
+        """
+        if self._db is None or self._db_pid != os.getpid():
+            self._db = sqlite3.connect(
+                'file:%s?mode=ro' % quote(os.path.abspath(self._path)),
+                uri=True,
+                isolation_level=None,
+                check_same_thread=False)
+            self._db_pid = os.getpid()
+        return self._db
+
+    def _signature(self):
+        """Returns a value that changes whenever the database files are
+        modified.
+
+        :return: the sizes and modification times of the database, its
+            write-ahead log and its rollback journal
+        """
+        def signature(path):
+            try:
+                st = os.stat(path)
+                return (st.st_size, st.st_mtime)
+            except OSError:
+                return None
+
+        return tuple(
+            signature(self._path + suffix)
+            for suffix in ('', '-wal', '-journal'))
+
+    @contextlib.contextmanager
+    def _copy(self):
+        """Copies the database to a temporary directory and opens the copy.
+
+        The copy is considered consistent if the database files were not
+        modified while copying, and no rollback journal exists.
+
+        :return: a context manager yielding a connection to the copy
+
+        :raises RuntimeError: if no consistent copy could be made
+        """
+        directory = tempfile.mkdtemp(
+            prefix='photofs-',
+            dir=self.COPY_DIRECTORY)
+        try:
+            target = os.path.join(directory, 'photo.db')
+            for attempt in range(self.COPY_ATTEMPTS):
+                before = self._signature()
+                if before[2] is None:
+                    shutil.copyfile(self._path, target)
+                    if before[1] is not None:
+                        shutil.copyfile(self._path + '-wal', target + '-wal')
+                    if self._signature() == before:
+                        break
+                time.sleep(0.1 * (attempt + 1))
+            else:
+                raise RuntimeError(
+                    'Failed to copy %s: the database is being modified',
+                    self._path)
+
+            db = sqlite3.connect(target, isolation_level=None)
+            try:
+                yield db
+            finally:
+                db.close()
+
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        """Opens a read transaction on the database.
+
+        :return: a context manager yielding the connection to the database
+        """
+        db = self.db
+        db.execute('BEGIN')
         try:
-            # The descriptions of the different image tables; the value tuple
-            # is the header of the ID in the tag table, the map of IDs to
-            # images and whether the table contains videos
-            db_tables = {
-                'phototable': ('thumb', {}, False),
-                'videotable': ('video-', {}, True)}
-
-            # Load the images
-            for table_name, (header, images, is_video) in db_tables.items():
-                results = db.execute("""
-                    SELECT id, filename, exposure_time, title
-                        FROM %s""" % table_name)
-                for r_id, r_filename, r_exposure_time, r_title in results:
-                    try:
-                        images[r_id] = FileBasedImage(
-                            r_title,
-                            r_filename,
-                            r_exposure_time,
-                            is_video)
-                    except OSError:
-                        # Ignore unreadable files
-                        pass
-
-            # Load the tags
+            yield db
+        finally:
+            db.execute('ROLLBACK')
+
+    def _use_transaction(self):
+        """Determines whether to read the database in a transaction instead of
+        from a copy.
+
+        If the strategy is ``'auto'``, a transaction is used only if the
+        database uses write-ahead logging, since readers do not block the
+        writer in that case.
+
+        :rtype: bool
+        """
+        if self._snapshot_strategy == 'auto':
+            try:
+                return self.db.execute(
+                    'PRAGMA journal_mode').fetchone()[0] == 'wal'
+            except sqlite3.OperationalError:
+                return False
+        else:
+            return self._snapshot_strategy == 'transaction'
+
+    def _probe(self, db):
+        """Probes all tables for changes.
+
+        :param db: The database connection to use.
+
+        The content of every table is concatenated by *SQLite*, which does
+        not hold the global interpreter lock, and only the digest of the
+        concatenation is kept.
+
+        :return: a mapping from table name to the tuple ``(count, last,
+            digest)``
+        :rtype: dict
+        """
+        result = {}
+        for table_name, columns in self.PROBES.items():
+            count, last, content = db.execute("""
+                SELECT count(*), max(rowid), group_concat(%s, char(30))
+                    FROM (SELECT * FROM %s ORDER BY rowid)""" % (
+                " || char(31) || ".join(
+                    "ifnull(%s, '')" % column for column in columns),
+                table_name)).fetchone()
+            result[table_name] = (
+                count,
+                last,
+                hashlib.sha1(content.encode('utf-8')).hexdigest()
+                if content else None)
+        return result
+
+    def refresh(self):
+        """Reloads all images and tags if the database has changed.
+
+        :meth:`reload` is only called if ``PRAGMA data_version`` indicates
+        that another connection has committed changes; the tables are then
+        probed by :meth:`load_tags`.
+
+        If another thread is already refreshing this source, this method
+        returns immediately, and the current tags are kept until the reload
+        has completed.
+        """
+        if not self._lock.acquire(False):
+            return
+
+        try:
+            data_version = self.db.execute('PRAGMA data_version').fetchone()[0]
+            if data_version == self._data_version:
+                return
+            self._data_version = data_version
+            self.reload()
+
+        finally:
+            self._lock.release()
+
+    def _load_images(self, db, table_name, is_video):
+        """Loads all images from an image table, and the events to which they
+        belong.
+
+        The *Shotwell* source ID and the stored content hashes of the images
+        are read in the same query, and are stored as attributes of the
+        images.
+
+        :param db: The database connection to use.
+
+        :param str table_name: The name of the table.
+
+        :param bool is_video: Whether the table contains videos.
+
+        :return: the tuple ``(images, events)``, where ``images`` is a mapping
+            from ID to image and ``events`` a mapping from event ID to the
+            tuple ``(name, ids)``, where ``name`` is the name of the event and
+            ``ids`` an array of the IDs of the images loaded
+        :rtype: (dict, dict)
+        """
+        images = {}
+        events = {}
+        header, _ = self.IMAGE_TABLES[table_name]
+        hashes = self.HASH_COLUMNS[table_name]
+        with self._timer.phase('sql'):
+            results = db.execute("""
+                SELECT t.id, t.filename, t.exposure_time, t.title, t.rating,
+                        t.event_id, e.name%s
+                    FROM %s AS t
+                    LEFT JOIN eventtable AS e ON e.id = t.event_id""" % (
+                ''.join(', t.%s' % column for column, _ in hashes),
+                table_name)).fetchall()
+
+        # Creating the images stats the files
+        with self._timer.phase('stat'):
+            for row in results:
+                r_id, r_filename, r_exposure_time, r_title, r_rating, \
+                    r_event_id, r_event_name = row[:7]
+                attributes = {
+                    name: value
+                    for (column, name), value in zip(hashes, row[7:])
+                    if value}
+                attributes[self.ID_ATTRIBUTE] = '%s%016x' % (header, r_id)
+                try:
+                    images[r_id] = FileBasedImage(
+                        r_title,
+                        r_filename,
+                        r_exposure_time,
+                        is_video,
+                        inode=self.make_inode(r_id << 1 | int(is_video)),
+                        rating=r_rating,
+                        attributes=attributes)
+                except OSError:
+                    # Ignore unreadable files
+                    continue
+
+                if r_event_id is not None and r_event_id >= 0:
+                    if r_event_id not in events:
+                        events[r_event_id] = (r_event_name, array.array('q'))
+                    events[r_event_id][1].append(r_id)
+
+        return (images, events)
+
+    @classmethod
+    def parse_photo_id_list(self, value):
+        """Parses the list of image IDs of a tag.
+
+        The IDs are all in the text of ``photo_id_list``, separated by commas,
+        with an extra comma at the end. Every ID is either a source ID, the
+        header of an image table followed by a hexadecimal ID, or a legacy
+        decimal ID in the photo table.
+
+        :param str value: The value of ``photo_id_list``.
+
+        :return: a list of ``(table_name, ids)``, where ``ids`` is an array of
+            consecutive IDs in the image table ``table_name``, in the order
+            they appear in ``value``
+        :rtype: [(str, array.array)]
+        """
+        return [
+            (
+                self.ID_TABLES[header],
+                array.array('q', (
+                    int(i, 16 if header else 10) for _, i in matches)))
+            for header, matches in itertools.groupby(
+                self.ID_PATTERN.findall(value), operator.itemgetter(0))]
+
+    def _load_events(self):
+        """Creates the view of all events from the events index.
+
+        Every event is presented as a tag named after the event, or after the
+        date of its first image if it has no name.
+
+        The view is rebuilt completely from the index. Since reloading an image
+        table creates new images, the tags of unchanged events could not be
+        reused in any case.
+
+        :return: the view, or ``None`` if there are no events
+        :rtype: Tag or None
+        """
+        events = {}
+        for table_name in sorted(self.IMAGE_TABLES):
+            images = self._images[table_name]
+            for event_id, (name, ids) in self._events[table_name].items():
+                events.setdefault(event_id, (name, []))[1].extend(
+                    images[i] for i in ids)
+        if not events:
+            return None
+
+        view = Tag(self.EVENTS_VIEW)
+        for name, images in sorted(
+                events.values(),
+                key=lambda event: min(image.timestamp for image in event[1])):
+            images.sort(key=lambda image: image.timestamp)
+            tag = Tag(make_unique(
+                view,
+                (name or images[0].timestamp.strftime(
+                    self.EVENT_DATE_FORMAT)).replace(os.path.sep, '-'),
+                '%s',
+                '%s (%d)'))
+            for image in images:
+                tag.add(image)
+            view.add(tag)
+
+        return view
+
+    def load_tags(self):
+        if self._use_transaction():
+            try:
+                with self._transaction() as db:
+                    return self._load_tags(db)
+            except sqlite3.OperationalError:
+                # If the database cannot be locked, fall back on a copy
+                if self._snapshot_strategy != 'auto':
+                    raise
+                self._root.clear()
+
+        with self._copy() as db:
+            return self._load_tags(db)
+
+    def _load_tags(self, db):
+        """Loads the images and tags from a database snapshot.
+
+        :param db: The database connection to use.
+
+        :return: ``False`` if no table has changed since the last load
+        """
+        with self._timer.phase('sql'):
+            probes = self._probe(db)
+        if probes == self._probes:
+            return False
+
+        # Reload the image tables that have changed; since the image tables
+        # are read joined with the event table, they are all reloaded if the
+        # events have changed
+        events_changed = probes['eventtable'] != self._probes.get(
+            'eventtable')
+        reloaded = False
+        for table_name, (header, is_video) in self.IMAGE_TABLES.items():
+            if table_name not in self._images \
+                    or events_changed \
+                    or probes[table_name] != self._probes.get(table_name):
+                self._images[table_name], self._events[table_name] = \
+                    self._load_images(db, table_name, is_video)
+                reloaded = True
+
+        # The events view only depends on the image tables, which are read
+        # joined with the event table; it is rebuilt only if any of them has
+        # changed
+        if reloaded:
+            with self._timer.phase('events'):
+                self._events_view = self._load_events()
+
+        # Load the tags, and remember the names of the tags applied to every
+        # image
+        tag_names = {}
+        with self._timer.phase('sql'):
             results = db.execute("""
                 SELECT name, photo_id_list
                     FROM tagtable
-                    ORDER BY name""")
-            for r_name, r_photo_id_list in results:
-                # Ignore unused tags
-                if not r_photo_id_list:
-                    continue
+                    ORDER BY name""").fetchall()
 
-                # Hierachial tag names start with '/'
-                path = r_name.split('/') if r_name[0] == '/' else ['', r_name]
-                path_name = os.path.sep.join(path)
-
-                # Make sure that the tag and all its parents exist
-                tag = self._make_tags(path_name)
-
-                # The IDs are all in the text of photo_id_list, separated by
-                # commas; there is an extra comma at the end
-                ids = r_photo_id_list.split(',')[:-1]
-
-                # Iterate over all image IDs and move them to this tag
-                for i in ids:
-                    if i[0].isdigit():
-                        # If the first character is a digit, this is a legacy
-                        # source ID and an ID in the photo table
-                        image = db_tables['phototable'][1].get(int(i))
-                    else:
-                        # Iterate over all database tables and locate the image
-                        # instance for the current ID
-                        image = None
-                        for table_name, (header, images, is_video) \
-                                in db_tables.items():
-                            if not i.startswith(header):
-                                continue
-                            image = images.get(int(i[len(header):], 16))
-                            break
-
-                    # Verify that the tag only references existing images
-                    if image is None:
-                        continue
-
-                    # Remove the image from the parent tags
-                    parent = tag.parent
-                    while parent:
-                        for k, v in list(parent.items()):
-                            if v == image:
-                                del parent[k]
-                        parent = parent.parent
-
-                    # Finally add the image to this tag
-                    tag.add(image)
+        # Parent tags list the images of their children, so many lists are
+        # identical; every distinct list is parsed once
+        parsed = {}
+        for r_name, r_photo_id_list in results:
+            # Ignore unused tags
+            if not r_photo_id_list:
+                continue
+            start = time.time()
+            ids = parsed.get(r_photo_id_list)
+            if ids is None:
+                ids = parsed[r_photo_id_list] = self.parse_photo_id_list(
+                    r_photo_id_list)
+            built = time.time()
+            self._timer.add('parse', built - start)
 
-        finally:
-            db.close()
+            # Hierachial tag names start with '/'
+            path = r_name.split('/') if r_name[0] == '/' else ['', r_name]
+            path_name = os.path.sep.join(path)
+
+            # Make sure that the tag and all its parents exist
+            tag = self._make_tags(path_name)
+
+            # Locate the images, ignoring references to missing images
+            images = []
+            for table_name, table_ids in ids:
+                table = self._images[table_name]
+                images.extend(
+                    image
+                    for image in map(table.get, table_ids)
+                    if image is not None)
+            if not images:
+                continue
+
+            # Remove the images from the parent tags
+            identities = set(id(image) for image in images)
+            parent = tag.parent
+            while parent is not None:
+                for k, v in list(parent.items()):
+                    if id(v) in identities:
+                        del parent[k]
+                parent = parent.parent
+
+            # Finally add the images to this tag, which generates their unique
+            # names
+            named = time.time()
+            for image in images:
+                tag.add(image)
+                tag_names.setdefault(id(image), []).append(r_name)
+            self._timer.add('tags', named - built)
+            self._timer.add('naming', time.time() - named)
+
+        # The images of unchanged tables are reused, so their tag lists must
+        # be updated
+        for images in self._images.values():
+            for image in images.values():
+                names = tag_names.get(id(image))
+                if names:
+                    image.attributes[self.TAGS_ATTRIBUTE] = '\n'.join(
+                        sorted(set(names)))
+                else:
+                    image.attributes.pop(self.TAGS_ATTRIBUTE, None)
+
+        self._probes = probes
@@ -46,6 +46,9 @@ def setup(**kwargs):
             'fusepy >=2.0.2',
             'pyxdg >= 0.25'],
         setup_requires=[],
+        extras_require={
+            'resize': ['Pillow >= 6.0'],
+            'pyfuse3': ['pyfuse3 >= 3.0', 'trio']},
 
         url=PACKAGE_URL,
 
@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+# coding: utf-8
+# photofs
+# Copyright (C) 2012-2016 Moses Palmér
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see <http://www.gnu.org/licenses/>.
+"""Tests for the block cache.
+
+Run with ``python -m unittest discover tests``.
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lib'))
+
+from photofs._blockcache import BlockCache, CachedFile
+
+
+#: The chunk size used by the tests
+CHUNK_SIZE = 100
+
+
+class BlockCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.location = os.path.join(self.directory, 'original')
+        self.data = bytes(bytearray(
+            i % 251 for i in range(5 * CHUNK_SIZE + 7)))
+        with open(self.location, 'wb') as f:
+            f.write(self.data)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def cache(self, max_size=10 * CHUNK_SIZE):
+        """Creates a block cache in the test directory.
+        """
+        return BlockCache(
+            os.path.join(self.directory, 'cache'),
+            max_size,
+            chunk_size=CHUNK_SIZE,
+            workers=1)
+
+    def open(self, cache):
+        """Opens the test file through a cache.
+        """
+        result = CachedFile(cache, self.location, os.stat(self.location))
+        self.addCleanup(result.close)
+        return result
+
+    def wait(self, cache):
+        """Waits for all chunks read to be written to a cache.
+        """
+        cache.pool.apply(int)
+
+    def test_boundaries(self):
+        """Tests that reads crossing chunk boundaries are assembled from all
+        chunks, both when read from the original and from the cache.
+        """
+        cache = self.cache()
+        f = self.open(cache)
+        ranges = [
+            (CHUNK_SIZE - 10, 20),
+            (0, 3 * CHUNK_SIZE),
+            (2 * CHUNK_SIZE - 1, 2 * CHUNK_SIZE + 2),
+            (CHUNK_SIZE, CHUNK_SIZE)]
+        for offset, size in ranges:
+            self.assertEqual(
+                self.data[offset:offset + size], f.pread(size, offset))
+        self.wait(cache)
+        self.assertEqual(5, cache.stats['misses'])
+        self.assertEqual(5, cache.stats['populated'])
+
+        hits = cache.stats['hits']
+        for offset, size in ranges:
+            self.assertEqual(
+                self.data[offset:offset + size], f.pread(size, offset))
+        self.assertEqual(5, cache.stats['misses'])
+        self.assertEqual(hits + 10, cache.stats['hits'])
+
+    def test_end_of_file(self):
+        """Tests that reads beyond the end of the file are truncated, and that
+        the last, short, chunk is cached.
+        """
+        cache = self.cache()
+        f = self.open(cache)
+        end = len(self.data)
+        self.assertEqual(self.data[end - 20:], f.pread(100, end - 20))
+        self.assertEqual(b'', f.pread(100, end + CHUNK_SIZE))
+        self.wait(cache)
+        misses = cache.stats['misses']
+        self.assertEqual(self.data[end - 7:], f.pread(100, end - 7))
+        self.assertEqual(misses, cache.stats['misses'])
+        self.assertEqual(CHUNK_SIZE + 7, cache.stats['size'])
+
+    def test_sequential(self):
+        """Tests that the file position is advanced by reads.
+        """
+        cache = self.cache()
+        f = self.open(cache)
+        f.seek(CHUNK_SIZE // 2)
+        self.assertEqual(
+            self.data[CHUNK_SIZE // 2:2 * CHUNK_SIZE], f.read(
+                CHUNK_SIZE + CHUNK_SIZE // 2))
+        self.assertEqual(2 * CHUNK_SIZE, f.tell())
+
+    def test_evict(self):
+        """Tests that the least recently used chunks are removed when the
+        cache is full.
+        """
+        cache = self.cache(2 * CHUNK_SIZE)
+        f = self.open(cache)
+        for index in range(3):
+            f.pread(1, index * CHUNK_SIZE)
+            self.wait(cache)
+        self.assertEqual(2 * CHUNK_SIZE, cache.stats['size'])
+        self.assertEqual(1, cache.stats['evicted'])
+        self.assertEqual(2, len(os.listdir(
+            os.path.join(self.directory, 'cache'))))
+
+        # The first chunk was evicted, but the third is still cached
+        misses = cache.stats['misses']
+        f.pread(1, 2 * CHUNK_SIZE)
+        self.assertEqual(misses, cache.stats['misses'])
+        f.pread(1, 0)
+        self.assertEqual(misses + 1, cache.stats['misses'])
+
+    def test_reload(self):
+        """Tests that cached chunks are used by a new cache, and that partially
+        written chunks are removed.
+        """
+        cache = self.cache()
+        self.open(cache).pread(2 * CHUNK_SIZE, 0)
+        self.wait(cache)
+        partial = os.path.join(self.directory, 'cache', 'partial.tmp')
+        with open(partial, 'wb') as f:
+            f.write(b'partial')
+
+        cache = self.cache()
+        self.assertFalse(os.path.exists(partial))
+        self.assertEqual(2 * CHUNK_SIZE, cache.stats['size'])
+        self.assertEqual(
+            self.data[:2 * CHUNK_SIZE],
+            self.open(cache).pread(2 * CHUNK_SIZE, 0))
+        self.assertEqual(0, cache.stats['misses'])
@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+# coding: utf-8
+# photofs
+# Copyright (C) 2012-2016 Moses Palmér
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see <http://www.gnu.org/licenses/>.
+"""Tests for filter expressions.
+
+Run with ``python -m unittest discover tests``.
+"""
+
+import datetime
+import os
+import sys
+import unittest
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lib'))
+
+from photofs._filter import compile_filter
+from photofs._image import Image
+
+
+def image(
+        extension='jpg', timestamp=datetime.datetime(2015, 6, 15), size=5,
+        rating=None, title='Photo'):
+    """Creates an image for a filter to test.
+    """
+    st = os.stat_result((0o100644, 1, 0, 1, 0, 0, size, 0, 0, 0))
+    return Image(title, extension, timestamp, st, rating=rating)
+
+
+class CompileFilterTest(unittest.TestCase):
+    def test_comparison(self):
+        """Tests that comparisons of fields are evaluated for every image.
+        """
+        include = compile_filter('rating >= 4')
+        self.assertTrue(include(image(rating=5)))
+        self.assertTrue(include(image(rating=4)))
+        self.assertFalse(include(image(rating=3)))
+        self.assertFalse(include(image()))
+
+    def test_boolean_operators(self):
+        """Tests that boolean operators and several fields may be combined.
+        """
+        include = compile_filter(
+            'photo and (extension in ("jpg", "png") or not size < 10)')
+        self.assertTrue(include(image()))
+        self.assertTrue(include(image(extension='tiff', size=10)))
+        self.assertFalse(include(image(extension='tiff')))
+        self.assertFalse(include(image(extension='mp4', size=10)))
+
+    def test_date(self):
+        """Tests that timestamps may be compared with dates.
+        """
+        include = compile_filter(
+            'timestamp >= date(2015, 6, 1) and year == 2015 and month == 6')
+        self.assertTrue(include(image()))
+        self.assertFalse(include(image(
+            timestamp=datetime.datetime(2015, 5, 31))))
+        self.assertFalse(include(image(
+            timestamp=datetime.datetime(2016, 6, 15))))
+
+    def test_invalid_value(self):
+        """Tests that an image for which the expression cannot be evaluated is
+        not included.
+        """
+        include = compile_filter('title > 3')
+        self.assertFalse(include(image()))
+
+    def test_syntax_error(self):
+        """Tests that an invalid expression is rejected.
+        """
+        with self.assertRaises(ValueError):
+            compile_filter('rating >=')
+
+    def test_unknown_field(self):
+        """Tests that an expression referencing an unknown name is rejected.
+        """
+        with self.assertRaises(ValueError):
+            compile_filter('colour == "red"')
+
+    def test_unsupported_construct(self):
+        """Tests that expressions may not access attributes or call functions
+        other than those provided.
+        """
+        for expression in (
+                'title.__class__',
+                'open("/etc/passwd")',
+                '[x for x in title]',
+                'lambda: 1'):
+            with self.assertRaises(ValueError):
+                compile_filter(expression)
@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+# coding: utf-8
+# photofs
+# Copyright (C) 2012-2016 Moses Palmér
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see <http://www.gnu.org/licenses/>.
+"""Tests for the *HTTP* server.
+
+Run with ``python -m unittest discover tests``.
+"""
+
+import os
+import stat
+import sys
+import unittest
+
+try:
+    from http.client import HTTPConnection
+except ImportError:
+    from httplib import HTTPConnection
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lib'))
+
+from photofs._http import Server
+
+
+#: The content of the file served
+DATA = bytes(bytearray(range(100)))
+
+
+class FileSystem(object):
+    """A file system containing the single file ``/file.jpg``.
+    """
+    block_cache = None
+
+    def locate(self, path):
+        if path != '/file.jpg':
+            raise KeyError(path)
+        return (None, object())
+
+    def getattr(self, path, fh=None):
+        return {
+            'st_mode': stat.S_IFREG | 0o444,
+            'st_ino': 1,
+            'st_size': len(DATA),
+            'st_mtime': 1400000000.0}
+
+    def open(self, path, flags):
+        return 1
+
+    def release(self, path, fh):
+        pass
+
+    def read_buffer(self, path, size, offset, fh):
+        return DATA[offset:offset + size]
+
+
+class ServerTest(unittest.TestCase):
+    def setUp(self):
+        self.server = Server(FileSystem(), ('127.0.0.1', 0))
+        self.server.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def request(self, headers={}, method='GET', path='/file.jpg'):
+        """Sends a request to the server.
+
+        :return: the tuple ``(response, body)``
+        """
+        connection = HTTPConnection(*self.server.server_address[:2])
+        try:
+            connection.request(method, path, headers=headers)
+            response = connection.getresponse()
+            return (response, response.read())
+        finally:
+            connection.close()
+
+    def assertRange(self, value, start, end):
+        """Asserts that a range request returns part of the file.
+
+        :param str value: The value of the ``Range`` header.
+
+        :param int start: The offset of the first byte expected.
+
+        :param int end: The offset after the last byte expected.
+        """
+        response, body = self.request({'Range': value})
+        self.assertEqual(206, response.status)
+        self.assertEqual(DATA[start:end], body)
+        self.assertEqual(
+            'bytes %d-%d/%d' % (start, end - 1, len(DATA)),
+            response.getheader('Content-Range'))
+
+    def test_file(self):
+        """Tests that a file is served in its entirety without a range.
+        """
+        response, body = self.request()
+        self.assertEqual(200, response.status)
+        self.assertEqual(DATA, body)
+        self.assertEqual('bytes', response.getheader('Accept-Ranges'))
+        self.assertEqual('image/jpeg', response.getheader('Content-Type'))
+
+    def test_head(self):
+        """Tests that no body is sent for a HEAD request.
+        """
+        response, body = self.request(method='HEAD')
+        self.assertEqual(200, response.status)
+        self.assertEqual(b'', body)
+        self.assertEqual(
+            str(len(DATA)), response.getheader('Content-Length'))
+
+    def test_missing(self):
+        """Tests that a missing file is reported.
+        """
+        response, body = self.request(path='/missing.jpg')
+        self.assertEqual(404, response.status)
+
+    def test_range(self):
+        """Tests that single byte ranges are served.
+        """
+        self.assertRange('bytes=10-19', 10, 20)
+        self.assertRange('bytes=90-', 90, 100)
+        self.assertRange('bytes=-5', 95, 100)
+        self.assertRange('bytes=-500', 0, 100)
+        self.assertRange('bytes=95-500', 95, 100)
+
+    def test_unsatisfiable(self):
+        """Tests that ranges outside of the file are rejected.
+        """
+        for value in ('bytes=100-', 'bytes=200-300', 'bytes=20-10'):
+            response, body = self.request({'Range': value})
+            self.assertEqual(416, response.status)
+            self.assertEqual(b'', body)
+            self.assertEqual(
+                'bytes */%d' % len(DATA),
+                response.getheader('Content-Range'))
+
+    def test_unsupported_range(self):
+        """Tests that the entire file is served for multiple ranges.
+        """
+        response, body = self.request({'Range': 'bytes=0-1,5-6'})
+        self.assertEqual(200, response.status)
+        self.assertEqual(DATA, body)
+
+    def test_conditional(self):
+        """Tests that ranges are only served if the file is unchanged, and
+        that unchanged files are not sent again.
+        """
+        response, body = self.request()
+        etag = response.getheader('ETag')
+
+        response, body = self.request({'If-None-Match': etag})
+        self.assertEqual(304, response.status)
+        self.assertEqual(b'', body)
+
+        response, body = self.request({
+            'Range': 'bytes=10-19',
+            'If-Range': '"other"'})
+        self.assertEqual(200, response.status)
+        self.assertEqual(DATA, body)
+
+        response, body = self.request({
+            'Range': 'bytes=10-19',
+            'If-Range': etag})
+        self.assertEqual(206, response.status)
+        self.assertEqual(DATA[10:20], body)
@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+# coding: utf-8
+# photofs
+# Copyright (C) 2012-2016 Moses Palmér
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see <http://www.gnu.org/licenses/>.
+"""Tests for the negative lookup cache.
+
+Run with ``python -m unittest discover tests``.
+"""
+
+import os
+import sys
+import unittest
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lib'))
+
+from photofs._util import NegativeCache
+
+
+class NegativeCacheTest(unittest.TestCase):
+    def test_contains(self):
+        """Tests that only added paths are known not to exist.
+        """
+        cache = NegativeCache()
+        cache.add('/missing', 1)
+        self.assertTrue(cache.contains('/missing', 1))
+        self.assertFalse(cache.contains('/other', 1))
+        self.assertEqual(
+            {'hits': 1, 'misses': 1, 'size': 1},
+            cache.stats)
+
+    def test_generation(self):
+        """Tests that paths added for a previous generation are forgotten.
+        """
+        cache = NegativeCache()
+        cache.add('/missing', 1)
+        self.assertFalse(cache.contains('/missing', 2))
+
+        cache.add('/other', 2)
+        self.assertFalse(cache.contains('/missing', 2))
+        self.assertFalse(cache.contains('/missing', 1))
+        self.assertTrue(cache.contains('/other', 2))
+        self.assertEqual(1, cache.stats['size'])
+
+    def test_max_size(self):
+        """Tests that the cache is cleared when full.
+        """
+        cache = NegativeCache(max_size=2)
+        cache.add('/first', 1)
+        cache.add('/second', 1)
+        cache.add('/third', 1)
+        self.assertFalse(cache.contains('/first', 1))
+        self.assertFalse(cache.contains('/second', 1))
+        self.assertTrue(cache.contains('/third', 1))
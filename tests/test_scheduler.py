@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+# coding: utf-8
+# photofs
+# Copyright (C) 2012-2016 Moses Palmér
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see <http://www.gnu.org/licenses/>.
+"""Tests for the read scheduler.
+
+Run with ``python -m unittest discover tests``.
+"""
+
+import os
+import sys
+import unittest
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lib'))
+
+from photofs._scheduler import ReadScheduler
+
+
+class ReadSchedulerTest(unittest.TestCase):
+    def setUp(self):
+        self.scheduler = ReadScheduler(
+            workers=1, header_size=100, bulk_threshold=1000)
+
+    def classify(self, fh, offset, size):
+        with self.scheduler._condition:
+            return self.scheduler.classify(fh, offset, size)
+
+    def stream(self, fh, start, end, size=100):
+        """Reads a range of a file sequentially, and returns the priority
+        class of every read.
+        """
+        return [
+            self.classify(fh, offset, size)
+            for offset in range(start, end, size)]
+
+    def test_header(self):
+        """Tests that reads of the header of a file are interactive, even when
+        the file is read sequentially.
+        """
+        self.stream(1, 0, 2000)
+        self.assertEqual(ReadScheduler.INTERACTIVE, self.classify(1, 0, 100))
+        self.assertEqual(ReadScheduler.INTERACTIVE, self.classify(1, 50, 100))
+
+    def test_sequential(self):
+        """Tests that a file becomes bulk once it has been read sequentially
+        past the threshold.
+        """
+        self.assertEqual(
+            [ReadScheduler.INTERACTIVE] * 9 + [ReadScheduler.BULK] * 11,
+            self.stream(1, 0, 2000))
+
+    def test_seek(self):
+        """Tests that a read not continuing the previous read is interactive,
+        and restarts the sequence.
+        """
+        self.stream(1, 0, 2000)
+        self.assertEqual(
+            [ReadScheduler.INTERACTIVE] * 10 + [ReadScheduler.BULK],
+            self.stream(1, 5000, 6100))
+
+    def test_files(self):
+        """Tests that every file handle is classified separately, and that a
+        forgotten handle starts over.
+        """
+        self.stream(1, 0, 2000)
+        self.assertEqual(
+            ReadScheduler.INTERACTIVE, self.classify(2, 2000, 100))
+        self.assertEqual(ReadScheduler.BULK, self.classify(1, 2000, 100))
+        self.scheduler.forget(1)
+        self.assertEqual(
+            ReadScheduler.INTERACTIVE, self.classify(1, 2100, 100))
+
+    def test_read(self):
+        """Tests that reads are performed by the workers, and that their
+        results, exceptions and statistics are reported.
+        """
+        self.assertEqual(b'data', self.scheduler.read(
+            1, 0, 4, lambda: b'data'))
+
+        def fail():
+            raise OSError('failed')
+
+        with self.assertRaises(OSError):
+            self.scheduler.read(1, 4, 4, fail)
+
+        stats = self.scheduler.stats
+        self.assertEqual(2, stats[ReadScheduler.INTERACTIVE]['reads'])
+        self.assertEqual(8, stats[ReadScheduler.INTERACTIVE]['bytes'])
+        self.assertEqual(0, stats[ReadScheduler.BULK]['reads'])
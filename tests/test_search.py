@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+# coding: utf-8
+# photofs
+# Copyright (C) 2012-2016 Moses Palmér
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see <http://www.gnu.org/licenses/>.
+"""Tests for the trigram search index.
+
+Run with ``python -m unittest discover tests``.
+"""
+
+import os
+import sys
+import unittest
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lib'))
+
+from photofs._image import Image
+from photofs._search import SearchIndex
+
+
+def image(title, inode):
+    """Creates an image to index.
+    """
+    st = os.stat_result((0o100644, inode, 0, 1, 0, 0, 5, 0, 0, 0))
+    return Image(title, 'jpg', 1400000000, st, inode=inode)
+
+
+class SearchIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.beach = image('Beach at sunset', 1)
+        self.forest = image('Forest', 2)
+        self.index = SearchIndex()
+        self.index.update([
+            ('Beach at sunset.jpg', self.beach),
+            ('Forest.jpg', self.forest),
+            ('Holiday.jpg', self.forest)])
+
+    def test_search_title(self):
+        """Tests that images are found by a part of their title, ignoring
+        case.
+        """
+        self.assertEqual([self.beach], self.index.search('SUNSET'))
+        self.assertEqual([self.beach], self.index.search('each a'))
+
+    def test_search_name(self):
+        """Tests that images are found by any name under which they are
+        presented.
+        """
+        self.assertEqual([self.forest], self.index.search('holiday'))
+
+    def test_search_short(self):
+        """Tests that terms shorter than a trigram are verified against all
+        documents.
+        """
+        self.assertEqual(
+            set((self.beach, self.forest)),
+            set(self.index.search('s')))
+
+    def test_search_missing(self):
+        """Tests that a term with unknown trigrams, or with trigrams only found
+        in different documents, matches nothing.
+        """
+        self.assertEqual([], self.index.search('mountain'))
+        self.assertEqual([], self.index.search('beach forest'))
+
+    def test_update(self):
+        """Tests that only changed documents are updated, and that removed and
+        renamed images are no longer found by their previous names.
+        """
+        renamed = image('Forest path', 2)
+        self.assertEqual((0, 0), self.index.update([
+            ('Beach at sunset.jpg', self.beach),
+            ('Forest.jpg', self.forest),
+            ('Holiday.jpg', self.forest)]))
+        self.assertEqual((1, 2), self.index.update([
+            ('Forest path.jpg', renamed)]))
+        self.assertEqual(1, len(self.index))
+        self.assertEqual([], self.index.search('sunset'))
+        self.assertEqual([], self.index.search('holiday'))
+        self.assertEqual([renamed], self.index.search('path'))
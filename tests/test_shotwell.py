@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+# coding: utf-8
+# photofs
+# Copyright (C) 2012-2016 Moses Palmér
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see <http://www.gnu.org/licenses/>.
+"""Tests for the *Shotwell* image source.
+
+Run with ``python -m unittest discover tests``.
+"""
+
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lib'))
+
+from photofs import PhotoFS
+from photofs.sources.shotwell import ShotwellSource
+
+
+SCHEMA = """
+    CREATE TABLE phototable (
+        id INTEGER PRIMARY KEY, filename TEXT, exposure_time INTEGER,
+        title TEXT, event_id INTEGER, rating INTEGER, md5 TEXT,
+        thumbnail_md5 TEXT, filesize INTEGER);
+    CREATE TABLE videotable (
+        id INTEGER PRIMARY KEY, filename TEXT, exposure_time INTEGER,
+        title TEXT, event_id INTEGER, rating INTEGER, md5 TEXT,
+        filesize INTEGER);
+    CREATE TABLE tagtable (
+        id INTEGER PRIMARY KEY, name TEXT, photo_id_list TEXT);
+    CREATE TABLE eventtable (
+        id INTEGER PRIMARY KEY, name TEXT, primary_photo_id INTEGER,
+        time_created INTEGER, primary_source_id TEXT, comment TEXT);
+"""
+
+
+class ShotwellSourceTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'photo.db')
+        self.db = sqlite3.connect(self.path)
+        self.db.executescript(SCHEMA)
+        for i in range(1, 5):
+            filename = os.path.join(self.directory, 'photo%d.jpg' % i)
+            with open(filename, 'wb') as f:
+                f.write(b'photo')
+            self.db.execute(
+                'INSERT INTO phototable VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (
+                    i, filename, 1400000000 + i, 'Photo %d' % i, -1, 0,
+                    '%032x' % i, '%032x' % (i + 100), 5))
+        self.db.commit()
+
+    def tearDown(self):
+        self.db.close()
+        shutil.rmtree(self.directory)
+
+    def source(self):
+        """Creates a loaded source for the test database.
+        """
+        result = ShotwellSource(database=self.path)
+        result.refresh()
+        return result
+
+    def tag(self, name, *ids):
+        """Sets the images of a tag.
+
+        :param str name: The name of the tag.
+
+        :param ids: The IDs of the photos.
+        """
+        photo_id_list = ''.join('thumb%016x,' % i for i in ids)
+        if self.db.execute(
+                'UPDATE tagtable SET photo_id_list = ? WHERE name = ?',
+                (photo_id_list, name)).rowcount == 0:
+            self.db.execute(
+                'INSERT INTO tagtable (name, photo_id_list) VALUES (?, ?)',
+                (name, photo_id_list))
+        self.db.commit()
+
+    def test_move_between_tags(self):
+        """Moving photos between tags without changing the lengths of the
+        lists is detected"""
+        self.tag('Cats', 1, 2)
+        self.tag('Dogs', 3, 4)
+        source = self.source()
+        self.assertEqual(
+            ['Photo 1.jpg', 'Photo 2.jpg'], sorted(source['Cats']))
+
+        self.tag('Cats', 1, 3)
+        self.tag('Dogs', 2, 4)
+        source.refresh()
+        self.assertEqual(
+            ['Photo 1.jpg', 'Photo 3.jpg'], sorted(source['Cats']))
+        self.assertEqual(
+            ['Photo 2.jpg', 'Photo 4.jpg'], sorted(source['Dogs']))
+
+    def test_edit_title(self):
+        """Editing a title without changing its length is detected"""
+        self.tag('Cats', 1)
+        source = self.source()
+        self.db.execute("UPDATE phototable SET title = 'Photo X' WHERE id = 1")
+        self.db.commit()
+        source.refresh()
+        self.assertEqual(['Photo X.jpg'], sorted(source['Cats']))
+
+    def test_md5_attribute(self):
+        """Changing the stored hashes updates the extended attributes"""
+        self.tag('Cats', 1)
+        photo_fs = PhotoFS(self.directory, image_source=self.source())
+        path = '/Cats/Photo 1.jpg'
+        self.assertEqual(
+            b'%032x' % 1, photo_fs.getxattr(path, 'user.shotwell.md5'))
+
+        self.db.execute(
+            "UPDATE phototable SET md5 = ?, thumbnail_md5 = ? WHERE id = 1",
+            ('f' * 32, 'e' * 32))
+        self.db.commit()
+        photo_fs.readdir('/', 0)
+        self.assertEqual(
+            b'f' * 32, photo_fs.getxattr(path, 'user.shotwell.md5'))
+        self.assertEqual(
+            b'e' * 32, photo_fs.getxattr(path, 'user.shotwell.thumbnail_md5'))
+
+    def test_move_between_events(self):
+        """Moving photos between existing events is detected"""
+        self.db.execute("INSERT INTO eventtable (id, name) VALUES (1, 'A')")
+        self.db.execute("INSERT INTO eventtable (id, name) VALUES (2, 'B')")
+        self.db.execute('UPDATE phototable SET event_id = 1')
+        self.db.commit()
+        source = self.source()
+        self.assertEqual(4, len(source.views['Events']['A']))
+        self.assertNotIn('B', source.views['Events'])
+
+        self.db.execute('UPDATE phototable SET event_id = 2 WHERE id < 3')
+        self.db.commit()
+        source.refresh()
+        self.assertEqual(
+            ['Photo 3.jpg', 'Photo 4.jpg'],
+            sorted(source.views['Events']['A']))
+        self.assertEqual(
+            ['Photo 1.jpg', 'Photo 2.jpg'],
+            sorted(source.views['Events']['B']))
+
+    def test_list_order(self):
+        """Images with the same name are named in the order of the tag list,
+        regardless of the format of their IDs"""
+        self.db.execute("UPDATE phototable SET title = 'Photo'")
+        self.db.execute(
+            'INSERT INTO tagtable (name, photo_id_list) VALUES (?, ?)',
+            ('Cats', '2,thumb%016x,' % 1))
+        self.db.commit()
+        source = self.source()
+        self.assertEqual(
+            ['Photo (2).jpg', 'Photo.jpg'], sorted(source['Cats']))
+        self.assertTrue(
+            source['Cats']['Photo.jpg'].location.endswith('photo2.jpg'))
+
+    def test_unrelated_change(self):
+        """Committing changes to columns that are not presented keeps the
+        current tags"""
+        self.tag('Cats', 1)
+        source = self.source()
+        generation = source.generation
+        cats = source['Cats']
+        self.db.execute('UPDATE phototable SET filesize = 6')
+        self.db.commit()
+        source.refresh()
+        self.assertEqual(generation, source.generation)
+        self.assertIs(cats, source['Cats'])
+
+    def test_added_after_missing(self):
+        """A photo added after its path was found missing is found once the
+        database has changed"""
+        self.tag('Cats', 1)
+        photo_fs = PhotoFS(self.directory, image_source=self.source())
+        path = '/Cats/Photo 2.jpg'
+        with self.assertRaises(OSError):
+            photo_fs.getattr(path)
+
+        self.tag('Cats', 1, 2)
+        self.assertTrue(photo_fs.getattr(path))